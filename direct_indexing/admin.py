@@ -0,0 +1,41 @@
+from django.contrib import admin
+
+from direct_indexing.models import DatasetState, IndexingRun, RunDataset
+
+
+class IndexingRunAdmin(admin.ModelAdmin):
+    list_display = [
+        'id',
+        'started',
+        'finished',
+        'update',
+        'shadow']
+    ordering = ['-started']
+
+
+class RunDatasetAdmin(admin.ModelAdmin):
+    search_fields = ['dataset_id']
+    list_display = [
+        'run',
+        'dataset_id',
+        'status',
+        'modified']
+    list_filter = ['status']
+    ordering = ['run', 'dataset_id']
+
+
+class DatasetStateAdmin(admin.ModelAdmin):
+    search_fields = ['dataset_id']
+    list_display = [
+        'dataset_id',
+        'filetype',
+        'indexed',
+        'last_indexed',
+        'processing_seconds']
+    list_filter = ['indexed', 'filetype']
+    ordering = ['dataset_id']
+
+
+admin.site.register(DatasetState, DatasetStateAdmin)
+admin.site.register(IndexingRun, IndexingRunAdmin)
+admin.site.register(RunDataset, RunDatasetAdmin)
@@ -0,0 +1,124 @@
+import fcntl
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+MIN_BATCH_SCALE = 0.1
+
+
+@contextmanager
+def write_slot(core):
+    """
+    Hold one of the in-flight write slots of a core while posting to Solr.
+
+    The slots are shared by all worker processes on the host with file locks, and only the
+    first `limit` slots may be taken, where the limit is adapted to Solr by record_write.
+    If no slot frees up within SOLR_TIMEOUT seconds, the write continues without a slot,
+    so a stuck lock can never block indexing.
+
+    :param core: The name of the core written to
+    :return: a function to call with the latency in seconds and success of the write
+    """
+    if not settings.SOLR_BACKPRESSURE:
+        yield lambda latency, ok: None
+        return
+    os.makedirs(settings.SOLR_WRITE_LOCK_DIR, exist_ok=True)
+    slot = _acquire_slot(core)
+    try:
+        yield lambda latency, ok: record_write(core, latency, ok)
+    finally:
+        if slot is not None:
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            slot.close()
+
+
+def record_write(core, latency, ok):
+    """
+    Adapt the write limits of a core to an observed write, additive increase, multiplicative decrease.
+    Every write which succeeded within SOLR_WRITE_TARGET_LATENCY seconds raises the number of in-flight
+    writes by 1/limit, so by about one per round of writes, and the batch size along with it.
+    A failed or slow write halves both, at most once per SOLR_WRITE_TARGET_LATENCY seconds,
+    as the writes in flight at that moment see the same overload.
+
+    :param core: The name of the core written to
+    :param latency: The duration of the write in seconds
+    :param ok: bool to indicate the write succeeded
+    :return: None
+    """
+    with _state(core) as state:
+        now = time.time()
+        if ok and latency <= settings.SOLR_WRITE_TARGET_LATENCY:
+            state['batch_scale'] = min(state['batch_scale'] + 0.1 / state['limit'], 1.0)
+            state['limit'] = min(state['limit'] + 1 / state['limit'], settings.SOLR_MAX_CONCURRENT_WRITES)
+        elif now - state['decreased'] >= settings.SOLR_WRITE_TARGET_LATENCY:
+            state['limit'] = max(state['limit'] / 2, 1)
+            state['batch_scale'] = max(state['batch_scale'] / 2, MIN_BATCH_SCALE)
+            state['decreased'] = now
+            logging.info(f'record_write:: Solr {core} write took {latency:.1f}s (ok: {ok}), limiting to '
+                         f'{int(state["limit"])} concurrent writes at {state["batch_scale"]:.0%} batch size')
+
+
+def batch_size(core, size):
+    """
+    Scale a batch size to the current capacity of Solr for the core.
+
+    :param core: The name of the core written to
+    :param size: The configured batch size
+    :return: The adapted batch size, at least 1
+    """
+    if not settings.SOLR_BACKPRESSURE:
+        return size
+    os.makedirs(settings.SOLR_WRITE_LOCK_DIR, exist_ok=True)
+    with _state(core) as state:
+        return max(int(size * state['batch_scale']), 1)
+
+
+def _acquire_slot(core):
+    """
+    Lock the first free write slot within the current limit of the core.
+
+    :param core: The name of the core written to
+    :return: The open, locked slot file, or None if no slot was freed in time
+    """
+    deadline = time.time() + settings.SOLR_TIMEOUT
+    while time.time() < deadline:
+        with _state(core) as state:
+            limit = int(state['limit'])
+        for i in range(limit):
+            slot = open(os.path.join(settings.SOLR_WRITE_LOCK_DIR, f'{core}.slot{i}'), 'a')
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except OSError:
+                slot.close()
+        time.sleep(random.uniform(0.05, 0.2))
+    logging.warning(f'_acquire_slot:: No Solr {core} write slot freed up, writing without a slot')
+    return None
+
+
+@contextmanager
+def _state(core):
+    """
+    Read and update the shared write limits of a core, under an exclusive file lock.
+
+    :param core: The name of the core
+    :return: the state dict with the limit, batch_scale and decreased time, written back on exit
+    """
+    path = os.path.join(settings.SOLR_WRITE_LOCK_DIR, f'{core}.json')
+    with open(f'{path}.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            state = {'limit': settings.SOLR_MAX_CONCURRENT_WRITES, 'batch_scale': 1.0, 'decreased': 0}
+        before = dict(state)
+        yield state
+        if state != before:
+            with open(path, 'w') as state_file:
+                json.dump(state, state_file)
@@ -1,17 +1,24 @@
-def add_all(data):
+from direct_indexing.custom_fields.dataset_metadata import add_meta_to_activity
+
+# Dataset metadata which the organisation core has no field for
+EXCLUDED_METADATA = ['dataset.extras.validation_status']
+
+
+def add_all(data, metadata=None):
     """
     Start organisation processing.
 
     :param data: the cleaned dataset.
-    :param codelists: an initialized codelist object.
-    :param currencies: an initialized currencies object.
+    :param metadata: the custom dataset metadata, so the documents of the dataset can be found by its dataset.id.
     :return: the updated dataset.
     """
     if type(data) is not list:
         data = [data]
+    metadata = {field: value for field, value in (metadata or {}).items() if field not in EXCLUDED_METADATA}
 
     for organisation in data:
         index_many_to_many_relations(organisation)
+        add_meta_to_activity(organisation, metadata)
 
     return data
 
@@ -2,11 +2,13 @@ import json
 import logging
 
 import pysolr
-import requests
 from django.conf import settings
 
+from direct_indexing import ledger
 from direct_indexing.metadata.dataset import index_datasets_and_dataset_metadata
 from direct_indexing.metadata.publisher import index_publisher_metadata
+from direct_indexing.processing.dataset import DATASET_CORES
+from direct_indexing.util import delete_datasets, delete_documents, reset_core, solr_core_name
 
 
 def run():
@@ -23,17 +25,20 @@ def run():
     index_datasets_and_dataset_metadata(False, False)
 
 
-def clear_indices():
+def clear_indices(shadow=False):
     """
     Clear all indices as indicated by the 'cores' variable.
+
+    :param shadow: bool to indicate the shadow cores should be cleared instead, defaults to False
     """
     try:
-        cores = ['dataset', 'publisher', 'activity', 'transaction', 'budget', 'result', 'organisation']
-        for core in cores:
+        for core in settings.SOLR_CORES:
             logging.info(f'clear_indices:: Clearing {core} core')
-            solr = pysolr.Solr(f'{settings.SOLR_URL}/{core}', always_commit=True)
-            solr.delete(q='*:*')
+            _clear_core(solr_core_name(core, shadow))
             logging.info(f'clear_indices:: Finished clearing {core} core')
+        if not shadow:
+            # The datasets are no longer indexed
+            ledger.clear()
         return 'Success'
     except pysolr.SolrError:
         logging.error('clear_indices:: Could not clear indices')
@@ -46,8 +51,7 @@ def clear_indices_for_core(core):
     """
     try:
         logging.info(f'clear_indices:: Clearing {core} core')
-        solr = pysolr.Solr(f'{settings.SOLR_URL}/{core}', always_commit=True)
-        solr.delete(q='*:*')
+        _clear_core(core)
         logging.info(f'clear_indices:: Finished clearing {core} core')
         return 'Success'
     except pysolr.SolrError:
@@ -55,48 +59,59 @@ def clear_indices_for_core(core):
         raise pysolr.SolrError
 
 
+def _clear_core(core):
+    """
+    Clear a core according to SOLR_CLEAR_MODE. When the core cannot be reset
+    through the CoreAdmin API, its documents are deleted by query instead.
+
+    :param core: The name of the core
+    """
+    if settings.SOLR_CLEAR_MODE == 'reset':
+        try:
+            reset_core(core)
+            return
+        except pysolr.SolrError as e:
+            logging.warning(f'_clear_core:: Could not reset {core} core, deleting its documents instead: {e}')
+    solr = pysolr.Solr(f'{settings.SOLR_URL}/{core}', always_commit=True)
+    solr.delete(q='*:*')
+
+
 # Subsets of the indexing process
-def run_publisher_metadata():
-    result = index_publisher_metadata()
+def run_publisher_metadata(shadow=False):
+    result = index_publisher_metadata(shadow)
     logging.info(f"run_publisher_metadata:: result: {result}")
     if 'ERROR' in result:
         raise ValueError(result)
     return result
 
 
-def run_dataset_metadata(update, force_update=False):
-    result = index_datasets_and_dataset_metadata(update, force_update)
+def run_dataset_metadata(update, force_update=False, shadow=False, resume=False, ignore_content_hash=False):
+    result = index_datasets_and_dataset_metadata(update, force_update, shadow, resume, ignore_content_hash)
     logging.info(f"run_dataset_metadata:: result: {result}")
     return result
 
 
 def drop_removed_data():
+    """
+    Remove the data of every indexed dataset that is no longer in the latest dataset list.
+    The indexed datasets are paged through with a cursor, and the removed datasets
+    are deleted from every core in batched delete-by-query requests.
+    """
     logging.info('drop_removed_data:: Removing all data not found in the latest dataset list')
-    dropped_list = []
-    existing = []
-
-    # Get the datasets that have been indexed
-    url = f'{settings.SOLR_DATASET}/select?fl=name%2Cid%2Ciati_cloud_indexed&indent=true&q.op=OR&q=*%3A*&rows=10000000'
-    data = requests.get(url)
-    data = data.json()['response']['docs']
 
-    # Get a list of dataset names from the dataset metadata file
+    # Get a set of dataset ids from the dataset metadata file
     with open(f'{settings.BASE_DIR}/direct_indexing/data_sources/datasets/dataset_metadata.json') as f:
-        meta = json.load(f)
-        for dataset in meta:
-            existing.append(dataset['name'])
-
-    for d in data:
-        if d['name'] not in existing:
-            dropped_list.append(d['name'])
-
-    # For every core with dataset data, delete the data for the dropped datasets identified with the dataset.name field
-    for core in ['activity', 'transaction', 'result', 'budget']:
-        solr = pysolr.Solr(f'{settings.SOLR_URL}/{core}', always_commit=True)
-        for d_name in dropped_list:
-            if len(solr.search(f'dataset.name:"{d_name}"')) > 0:
-                solr.delete(q=f'dataset.name:"{d_name}"')
-    solr = pysolr.Solr(settings.SOLR_DATASET, always_commit=True)
-    for d_name in dropped_list:
-        if len(solr.search(f'name:"{d_name}"')) > 0:
-            solr.delete(q='name:{d_name}')
+        existing = {dataset['id'] for dataset in json.load(f)}
+
+    # Get the datasets that have been indexed from the dataset ledger, and drop the ones that no longer exist.
+    ledger.ensure_seeded()
+    indexed = ledger.dataset_ids()
+    dropped = sorted(indexed - existing)
+    if not dropped:
+        logging.info('drop_removed_data:: No removed datasets found')
+        return
+
+    delete_datasets(dropped, DATASET_CORES)
+    delete_documents('dataset', dropped)
+    ledger.forget_datasets(dropped)
+    logging.info(f'drop_removed_data:: Removed {len(dropped)} datasets')
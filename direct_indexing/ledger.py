@@ -0,0 +1,185 @@
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from direct_indexing.models import DatasetState, LedgerSeed
+from direct_indexing.runs import dataset_hash
+from direct_indexing.util import iterate_documents
+
+
+def record_dataset(dataset, document_ids=None, duration=None, reindex=False):
+    """
+    Record the state of a dataset after it was processed.
+
+    :param dataset: the cleaned dataset metadata, with its iati_cloud_indexed status.
+    :param document_ids: a dict of the ids of the indexed documents, per core.
+    :param duration: the time spent processing the dataset in seconds.
+    :param reindex: bool to indicate the next update should index the dataset again, although its hash is unchanged.
+    :return: the DatasetState
+    """
+    indexed = bool(dataset.get('iati_cloud_indexed'))
+    state, _ = DatasetState.objects.update_or_create(dataset_id=dataset['id'], defaults={
+        'registry_hash': dataset_hash(dataset),
+        'content_hash': dataset.get('iati_cloud_content_hash') or '',
+        'filetype': dataset.get('extras.filetype') or '',
+        'indexed': indexed,
+        'last_indexed': timezone.now() if indexed else None,
+        'document_counts': {core: len(ids) for core, ids in (document_ids or {}).items()},
+        'processing_seconds': duration,
+        'reindex': reindex,
+    })
+    return state
+
+
+def ensure_seeded():
+    """
+    Seed the ledger once with the datasets in the dataset core, f.ex. right after upgrading,
+    when the datasets indexed before the ledger existed are not recorded in it yet.
+    Without them, updates would index those datasets as new, and never drop them once they are removed.
+    Datasets which are already recorded keep their state.
+
+    :return: None
+    :raises requests.exceptions.RequestException: if the dataset core cannot be read, so no run is planned
+        from an incomplete ledger.
+    """
+    if LedgerSeed.objects.exists():
+        return
+    seeded = _seed()
+    LedgerSeed.objects.create(datasets=seeded)
+    logging.info(f'ensure_seeded:: Seeded the dataset ledger with {seeded} indexed datasets')
+
+
+def reseed():
+    """
+    Replace the state of every dataset with the datasets in the dataset core, once a rebuild was swapped in.
+    A rebuild does not record its datasets while it runs, as its shadow cores may never be swapped in.
+    The dataset core is read in full before the ledger is replaced, in a single transaction, so a failure
+    leaves the previous ledger in place. The document counts and processing times of the datasets which
+    were recorded before are kept, where the dataset core does not hold them.
+
+    :return: None
+    :raises requests.exceptions.RequestException: if the dataset core cannot be read.
+    """
+    states = _seed_states()
+    previous = {
+        dataset_id: (document_counts, processing_seconds)
+        for dataset_id, document_counts, processing_seconds in DatasetState.objects.values_list(
+            'dataset_id', 'document_counts', 'processing_seconds'
+        )
+    }
+    for state in states:
+        if state.dataset_id not in previous:
+            continue
+        document_counts, processing_seconds = previous[state.dataset_id]
+        state.document_counts = document_counts
+        if state.processing_seconds is None:
+            state.processing_seconds = processing_seconds
+    with transaction.atomic():
+        DatasetState.objects.all().delete()
+        DatasetState.objects.bulk_create(states, batch_size=1000)
+    logging.info(f'reseed:: Recorded the {len(states)} datasets of the rebuild in the dataset ledger')
+
+
+def _seed():
+    """
+    Record every dataset in the dataset core which is not recorded yet.
+
+    :return: the number of datasets in the dataset core.
+    """
+    states = _seed_states()
+    DatasetState.objects.bulk_create(states, batch_size=1000, ignore_conflicts=True)
+    return len(states)
+
+
+def _seed_states():
+    """
+    :return: a list of unsaved DatasetStates of every dataset in the dataset core.
+    """
+    fields = ('id,resources.hash,extras.filetype,iati_cloud_content_hash,iati_cloud_indexed,'
+              'iati_cloud_processing_seconds')
+    return [_seed_state(doc) for doc in iterate_documents('dataset', 'id:*', fields)]
+
+
+def _seed_state(doc):
+    """
+    :param doc: a dataset metadata document from the dataset core.
+    :return: an unsaved DatasetState of the document.
+    """
+    registry_hash = doc.get('resources.hash') or ''
+    if isinstance(registry_hash, list):
+        registry_hash = registry_hash[0]
+    return DatasetState(
+        dataset_id=doc['id'],
+        registry_hash=registry_hash,
+        content_hash=doc.get('iati_cloud_content_hash') or '',
+        filetype=doc.get('extras.filetype') or '',
+        indexed=bool(doc.get('iati_cloud_indexed')),
+        processing_seconds=doc.get('iati_cloud_processing_seconds'),
+    )
+
+
+def existing_datasets():
+    """
+    Retrieve the registry hash, filetype and content hash of every recorded dataset with a known hash and filetype.
+    The content hash is only returned for indexed datasets, as only those can be skipped when their file is unchanged,
+    and not for datasets which need to be indexed again.
+
+    :return: a dict of {'hash', 'filetype', 'content_hash', 'reindex'} per dataset id.
+    """
+    rows = DatasetState.objects.exclude(registry_hash='').exclude(filetype='').values_list(
+        'dataset_id', 'registry_hash', 'filetype', 'content_hash', 'indexed', 'reindex'
+    )
+    return {
+        dataset_id: {'hash': registry_hash, 'filetype': filetype, 'reindex': reindex,
+                     'content_hash': content_hash if indexed and not reindex else ''}
+        for dataset_id, registry_hash, filetype, content_hash, indexed, reindex in rows
+    }
+
+
+def update_registry_hashes(registry_hashes):
+    """
+    Record the new registry hash of datasets whose file did not change, so their file is not hashed again.
+
+    :param registry_hashes: a dict of the registry hash per dataset id.
+    :return: None
+    """
+    for dataset_id, registry_hash in registry_hashes.items():
+        DatasetState.objects.filter(dataset_id=dataset_id).update(registry_hash=registry_hash)
+
+
+def dataset_ids():
+    """
+    :return: the set of the ids of every recorded dataset.
+    """
+    return set(DatasetState.objects.values_list('dataset_id', flat=True))
+
+
+def processing_times():
+    """
+    :return: a dict of the last processing time in seconds per dataset id.
+    """
+    return dict(DatasetState.objects.exclude(processing_seconds=None).values_list('dataset_id', 'processing_seconds'))
+
+
+def forget_datasets(removed_ids):
+    """
+    Remove the state of datasets whose data was dropped.
+
+    :param removed_ids: the ids of the removed datasets.
+    :return: None
+    """
+    deleted, _ = DatasetState.objects.filter(dataset_id__in=list(removed_ids)).delete()
+    logging.info(f'forget_datasets:: Removed the state of {deleted} datasets')
+
+
+def clear():
+    """
+    Remove the state of every dataset, when the indexed data is cleared.
+    The empty ledger is complete, as no dataset is indexed anymore.
+
+    :return: None
+    """
+    DatasetState.objects.all().delete()
+    if not LedgerSeed.objects.exists():
+        LedgerSeed.objects.create()
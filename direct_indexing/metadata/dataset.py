@@ -1,12 +1,26 @@
+import heapq
 import logging
+import os
+import time
+from datetime import datetime
 
 import requests
-from celery import shared_task
+from celery import shared_task, uuid
+from celery.result import GroupResult
 from django.conf import settings
 
+from direct_indexing import ledger, runs
 from direct_indexing.custom_fields.models import codelists
-from direct_indexing.metadata.util import download_dataset, retrieve
+from direct_indexing.metadata.util import download_dataset, retrieve, update_dataset_status
+from direct_indexing.models import RunDataset
 from direct_indexing.processing import dataset as dataset_processing
+from direct_indexing.processing.util import get_dataset_filepath, get_dataset_filesize, get_file_hash
+from direct_indexing.routing import fair_order
+from direct_indexing.util import (
+    INDEX_SUCCESS, commit_core, count_documents, optimize_core, solr_core_url, swap_cores, warm_core
+)
+
+REBUILD_SWAPPED = '- Rebuild swapped in'
 
 
 class DatasetException(Exception):
@@ -15,51 +29,370 @@ class DatasetException(Exception):
 
 
 @shared_task
-def subtask_process_dataset(dataset, update):
-    dataset_indexing_result, result = dataset_processing.fun(dataset, update)
+def subtask_process_dataset(dataset, update, shadow=False, run_id=None):
+    try:
+        dataset_indexing_result, result = dataset_processing.fun(dataset, update, shadow)
+    except Exception:
+        # Mark a previously indexed dataset as no longer indexed, without resending its metadata
+        update_dataset_status(dataset['id'], shadow, iati_cloud_indexed=False,
+                              iati_cloud_indexed_datetime=str(datetime.now()))
+        runs.mark_dataset(run_id, dataset['id'], RunDataset.FAILED)
+        raise
     if result == 'Successfully indexed' and dataset_indexing_result == 'Successfully indexed':
+        runs.mark_dataset(run_id, dataset['id'], RunDataset.DONE)
         return result
     elif dataset_indexing_result == 'Dataset invalid':
+        runs.mark_dataset(run_id, dataset['id'], RunDataset.DONE)
         return dataset_indexing_result
     else:
+        runs.mark_dataset(run_id, dataset['id'], RunDataset.FAILED)
         raise DatasetException(message=f'Error indexing dataset {dataset["id"]}\nDataset metadata:\n{result}\nDataset indexing:\n{str(dataset_indexing_result)}')  # NOQA
 
 
-def index_datasets_and_dataset_metadata(update, force_update):
+@shared_task
+def subtask_process_datasets(datasets, shadow=False, run_id=None):
+    """
+    Process a micro batch of small datasets in a single task, see dataset_processing.fun_batch.
+
+    :param datasets: a list of (dataset, update flag) pairs.
+    :param shadow: bool to indicate the datasets should be indexed into the shadow cores.
+    :param run_id: the id of the IndexingRun the datasets belong to, if the run is tracked.
+    :return: a result message, raises a DatasetException if any of the datasets failed.
+    """
+    try:
+        outcomes = dataset_processing.fun_batch(datasets, shadow)
+    except Exception:
+        # Mark the previously indexed datasets as no longer indexed, without resending their metadata
+        for dataset, _ in datasets:
+            update_dataset_status(dataset['id'], shadow, iati_cloud_indexed=False,
+                                  iati_cloud_indexed_datetime=str(datetime.now()))
+            runs.mark_dataset(run_id, dataset['id'], RunDataset.FAILED)
+        raise
+    errors = []
+    for (dataset, _), (dataset_indexing_result, result) in zip(datasets, outcomes):
+        if result != INDEX_SUCCESS or dataset_indexing_result not in (INDEX_SUCCESS, 'Dataset invalid'):
+            errors.append(f'{dataset["id"]}\nDataset metadata:\n{result}\n'
+                          f'Dataset indexing:\n{str(dataset_indexing_result)}')
+            runs.mark_dataset(run_id, dataset['id'], RunDataset.FAILED)
+        else:
+            runs.mark_dataset(run_id, dataset['id'], RunDataset.DONE)
+    if errors:
+        raise DatasetException(message=f'Error indexing {len(errors)} of {len(datasets)} datasets\n'
+                                       + '\n'.join(errors))
+    return INDEX_SUCCESS
+
+
+@shared_task(bind=True, max_retries=None)
+def subtask_finalize_run(self, group_id, shadow=False, started=None, estimated_makespan=None, run_id=None):
+    """
+    Wait until every dataset subtask of the run has finished, successfully or not,
+    then finalize the run. Subtasks which have not finished RUN_FINALIZE_TIMEOUT seconds after
+    the dataset subtasks were dispatched are considered lost, f.ex. with a worker that was killed,
+    and count as failed. The run is then finalized without marking it finished,
+    so resuming it re-dispatches the lost datasets.
+
+    :param group_id: the id of the saved GroupResult tracking the dataset subtasks.
+    :param shadow: bool to indicate the run rebuilt the shadow cores.
+    :param started: the timestamp at which the dataset subtasks were dispatched.
+    :param estimated_makespan: the estimated duration of the dataset subtasks in seconds.
+    :param run_id: the id of the IndexingRun, marked as finished once the run is finalized.
+    :return: the result of finalizing the run.
+    """
+    group_result = GroupResult.restore(group_id)
+    lost = False
+    if group_result is not None and not group_result.ready():
+        # Without the dispatch time, the time waited is derived from the number of retries
+        waited = time.time() - started if started is not None else self.request.retries * settings.RUN_FINALIZE_INTERVAL
+        if waited < settings.RUN_FINALIZE_TIMEOUT:
+            raise self.retry(countdown=settings.RUN_FINALIZE_INTERVAL)
+        lost = True
+        logging.error(f'subtask_finalize_run:: Dataset subtasks of group {group_id} did not finish within '
+                      f'{settings.RUN_FINALIZE_TIMEOUT}s, finalizing the run without them')
+    res = finalize_run(shadow)
+    if not lost:
+        runs.finish_run(run_id)
+    if group_result is not None:
+        res = f'{res}\n{run_summary(group_result)}'
+        if started is not None:
+            res = f'{res}\n{report_makespan(group_result, started, estimated_makespan)}'
+    return res
+
+
+def run_summary(group_result):
+    """
+    Summarize the outcome of the dataset subtasks and the resulting size of the cores.
+
+    :param group_result: the GroupResult tracking the dataset subtasks.
+    :return: a result message
+    """
+    results = group_result.results
+    succeeded = sum(1 for result in results if result.successful())
+    failed = sum(1 for result in results if result.failed())
+    res = f'- Dataset subtasks: {succeeded} succeeded, {failed} failed, of {len(results)}'
+    unfinished = sum(1 for result in results if not result.ready())
+    if unfinished:
+        res = f'{res}, {unfinished} did not finish and are considered failed'
+    for core in settings.SOLR_CORES:
+        try:
+            res = f'{res}\n- {core}: {count_documents(solr_core_url(core))} documents'
+        except requests.exceptions.RequestException as e:
+            logging.warning(f'run_summary:: Could not count the {core} documents: {e}')
+    logging.info(f'run_summary:: {res}')
+    return res
+
+
+def report_makespan(group_result, started, estimated_makespan=None):
+    """
+    Compare the estimated makespan of the run with the actual makespan,
+    from dispatching the datasets until the last dataset subtask was done.
+
+    :param group_result: the GroupResult tracking the dataset subtasks.
+    :param started: the timestamp at which the dataset subtasks were dispatched.
+    :param estimated_makespan: the estimated makespan in seconds, if it could be estimated.
+    :return: a result message
+    """
+    done = [result.date_done.timestamp() for result in group_result.results if result.date_done]
+    actual = f'{max(done) - started:.0f}s' if done else 'unknown'
+    estimated = f'{estimated_makespan:.0f}s' if estimated_makespan is not None else 'unknown'
+    res = f'- Makespan: estimated {estimated}, actual {actual}'
+    logging.info(f'report_makespan:: {res}')
+    return res
+
+
+def finalize_run(shadow=False):
+    """
+    Steps:
+    . Hard commit every core once, unless every update was already hard committed.
+      Rebuilt shadow cores are always committed, as they are about to be swapped in.
+    . Merge the segments of every core, if SOLR_OPTIMIZE_MAX_SEGMENTS is set.
+    . Run the SOLR_WARM_QUERIES of every core, before the shadow cores are swapped in.
+    . If the shadow cores were rebuilt, swap them with the live cores,
+      and record the datasets of the rebuild in the dataset ledger.
+
+    :param shadow: bool to indicate the run rebuilt the shadow cores.
+    :return: a result message
+    """
+    if settings.SOLR_COMMIT_POLICY != 'hard' or shadow:
+        for core in settings.SOLR_CORES:
+            logging.info(f'finalize_run:: -- Committing {core} core')
+            commit_core(solr_core_url(core, shadow))
+    if settings.SOLR_OPTIMIZE_MAX_SEGMENTS:
+        for core in settings.SOLR_CORES:
+            logging.info(f'finalize_run:: -- Merging {core} core segments')
+            optimize_core(solr_core_url(core, shadow), settings.SOLR_OPTIMIZE_MAX_SEGMENTS)
+    for core, queries in settings.SOLR_WARM_QUERIES.items():
+        logging.info(f'finalize_run:: -- Warming {core} core')
+        warm_core(solr_core_url(core, shadow), queries)
+    res = '- Indexing run finalized'
+    if shadow:
+        res = swap_shadow_cores()
+        if res == REBUILD_SWAPPED:
+            try:
+                ledger.reseed()
+            except requests.exceptions.RequestException as e:
+                # The previous ledger is kept, the next update re-indexes the datasets it does not match
+                logging.error(f'finalize_run:: Could not record the datasets of the rebuild in the ledger: {e}')
+    logging.info(f'finalize_run:: result: {res}')
+    return res
+
+
+def swap_shadow_cores():
+    """
+    Swap every rebuilt shadow core with its live core, provided every shadow core holds
+    at least SOLR_REBUILD_MIN_RATIO of the documents of its live core.
+    After the swap the shadow cores hold the previous data, which allows rolling back.
+
+    :return: a result message
+    """
+    for core in settings.SOLR_CORES:
+        live_count = count_documents(solr_core_url(core))
+        shadow_count = count_documents(solr_core_url(core, shadow=True))
+        if shadow_count < live_count * settings.SOLR_REBUILD_MIN_RATIO:
+            res = f'- Rebuild not swapped in, the {core} shadow core has {shadow_count} of {live_count} documents'
+            logging.error(f'swap_shadow_cores:: {res}')
+            return res
+    for core in settings.SOLR_CORES:
+        logging.info(f'swap_shadow_cores:: -- Swapping {core} core')
+        swap_cores(core, f'{core}{settings.SOLR_SHADOW_SUFFIX}')
+    return REBUILD_SWAPPED
+
+
+def index_datasets_and_dataset_metadata(update, force_update, shadow=False, resume=False, ignore_content_hash=False):
     """
     Steps:
     . Download all the datasets
     . Download dataset metadata
     . Download codelists and make data available.
+    . Record the datasets to index in the manifest of the run
     . For every dataset:
         Index that dataset
     . Index all dataset metadata
+    . Track the dataset subtasks and finalize the run once they have all finished
 
+    When resuming, the unfinished datasets of the last run are indexed again, from the
+    pre-downloaded dataset metadata and a resumed download of the datasets.
+
+    :param update: bool to indicate only new and changed datasets should be indexed.
+    :param force_update: bool to indicate the pre-downloaded dataset metadata should be used.
+    :param shadow: bool to indicate the datasets should be indexed into the shadow cores.
+    :param resume: bool to indicate the last run should be resumed, rather than starting a new run.
+    :param ignore_content_hash: bool to indicate an update should index every dataset with a changed registry hash,
+        even if its file did not change.
     :return: None
     """
     logging.info('index_datasets_and_dataset_metadata:: - Dataset metadata and indexing')
-    download_dataset()
+    if resume:
+        run = runs.unfinished_run()
+        if run is None:
+            res = '- No unfinished indexing run to resume'
+            logging.info(f'index_datasets_and_dataset_metadata:: result: {res}')
+            return res
+        shadow = run.shadow
+        force_update = True
+    changed_files = download_dataset(resume=resume)
 
     logging.info('index_datasets_and_dataset_metadata:: -- Retrieve metadata')
     dataset_metadata = retrieve(settings.METADATA_DATASET_URL, 'dataset_metadata', force_update)
 
     # If we are updating instead of refreshing, retrieve dataset ids
-    if update:
-        dataset_metadata, update_bools = prepare_update(dataset_metadata)
+    if update and not resume:
+        dataset_metadata, update_bools = prepare_update(dataset_metadata, ignore_content_hash, changed_files)
     load_codelists()
     logging.info('index_datasets_and_dataset_metadata:: -- Walk the metadata')
-    number_of_datasets = len(dataset_metadata)
-    for i, dataset in enumerate(dataset_metadata):
-        if settings.THROTTLE_DATASET and i % 10 != 0:
-            continue
-        logging.info(f'index_datasets_and_dataset_metadata:: --- Submitting dataset {i+1} of {number_of_datasets}')
-        update_flag = update_bools[i] if update else False
-        subtask_process_dataset.delay(dataset=dataset, update=update_flag)
+    if resume:
+        submissions = runs.unfinished_submissions(run, dataset_metadata)
+    else:
+        submissions = []
+        for i, dataset in enumerate(dataset_metadata):
+            if settings.THROTTLE_DATASET and i % 10 != 0:
+                continue
+            update_flag = update_bools[i] if update else False
+            submissions.append((dataset, update_flag))
+        run = runs.start_run(submissions, update, shadow)
+
+    # Dispatch the most expensive datasets first, so no large dataset is left to run on its own at the end
+    submissions, estimated_makespan = order_by_cost(submissions)
+    submissions = fair_order(submissions)
+    started = time.time()
+    batches = micro_batches(submissions)
+    number_of_tasks = len(batches)
+    subtask_results = []
+    for i, batch in enumerate(batches):
+        logging.info(f'index_datasets_and_dataset_metadata:: --- Submitting task {i+1} of {number_of_tasks}, '
+                     f'{len(batch)} dataset(s)')
+        if len(batch) == 1:
+            dataset, update_flag = batch[0]
+            subtask_results.append(subtask_process_dataset.delay(dataset=dataset, update=update_flag, shadow=shadow,
+                                                                 run_id=run.pk))
+        else:
+            subtask_results.append(subtask_process_datasets.delay(datasets=batch, shadow=shadow, run_id=run.pk))
+    track_run(subtask_results, shadow, started, estimated_makespan, run.pk)
     res = '- All Indexing substasks started'
     logging.info(f'index_datasets_and_dataset_metadata:: result: {res}')
     return res
 
 
+def track_run(subtask_results, shadow=False, started=None, estimated_makespan=None, run_id=None):
+    """
+    Save the dataset subtasks of this run as a group, and start the task
+    which finalizes the run once all of them have finished.
+
+    :param subtask_results: the AsyncResults of the dataset subtasks.
+    :param shadow: bool to indicate the run rebuilds the shadow cores.
+    :param started: the timestamp at which the dataset subtasks were dispatched.
+    :param estimated_makespan: the estimated duration of the dataset subtasks in seconds.
+    :param run_id: the id of the IndexingRun of the subtasks.
+    :return: None
+    """
+    group_result = GroupResult(uuid(), subtask_results)
+    group_result.save()
+    subtask_finalize_run.apply_async(args=[group_result.id, shadow],
+                                     kwargs={'started': started, 'estimated_makespan': estimated_makespan,
+                                             'run_id': run_id},
+                                     countdown=settings.RUN_FINALIZE_INTERVAL)
+
+
+def order_by_cost(submissions):
+    """
+    Order the dataset submissions by their estimated cost, largest first (LPT scheduling).
+    The cost of a dataset is its processing time in the previous run when known,
+    otherwise its file size, converted to seconds with the average processing rate
+    of the datasets whose processing time is known.
+
+    :param submissions: a list of (dataset, update flag) tuples.
+    :return: a tuple of the ordered submissions, and the estimated makespan in seconds,
+        None if there are no previous processing times to estimate it with.
+    """
+    ledger.ensure_seeded()
+    durations = ledger.processing_times()
+    sizes = {dataset['id']: get_dataset_filesize(dataset) for dataset, _ in submissions}
+    known = [dataset_id for dataset_id in sizes if dataset_id in durations and sizes[dataset_id]]
+    known_size = sum(sizes[dataset_id] for dataset_id in known)
+    rate = sum(durations[dataset_id] for dataset_id in known) / known_size if known_size else None
+
+    def cost(dataset_id):
+        if dataset_id in durations:
+            return durations[dataset_id]
+        return sizes[dataset_id] * rate if rate else sizes[dataset_id]
+
+    costs = {dataset_id: cost(dataset_id) for dataset_id in sizes}
+    ordered = sorted(submissions, key=lambda submission: costs[submission[0]['id']], reverse=True)
+    estimated_makespan = None
+    if rate or all(dataset_id in durations for dataset_id in sizes):
+        estimated_makespan = estimate_makespan([costs[dataset['id']] for dataset, _ in ordered],
+                                               settings.DATASET_WORKER_CONCURRENCY)
+    logging.info(f'order_by_cost:: {len(known)} of {len(submissions)} datasets have a known processing time, '
+                 f'estimated makespan: {estimated_makespan}')
+    return ordered, estimated_makespan
+
+
+def micro_batches(submissions):
+    """
+    Pack the submissions of small datasets into micro batches, processed by a single task each,
+    so they do not each pay for a task round trip, codelist and currency setup and Solr posts.
+    A dataset is small when its file is at most DATASET_MICRO_BATCH_SMALL_BYTES, and a batch holds
+    at most DATASET_MICRO_BATCH_COUNT datasets and DATASET_MICRO_BATCH_BYTES of files.
+    Other datasets are submitted on their own, as are all datasets if DATASET_MICRO_BATCH is disabled.
+
+    :param submissions: a list of (dataset, update flag) tuples.
+    :return: a list of batches, lists of (dataset, update flag) tuples, in the order of the submissions.
+    """
+    if not settings.DATASET_MICRO_BATCH:
+        return [[submission] for submission in submissions]
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for submission in submissions:
+        size = get_dataset_filesize(submission[0])
+        if size > settings.DATASET_MICRO_BATCH_SMALL_BYTES:
+            batches.append([submission])
+            continue
+        if batch and (len(batch) >= settings.DATASET_MICRO_BATCH_COUNT
+                      or batch_bytes + size > settings.DATASET_MICRO_BATCH_BYTES):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(submission)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def estimate_makespan(costs, workers):
+    """
+    Estimate the makespan of jobs dispatched in the given order, each to the first free worker.
+
+    :param costs: the costs of the jobs, in dispatch order.
+    :param workers: the number of workers.
+    :return: the makespan, the largest total cost of a single worker.
+    """
+    loads = [0] * max(workers, 1)
+    for job_cost in costs:
+        heapq.heappush(loads, heapq.heappop(loads) + job_cost)
+    return max(loads)
+
+
 def load_codelists():
     """
     Safe loads codelists.
@@ -72,26 +405,83 @@ def load_codelists():
         raise
 
 
-def _get_existing_datasets():
-    url = settings.SOLR_DATASET + (
-        '/select?q=resources.hash:* AND extras.filetype:*'
-        ' AND id:*&rows=100000&wt=json&fl=resources.hash,id,extras.filetype'
-    )
-    data = requests.get(url).json()['response']['docs']
-    datasets = {}
-    for doc in data:
-        datasets[doc['id']] = {'hash': doc['resources.hash'][0], 'filetype': doc['extras.filetype']}
-    return datasets
-
+def prepare_update(dataset_metadata, ignore_content_hash=False, changed_files=None):
+    """
+    Select the new datasets, the datasets whose registry hash changed and those marked to be indexed again.
+    Unless the content hash is ignored, a changed dataset is skipped if its file has the same
+    content hash as when it was last indexed.
+    When the changed files since the previous download are known, those select the datasets whose file changed,
+    also when their registry hash did not, and only the other datasets with a changed registry hash are hashed.
 
-def prepare_update(dataset_metadata):
-    # create a list of new and updated datasets.
-    existing_datasets = _get_existing_datasets()
+    :param dataset_metadata: the list of dataset metadata.
+    :param ignore_content_hash: bool to indicate every dataset with a changed registry hash should be indexed.
+    :param changed_files: an optional dict of the 'added', 'modified' and 'removed' files, see download_dataset.
+    :return: the datasets to index, and a list of bools to indicate which of them were indexed before.
+    """
+    # create a list of new and updated datasets, from the dataset ledger
+    ledger.ensure_seeded()
+    existing_datasets = ledger.existing_datasets()
     new_datasets = [d for d in dataset_metadata if d['id'] not in existing_datasets]
     old_datasets = [d for d in dataset_metadata if d['id'] in existing_datasets]
     changed_datasets = [
-        d for d in old_datasets if d['resources'][0]['hash'] != existing_datasets[d['id']]['hash']
+        d for d in old_datasets
+        if d['resources'][0]['hash'] != existing_datasets[d['id']]['hash'] or existing_datasets[d['id']].get('reindex')
     ]  # Skip organisation files for incremental updates
+    if changed_files is not None:
+        changed_datasets = _files_changed(old_datasets, changed_datasets, existing_datasets, changed_files,
+                                          ignore_content_hash)
+    elif not ignore_content_hash:
+        changed_datasets = _content_changed(changed_datasets, existing_datasets)
     updated_datasets = new_datasets + changed_datasets
     updated_datasets_bools = [False for _ in new_datasets] + [True for _ in changed_datasets]
     return updated_datasets, updated_datasets_bools
+
+
+def _content_changed(changed_datasets, existing_datasets):
+    """
+    Filter out the datasets whose file content did not change since they were last indexed,
+    and record their new registry hash in the dataset ledger.
+
+    :param changed_datasets: the datasets with a changed registry hash.
+    :param existing_datasets: a dict of the hashes of the indexed datasets per dataset id.
+    :return: the datasets whose file content changed, or whose content hash is unknown.
+    """
+    content_changed = []
+    unchanged = {}
+    for dataset in changed_datasets:
+        content_hash = existing_datasets[dataset['id']].get('content_hash')
+        if content_hash and get_file_hash(get_dataset_filepath(dataset)) == content_hash:
+            unchanged[dataset['id']] = dataset['resources'][0]['hash']
+        else:
+            content_changed.append(dataset)
+    if unchanged:
+        logging.info(f'prepare_update:: Skipping {len(unchanged)} datasets with a changed hash but unchanged file')
+        ledger.update_registry_hashes(unchanged)
+    return content_changed
+
+
+def _files_changed(old_datasets, changed_datasets, existing_datasets, changed_files, ignore_content_hash=False):
+    """
+    Select the indexed datasets whose file changed since the previous download.
+    A dataset with a changed registry hash whose file did not change since the previous download
+    may still differ from the file it was last indexed with, f.ex. when the run which should have
+    indexed it failed, so its content hash decides, see _content_changed.
+
+    :param old_datasets: the datasets which were indexed before.
+    :param changed_datasets: the datasets with a changed registry hash.
+    :param existing_datasets: a dict of the hashes of the indexed datasets per dataset id.
+    :param changed_files: a dict of the 'added', 'modified' and 'removed' files.
+    :param ignore_content_hash: bool to indicate every dataset with a changed registry hash should be indexed.
+    :return: the datasets whose file changed, including those with an unchanged registry hash.
+    """
+    paths = {os.path.normpath(path) for files in changed_files.values() for path in files}
+    selected = set()
+    for dataset in old_datasets:
+        filepath = get_dataset_filepath(dataset)
+        if filepath and os.path.normpath(filepath) in paths:
+            selected.add(dataset['id'])
+    unlisted = [dataset for dataset in changed_datasets if dataset['id'] not in selected]
+    if not ignore_content_hash:
+        unlisted = _content_changed(unlisted, existing_datasets)
+    selected.update(dataset['id'] for dataset in unlisted)
+    return [dataset for dataset in old_datasets if dataset['id'] in selected]
@@ -5,14 +5,16 @@ import re
 from django.conf import settings
 
 from direct_indexing.metadata.util import index, retrieve
+from direct_indexing.util import solr_core_url
 
 
-def index_publisher_metadata():
+def index_publisher_metadata(shadow=False):
     """
     Steps:
     . Download publisher metadata
     . Index publisher metadata
 
+    :param shadow: bool to indicate the metadata should be indexed into the shadow core, defaults to False
     :return: None
     """
     logging.info('index_publisher_metadata:: - Publisher metadata')
@@ -24,7 +26,8 @@ def index_publisher_metadata():
 
     # Index the metadata.
     logging.info('index_publisher_metadata:: -- Save JSON publisher metadata')
-    indexing_status = index('publisher_metadata', publishers_metadata, settings.SOLR_PUBLISHER_URL)
+    url = f"{solr_core_url('publisher', shadow)}/update"
+    indexing_status = index('publisher_metadata', publishers_metadata, url)
 
     logging.info(f'index_publisher_metadata:: result: {indexing_status}')
     return indexing_status
@@ -2,13 +2,14 @@ import json
 import logging
 import os
 import shutil
-import urllib
+import subprocess
 import zipfile
+import zlib
 
 import requests
 from django.conf import settings
 
-from direct_indexing.util import index_to_core
+from direct_indexing.util import index_documents, index_to_core, solr_core_url, update_fields
 
 
 def retrieve(url, name=None, force_update=False):
@@ -51,16 +52,55 @@ def index(name, metadata, url):
     with open(path, 'w') as json_file:
         json.dump(metadata, json_file)
 
-    result = index_to_core(url, path)  # Do not remove the metadata file by using default remove=False
+    result = index_to_core(url, path, commit=True)  # Do not remove the metadata file by using default remove=False
     logging.info(f'util.index:: result: {result}')
     return result
 
 
-def download_dataset():
+def index_dataset_metadata(datasets, shadow=False):
+    """
+    Index dataset metadata documents into the dataset core with a single request.
+    The documents are posted before the task that processed the datasets returns,
+    so a dataset is only reported as indexed once its metadata is in Solr.
+
+    :param datasets: A dataset metadata document, or a list of them, f.ex. for a micro batch of datasets
+    :param shadow: bool to indicate the documents should be indexed into the shadow core, defaults to False
+    :return: 'Successfully indexed' or the error message returned by Solr
+    """
+    if type(datasets) is not list:
+        datasets = [datasets]
+    url = f"{solr_core_url('dataset', shadow)}/update"
+    result = index_documents(url, datasets)
+    logging.info(f'util.index_dataset_metadata:: indexed {len(datasets)} dataset metadata documents into {url}, '
+                 f'result: {result}')
+    return result
+
+
+def update_dataset_status(dataset_id, shadow=False, **fields):
+    """
+    Patch status fields of an indexed dataset metadata document, such as iati_cloud_indexed,
+    iati_cloud_indexed_datetime or dataset_valid, without resending the full document.
+
+    :param dataset_id: The id of the dataset
+    :param shadow: bool to indicate the document is in the shadow core, defaults to False
+    :param fields: The fields to set, with their new values
+    :return: 'Successfully indexed' or the error message returned by Solr
+    """
+    url = f"{solr_core_url('dataset', shadow)}/update"
+    result = update_fields(url, [{'id': dataset_id, **fields}], commit=True)
+    logging.info(f'util.update_dataset_status:: updated {list(fields)} of dataset {dataset_id}, result: {result}')
+    return result
+
+
+def download_dataset(resume=False):
     """
     Download all of the datasets and store to local disk.
+    Once the datasets are unzipped, a marker file records the download is complete.
+    With DATASET_SYNC_MODE 'git', the clone of the data repository is synced instead.
 
-    :return: None
+    :param resume: bool to indicate an interrupted download should be resumed. A completed download is
+        kept, a downloaded zip file is only unzipped, and a partial download continues where it stopped.
+    :return: The changed files, see sync_repository and extract_changed, or None if they are unknown.
     """
     try:
         if not settings.FRESH:
@@ -69,20 +109,206 @@ def download_dataset():
         dataset_zip = 'iati-data-main.zip'  # Location of the zip file
         dataset_zip_folder = f'{settings.DATASET_PARENT_PATH}/{os.path.splitext(dataset_zip)[0]}'
         dataset_zip_loc = f'{settings.DATASET_PARENT_PATH}/{dataset_zip}'
+        complete_marker = f'{dataset_zip_folder}.complete'
+
+        if settings.DATASET_SYNC_MODE == 'git':
+            logging.info('download_dataset:: -- Sync the data repository')
+            return sync_repository(dataset_zip_folder)
+
+        if resume and os.path.isfile(complete_marker):
+            logging.info('download_dataset:: -- Using the completed download of the dataset')
+            return
+        if os.path.isfile(complete_marker):
+            os.remove(complete_marker)
 
         # ---- Download and unzip the IATI Datasets ----
         logging.info('download_dataset:: -- Download the actual Dataset')
-        # Download the dataset
-        urlopener = urllib.request.URLopener()
-        urlopener.retrieve(settings.DATASET_URL, dataset_zip_loc)
+        # Download the dataset into a .part file, so an interrupted download can be resumed.
+        # A new download starts over, as a partial download may hold an older version of the file.
+        part_path = f'{dataset_zip_loc}.part'
+        if not resume and os.path.isfile(part_path):
+            os.remove(part_path)
+        if not resume or not zipfile.is_zipfile(dataset_zip_loc):
+            resume_download(settings.DATASET_URL, dataset_zip_loc)
 
         logging.info('download_dataset:: -- Unzip the dataset')
-        # Remove any existing previous data
-        if os.path.isdir(dataset_zip_folder):
-            shutil.rmtree(dataset_zip_folder)
-        # Unzip the dataset
-        with zipfile.ZipFile(dataset_zip_loc, 'r') as data_zip:
-            data_zip.extractall(settings.DATASET_PARENT_PATH)
-    except urllib.error.URLError as e:
+        changes = extract_changed(dataset_zip_loc, dataset_zip_folder)
+        with open(complete_marker, 'w'):
+            pass
+        return changes
+    except (requests.exceptions.RequestException, subprocess.CalledProcessError) as e:
         logging.error(f'download_dataset:: Error downloading dataset, due to {e}')
         raise
+
+
+def extract_changed(zip_path, folder):
+    """
+    Extract only the members of the zip file which changed since the previous extraction,
+    by comparing their CRC32 and size from the central directory with a manifest of the previous extraction,
+    and delete the files which are no longer in the zip file. Every changed file is replaced at once,
+    so the extracted folder stays usable while it is refreshed. A file which was changed on disk since it was
+    extracted, f.ex. by fcdo_replace_partial_url, is restored from the zip file.
+    Without a manifest, the folder is replaced by a full extraction.
+    The manifest records what was extracted, not what was indexed: the update planner still compares
+    the datasets whose registry hash changed with their content hash, so a file extracted for a run
+    which failed is indexed by a later run. A member which could not be extracted is left out of the
+    manifest, so it is extracted again next time.
+
+    :param zip_path: The path of the zip file.
+    :param folder: The folder the zip file extracts to, in the folder of the zip file.
+    :return: A dict of the absolute paths of the 'added', 'modified' and 'removed' files,
+        or None if the zip file was extracted in full.
+    """
+    manifest_path = f'{folder}.manifest.json'
+    parent = os.path.dirname(folder)
+    previous = None
+    if os.path.isdir(folder) and os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path) as manifest_file:
+                previous = json.load(manifest_file)
+        except ValueError:
+            logging.warning('extract_changed:: The manifest of the previous extraction is invalid')
+
+    with zipfile.ZipFile(zip_path, 'r') as data_zip:
+        members = [info for info in data_zip.infolist() if not info.is_dir()]
+        manifest = {info.filename: [info.CRC, info.file_size] for info in members}
+        if previous is None:
+            # Remove any existing previous data, as it is unknown which of its files are still in the zip file
+            if os.path.isdir(folder):
+                shutil.rmtree(folder)
+            data_zip.extractall(parent)
+            changes = None
+        else:
+            changes = {'added': [], 'modified': [], 'removed': []}
+            for info in members:
+                path = os.path.join(parent, info.filename)
+                if previous.get(info.filename) == manifest[info.filename] and _matches_member(path, info):
+                    continue
+                if not _extract_member(data_zip, info, parent):
+                    manifest.pop(info.filename)
+                    continue
+                changes['modified' if info.filename in previous else 'added'].append(path)
+            for name in previous.keys() - manifest.keys():
+                path = os.path.join(parent, name)
+                if os.path.isfile(path):
+                    os.remove(path)
+                changes['removed'].append(path)
+            logging.info(f'extract_changed:: {len(changes["added"])} added, {len(changes["modified"])} modified '
+                         f'and {len(changes["removed"])} removed files of {len(members)}')
+
+    with open(f'{manifest_path}.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+    return changes
+
+
+def _matches_member(path, info):
+    """
+    Check whether the file on disk is the extracted member of the zip file, by its size and CRC32.
+
+    :param path: The path of the extracted file.
+    :param info: The ZipInfo of the member.
+    :return: True if the file exists with the size and CRC32 of the member.
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) != info.file_size:
+        return False
+    crc = 0
+    with open(path, 'rb') as extracted_file:
+        for chunk in iter(lambda: extracted_file.read(1024 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc == info.CRC
+
+
+def _extract_member(data_zip, info, parent):
+    """
+    Extract a single member of a zip file to a temporary file, which then replaces the existing file.
+
+    :param data_zip: The open zip file.
+    :param info: The ZipInfo of the member.
+    :param parent: The folder to extract to.
+    :return: True if extracted, False if the member would be extracted outside of the folder.
+    """
+    path = os.path.realpath(os.path.join(parent, info.filename))
+    if not path.startswith(os.path.realpath(parent) + os.sep):
+        logging.warning(f'_extract_member:: Skipping {info.filename}, outside of the extraction folder')
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with data_zip.open(info) as source, open(f'{path}.tmp', 'wb') as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    os.replace(f'{path}.tmp', path)
+    return True
+
+
+def sync_repository(path):
+    """
+    Sync a shallow clone of the data repository with its remote branch, fetching only the new commits.
+    The working tree is updated in place, so only the changed files are written.
+    A folder which is not a clone, f.ex. an unzipped archive, is replaced by a new clone.
+
+    :param path: The path of the clone.
+    :return: A dict of the absolute paths of the 'added', 'modified' and 'removed' files,
+        or None if the repository was cloned, as every file is new then.
+    """
+    if not os.path.isdir(os.path.join(path, '.git')):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        logging.info(f'sync_repository:: Cloning {settings.DATASET_GIT_URL}')
+        _git('clone', '--depth', '1', '--single-branch', '--branch', settings.DATASET_GIT_BRANCH,
+             settings.DATASET_GIT_URL, path)
+        return None
+
+    changes = {'added': [], 'modified': [], 'removed': []}
+    previous = _git('rev-parse', 'HEAD', cwd=path).strip()
+    _git('fetch', '--depth', '1', settings.DATASET_GIT_URL, settings.DATASET_GIT_BRANCH, cwd=path)
+    latest = _git('rev-parse', 'FETCH_HEAD', cwd=path).strip()
+    if latest == previous:
+        logging.info('sync_repository:: The data repository is up to date')
+        return changes
+
+    # The shallow clone still holds the tree of the previous commit, so the commits can be compared
+    status = {'A': 'added', 'D': 'removed'}
+    diff = _git('diff', '--name-status', '--no-renames', '-z', previous, latest, cwd=path).split('\0')
+    for change, file_path in zip(diff[0::2], diff[1::2]):
+        changes[status.get(change, 'modified')].append(os.path.join(path, file_path))
+    _git('reset', '--quiet', '--hard', latest, cwd=path)
+    logging.info(f'sync_repository:: Synced {previous[:8]}..{latest[:8]}, {len(changes["added"])} added, '
+                 f'{len(changes["modified"])} modified and {len(changes["removed"])} removed files')
+    return changes
+
+
+def _git(*args, cwd=None):
+    """
+    Run a git command.
+
+    :param args: The arguments of the git command.
+    :param cwd: The directory to run the command in.
+    :return: The output of the command.
+    """
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+def resume_download(url, path):
+    """
+    Download a file, continuing a previous partial download of it with a HTTP range request.
+    The download is written to a .part file, which replaces the file once it is complete.
+
+    :param url: The url of the file
+    :param path: The path to store the file at
+    :return: None
+    """
+    part_path = f'{path}.part'
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with requests.get(url, headers=headers, stream=True, timeout=settings.SOLR_TIMEOUT) as response:
+        if response.status_code == 416:
+            # The partial download already holds the complete file
+            os.replace(part_path, path)
+            return
+        response.raise_for_status()
+        # Servers which do not support ranges return the complete file
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        logging.info(f'resume_download:: Downloading {url} from byte {offset if mode == "ab" else 0}')
+        with open(part_path, mode) as part_file:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                part_file.write(chunk)
+    os.replace(part_path, path)
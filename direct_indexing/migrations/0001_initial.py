@@ -0,0 +1,47 @@
+# Generated by Django 4.2.7 on 2026-10-19 02:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexingRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, default=None, null=True)),
+                ('update', models.BooleanField(default=False)),
+                ('shadow', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RunDataset',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dataset_id', models.CharField(max_length=255)),
+                ('dataset_hash', models.CharField(blank=True, default='', max_length=255)),
+                ('update', models.BooleanField(default=False)),
+                ('status', models.CharField(
+                    choices=[('planned', 'Planned'), ('done', 'Done'), ('failed', 'Failed')],
+                    db_index=True, default='planned', max_length=10
+                )),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('run', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='datasets',
+                    to='direct_indexing.indexingrun'
+                )),
+            ],
+            options={
+                'unique_together': {('run', 'dataset_id')},
+            },
+        ),
+    ]
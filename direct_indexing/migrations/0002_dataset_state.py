@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-19 02:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('direct_indexing', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dataset_id', models.CharField(max_length=255, unique=True)),
+                ('registry_hash', models.CharField(blank=True, default='', max_length=255)),
+                ('content_hash', models.CharField(blank=True, default='', max_length=64)),
+                ('filetype', models.CharField(blank=True, default='', max_length=20)),
+                ('indexed', models.BooleanField(default=False)),
+                ('last_indexed', models.DateTimeField(blank=True, default=None, null=True)),
+                ('document_counts', models.JSONField(blank=True, default=dict)),
+                ('processing_seconds', models.FloatField(blank=True, default=None, null=True)),
+            ],
+        ),
+    ]
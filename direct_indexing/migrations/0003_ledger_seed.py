@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-19 03:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('direct_indexing', '0002_dataset_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerSeed',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seeded', models.DateTimeField(auto_now_add=True)),
+                ('datasets', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 03:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('direct_indexing', '0003_ledger_seed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasetstate',
+            name='reindex',
+            field=models.BooleanField(default=False),
+        ),
+    ]
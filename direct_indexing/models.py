@@ -0,0 +1,71 @@
+from django.db import models
+
+
+class IndexingRun(models.Model):
+    """
+    The manifest of an indexing run, recording the datasets it planned to index,
+    so a run which was interrupted can be resumed.
+    """
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True, default=None)
+    update = models.BooleanField(default=False)
+    shadow = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f'Indexing run {self.pk} started {self.started:%Y-%m-%d %H:%M}'
+
+
+class RunDataset(models.Model):
+    PLANNED = 'planned'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PLANNED, 'Planned'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    run = models.ForeignKey(IndexingRun, on_delete=models.CASCADE, related_name='datasets')
+    dataset_id = models.CharField(max_length=255)
+    dataset_hash = models.CharField(max_length=255, blank=True, default='')
+    update = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PLANNED, db_index=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('run', 'dataset_id')
+
+    def __str__(self):
+        return f'{self.dataset_id}: {self.status}'
+
+
+class DatasetState(models.Model):
+    """
+    The state of every dataset as it was last indexed, used to plan incremental updates
+    without querying Solr.
+    """
+    dataset_id = models.CharField(max_length=255, unique=True)
+    registry_hash = models.CharField(max_length=255, blank=True, default='')
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    filetype = models.CharField(max_length=20, blank=True, default='')
+    indexed = models.BooleanField(default=False)
+    last_indexed = models.DateTimeField(null=True, blank=True, default=None)
+    document_counts = models.JSONField(default=dict, blank=True)
+    processing_seconds = models.FloatField(null=True, blank=True, default=None)
+    # Documents of a previous version of the dataset could not be dropped, so the next update indexes it again
+    reindex = models.BooleanField(default=False)
+
+    def __str__(self):
+        return self.dataset_id
+
+
+class LedgerSeed(models.Model):
+    """
+    Marks the dataset ledger as complete, once it was seeded with the datasets indexed before it existed,
+    so incremental updates can be planned from the ledger alone.
+    """
+    seeded = models.DateTimeField(auto_now_add=True)
+    datasets = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'Ledger seeded with {self.datasets} datasets on {self.seeded:%Y-%m-%d %H:%M}'
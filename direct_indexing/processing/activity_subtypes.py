@@ -26,7 +26,8 @@ def extract_subtype(activity, subtype):
 
     # Create a list of the extracted subtypes
     subtype_list = []
-    exclude_fields = []
+    # The content hash only applies to the activity document itself
+    exclude_fields = ['iati_cloud_activity_hash']
     for each_subtype in AVAILABLE_SUBTYPES:
         if each_subtype == subtype:
             continue
@@ -59,11 +60,32 @@ def extract_subtype(activity, subtype):
         subtype_dict = {subtype: dict(subtype_element)}
         for key in activity:
             subtype_dict = process_subtype_dict(subtype_dict, key, i, activity, exclude_fields, include_fields)
+        # Derive a deterministic id from the parent activity, the subtype and its position in the activity
+        if 'id' in activity:
+            subtype_dict['id'] = f'{activity["id"]}|{subtype}|{i}'
         subtype_list.append(subtype_dict)
 
     return subtype_list
 
 
+def subtype_ids(activity):
+    """
+    Derive the ids of the subtype documents of an activity, without extracting them.
+
+    :param activity: the activity, with its document id set.
+    :return: a generator of (subtype, subtype document id) tuples
+    """
+    if 'id' not in activity:
+        return
+    for subtype in AVAILABLE_SUBTYPES:
+        subtype_in_data = activity.get(subtype, [])
+        if isinstance(subtype_in_data, dict):
+            subtype_in_data = [subtype_in_data]
+        for i, subtype_element in enumerate(subtype_in_data):
+            if isinstance(subtype_element, dict):
+                yield subtype, f'{activity["id"]}|{subtype}|{i}'
+
+
 def process_subtype_dict(subtype_dict, key, i, activity, exclude_fields, include_fields):
     """
     Process the subtype dict.
@@ -92,18 +114,19 @@ def process_subtype_dict(subtype_dict, key, i, activity, exclude_fields, include
     return subtype_dict
 
 
-def extract_all_subtypes(subtypes, data):
+def extract_all_subtypes(data):
     """
-    Extract all subtypes from the data.
+    Lazily extract all subtypes from the data, one activity at a time.
+    The extracted subtype documents are yielded rather than collected,
+    so the consumer can index them in bounded batches.
 
-    :param subtypes: the subtypes to extract
     :param data: the activities to extract the subtypes from.
-    :return: the extracted subtypes
+    :return: a generator of (subtype, subtype document) tuples
     """
     if type(data) is not list:
         data = [data]
     for activity in data:
         index_many_to_many_relations(activity)
-        for key in subtypes:
-            subtypes[key] += extract_subtype(activity, key)
-    return subtypes
+        for key in AVAILABLE_SUBTYPES:
+            for subtype_dict in extract_subtype(activity, key):
+                yield key, subtype_dict
@@ -1,25 +1,39 @@
 import json
 import logging
 import os
+import time
 import xml.etree.ElementTree as ET
+from concurrent import futures
 from datetime import datetime
 
+import pysolr
+import requests
 from django.conf import settings
-from pysolr import Solr
 from xmljson import badgerfish as bf
 
+from direct_indexing import ledger
+from direct_indexing.backpressure import batch_size
 from direct_indexing.cleaning.dataset import recursive_attribute_cleaning
 from direct_indexing.cleaning.metadata import clean_dataset_metadata
 from direct_indexing.custom_fields import custom_fields, organisation_custom_fields
 from direct_indexing.custom_fields.models import codelists
 from direct_indexing.custom_fields.models import currencies as cu
-from direct_indexing.metadata.util import index
+from direct_indexing.metadata.util import index_dataset_metadata
 from direct_indexing.processing import activity_subtypes
-from direct_indexing.processing.util import get_dataset_filepath, get_dataset_filetype, get_dataset_version_validity
-from direct_indexing.util import index_to_core
+from direct_indexing.processing.util import (
+    VOLATILE_ACTIVITY_FIELDS, get_dataset_filepath, get_dataset_filetype, get_dataset_version_validity, get_file_hash,
+    set_activity_hashes, set_document_ids
+)
+from direct_indexing.solr_cloud import index_documents_by_shard, index_file_by_shard, route_key
+from direct_indexing.util import (
+    INDEX_SUCCESS, BadRequest, atomic_update, commit_core, delete_documents, index_documents, index_documents_bisecting,
+    index_to_core, iterate_documents, solr_core_name, solr_core_url, upload_executor
+)
 
+DATASET_CORES = ['activity', 'organisation', 'transaction', 'budget', 'result']
 
-def fun(dataset, update=False):
+
+def fun(dataset, update=False, shadow=False):
     """
     Running the dataset means to take the steps.
     . Clean the dataset metadata.
@@ -27,19 +41,84 @@ def fun(dataset, update=False):
     . Check the version validity of the dataset
     . check the filetype of the dataset.
     . Validate the dataset using the IATI Validator
-    . Index the dataset to the appropriate solr core.
+    . Index the dataset to the appropriate solr core, leaving out documents rejected by Solr.
+    . If the dataset was indexed before, drop the documents that no longer exist in it.
 
     :param dataset: The dataset to be indexed.
-    :param codelist: An initialized codelist object
-    :param currencies: An initialized currencies object
+    :param update: Whether the dataset was indexed before. As the documents have deterministic ids,
+        re-indexing overwrites them, only the documents that disappeared need to be deleted.
+    :param shadow: Whether the dataset should be indexed into the shadow cores, for a rebuild.
     :return: The updated dataset metadata.
     """
     logging.info(f'Indexing dataset {dataset}')
+    start = time.time()
+
+    currencies = cu.Currencies()
+    codelist = codelists.Codelists(download=False)
+    processed = process_dataset(dataset, codelist, currencies, shadow, update=update)
+    return complete_dataset(processed, update, shadow, time.time() - start)
+
 
+def fun_batch(datasets, shadow=False):
+    """
+    Run a micro batch of small datasets in sequence, sharing the codelists and currencies,
+    and posting the documents of all datasets in one combined request per core.
+    The status and metadata of every dataset are still recorded individually.
+
+    :param datasets: A list of (dataset, update) pairs, see fun.
+    :param shadow: Whether the datasets should be indexed into the shadow cores, for a rebuild.
+    :return: A list of (dataset indexing result, metadata indexing result) tuples, one per dataset.
+    """
+    logging.info(f'fun_batch:: Indexing a batch of {len(datasets)} datasets')
     currencies = cu.Currencies()
     codelist = codelists.Codelists(download=False)
+    pending = {}
+    processed = []
+    for dataset, update in datasets:
+        start = time.time()
+        processed.append((process_dataset(dataset, codelist, currencies, shadow, pending, update), update,
+                          time.time() - start))
+
+    post_start = time.time()
+    rejected = []
+    results = {core: index_subtype_batch(core, documents, shadow, rejected) for core, documents in pending.items()}
+    post_duration = (time.time() - post_start) / max(len(processed), 1)
+
+    outcomes = []
+    for dataset_run, update, duration in processed:
+        if dataset_run['indexed']:
+            document_ids = dataset_run['document_ids']
+            dataset_run['rejected'].extend(
+                document for document in rejected if document['id'] in document_ids.get(document['core'], ())
+            )
+            errors = [results[core] for core in document_ids if results.get(core, INDEX_SUCCESS) != INDEX_SUCCESS]
+            if errors:
+                dataset_run['indexed'], dataset_run['result'] = False, errors[0]
+        outcomes.append(complete_dataset(dataset_run, update, shadow, duration + post_duration,
+                                         index_metadata=False, commit=False))
+    # The metadata of all datasets is indexed with a single request, before the task returns
+    metadata_result = index_dataset_metadata([dataset_run['dataset'] for dataset_run, _, _ in processed], shadow)
+    commit_dataset_cores({'dataset'}.union(*(dataset_run['cores'] for dataset_run, _, _ in processed)), shadow)
+    return [(dataset_result, metadata_result) for dataset_result, _ in outcomes]
+
+
+def process_dataset(dataset, codelist, currencies, shadow=False, pending=None, update=False):
+    """
+    Clean and validate the dataset, and index it when it is valid.
+
+    :param dataset: The dataset to be indexed.
+    :param codelist: An initialized codelist object
+    :param currencies: An initialized currencies object
+    :param shadow: Whether the dataset should be indexed into the shadow cores, for a rebuild.
+    :param pending: An optional dict in which the documents are collected per core, instead of posting them.
+    :param update: Whether the dataset was indexed before, so its unchanged activities need not be posted again.
+    :return: A dict of the cleaned dataset, whether it was indexed, the indexing result,
+        the ids of the indexed documents per core and the rejected documents.
+    """
     dataset = clean_dataset_metadata(dataset)
     dataset_filepath = get_dataset_filepath(dataset)
+    # The content hash lets the next update skip the dataset if its file did not change
+    dataset['iati_cloud_content_hash'] = get_file_hash(dataset_filepath)
     valid_version = get_dataset_version_validity(dataset, dataset_filepath)
     dataset_filetype = get_dataset_filetype(dataset)
     dataset_metadata = custom_fields.get_custom_metadata(dataset)
@@ -52,33 +131,141 @@ def fun(dataset, update=False):
     dataset['dataset_valid'] = validation_status
     indexed = False
     dataset_indexing_result = "Dataset invalid"
-    # drop the old data from solr
-    if update:
-        for url in [settings.SOLR_ACTIVITY, settings.SOLR_BUDGET, settings.SOLR_RESULT, settings.SOLR_TRANSACTION]:
-            conn = Solr(url)
-            conn.delete(q='%s:"%s"' % ('dataset.id', dataset['id']), commit=True)
-
+    document_ids = {}
+    rejected = []
     # Index the relevant datasets,
     # these are activity files of a valid version and that have been successfully validated (not critical)
     if validation_status == 'Valid':
+        previous_hashes = None
+        if settings.ACTIVITY_INCREMENTAL_UPDATE:
+            # The hashes of the indexed activities only apply to the live core
+            previous_hashes = get_activity_hashes(dataset['id']) if update and not shadow else {}
         indexed, dataset_indexing_result = index_dataset(dataset_filepath, dataset_filetype, codelist, currencies,
-                                                         dataset_metadata)
+                                                         dataset_metadata, document_ids, shadow, rejected, pending,
+                                                         previous_hashes)
+    return {'dataset': dataset, 'indexed': indexed, 'result': dataset_indexing_result,
+            'document_ids': document_ids, 'rejected': rejected}
+
+
+def complete_dataset(dataset_run, update=False, shadow=False, duration=0, index_metadata=True, commit=True):
+    """
+    Drop the stale documents of an updated dataset, record its indexing status in its metadata,
+    and commit the cores it updated once.
+
+    :param dataset_run: The result of process_dataset.
+    :param update: Whether the dataset was indexed before.
+    :param shadow: Whether the dataset was indexed into the shadow cores, for a rebuild.
+    :param duration: The time spent processing the dataset in seconds.
+    :param index_metadata: Whether to index the dataset metadata, False when the caller indexes it
+        together with the metadata of other datasets.
+    :param commit: Whether to commit the updated cores, False when the caller commits them
+        together with the cores of other datasets.
+    :return: A tuple of the dataset indexing result and the dataset metadata indexing result,
+        None if the metadata was not indexed. The updated cores are kept in dataset_run['cores'].
+    """
+    dataset = dataset_run['dataset']
+    document_ids = dataset_run['document_ids']
+    rejected = dataset_run['rejected']
+    # Rejected documents were not indexed, so their previous versions are stale
+    for document in rejected:
+        document_ids.get(document['core'], set()).discard(document['id'])
+    cores = dataset_run['cores'] = set(document_ids)
+    # Cores whose stale documents could not be dropped, the next update indexes the dataset again to drop them
+    failed_drops = []
+    if update:
+        cores.update(drop_stale_documents(dataset['id'], document_ids, failed_drops))
     # Add an indexing status to the dataset metadata.
-    dataset['iati_cloud_indexed'] = indexed
+    dataset['iati_cloud_indexed'] = dataset_run['indexed']
     dataset['iati_cloud_indexed_datetime'] = str(datetime.now())
+    dataset['iati_cloud_rejected_count'] = len(rejected)
+    # The processing time is used to order the datasets of the next run
+    dataset['iati_cloud_processing_seconds'] = round(duration, 1)
+    if rejected:
+        dataset['iati_cloud_rejected_documents'] = [
+            f"{document['core']} {document['id']}: {document['error']}" for document in rejected
+        ]
+
+    result = None
+    if index_metadata:
+        logging.info('-- Save the dataset metadata')
+        result = index_dataset_metadata(dataset, shadow)
+    # Record the state of the dataset, to plan the next incremental update with.
+    # A rebuild is recorded once its shadow cores are swapped in.
+    if not shadow:
+        ledger.record_dataset(dataset, document_ids, dataset['iati_cloud_processing_seconds'], bool(failed_drops))
+
+    if commit:
+        commit_dataset_cores(cores | {'dataset'}, shadow)
+    return dataset_run['result'], result
+
+
+def commit_dataset_cores(cores, shadow=False):
+    """
+    Commit the cores updated for one or more datasets once, under the hard and soft commit policies.
+    The other policies leave committing to Solr or to the end of the run, as do rebuilds,
+    whose shadow cores are committed before they are swapped in.
+
+    :param cores: The names of the updated cores.
+    :param shadow: Whether the datasets were indexed into the shadow cores, for a rebuild.
+    :return: None
+    """
+    if shadow or settings.SOLR_COMMIT_POLICY not in ('hard', 'soft'):
+        return
+    for core in sorted(cores):
+        try:
+            commit_core(solr_core_url(core), soft=settings.SOLR_COMMIT_POLICY == 'soft')
+        except pysolr.SolrError:
+            # The updates are still committed with the next commit of the core
+            logging.warning(f'commit_dataset_cores:: Could not commit the {core} core')
+
 
-    # Index the dataset metadata
-    logging.info('-- Save the dataset metadata')
-    result = index(
-        f'iati-data-main/metadata/{dataset["organization"]["name"]}/{dataset["name"]}',
-        dataset,
-        settings.SOLR_DATASET_URL
-    )
+def get_activity_hashes(dataset_id):
+    """
+    Retrieve the content hashes of the indexed activities of a dataset.
 
-    return dataset_indexing_result, result
+    :param dataset_id: The id of the dataset.
+    :return: A dict of the activity hash per document id, empty if they could not be retrieved.
+    """
+    try:
+        return {
+            doc['id']: doc['iati_cloud_activity_hash']
+            for doc in iterate_documents('activity', f'dataset.id:"{dataset_id}"', 'id,iati_cloud_activity_hash')
+            if 'iati_cloud_activity_hash' in doc
+        }
+    except requests.exceptions.RequestException as e:
+        logging.warning(f'get_activity_hashes:: Could not retrieve the activity hashes of {dataset_id}: {e}')
+        return {}
 
 
-def index_dataset(internal_url, dataset_filetype, codelist, currencies, dataset_metadata):
+def drop_stale_documents(dataset_id, document_ids, failed=None):
+    """
+    Delete the documents of a re-indexed dataset which were not overwritten,
+    because they no longer exist in the dataset.
+    A core which cannot be read or deleted from is skipped, the indexed documents are not affected by it.
+
+    :param dataset_id: The id of the dataset.
+    :param document_ids: A dict of the ids of the documents indexed for the dataset, per core.
+    :param failed: An optional list in which the cores whose stale documents could not be dropped are collected.
+    :return: The cores from which documents were deleted, uncommitted.
+    """
+    if failed is None:
+        failed = []
+    cores = []
+    for core in DATASET_CORES:
+        try:
+            existing_ids = {doc['id'] for doc in iterate_documents(core, f'dataset.id:"{dataset_id}"', 'id')}
+            stale_ids = existing_ids - document_ids.get(core, set())
+            if stale_ids:
+                delete_documents(core, stale_ids, commit=False)
+                cores.append(core)
+        except (requests.exceptions.RequestException, pysolr.SolrError) as e:
+            logging.warning(f'drop_stale_documents:: Could not drop the stale {core} documents of {dataset_id}: {e}')
+            failed.append(core)
+    return cores
+
+
+def index_dataset(internal_url, dataset_filetype, codelist, currencies, dataset_metadata, document_ids=None,
+                  shadow=False, rejected=None, pending=None, previous_hashes=None):
     """
     Index the dataset to the correct core.
 
@@ -86,14 +273,30 @@ def index_dataset(internal_url, dataset_filetype, codelist, currencies, dataset_
     :param dataset_filetype: The filetype of the dataset.
     :param codelist: An initialized codelist object
     :param currencies: An initialized currencies object
+    :param document_ids: An optional dict in which the ids of the indexed documents are collected per core.
+    :param shadow: Whether the dataset should be indexed into the shadow cores.
+    :param rejected: An optional list in which the documents rejected by Solr are collected.
+    :param pending: An optional dict in which the documents are collected per core, instead of posting them.
+    :param previous_hashes: An optional dict of the hashes of the indexed activities, to hash the activities
+        and only post the changed ones. None to post every activity without hashing them.
     :return: true if indexing successful, false if failed.
     """
+    # The subtype batches are uploaded in the background while the dataset is processed and posted
+    uploads = []
+    start = time.time()
     try:
-        core_url = settings.SOLR_ACTIVITY_URL if dataset_filetype == 'activity' else settings.SOLR_ORGANISATION_URL
+        core = 'activity' if dataset_filetype == 'activity' else 'organisation'
         json_path = convert_and_save_xml_to_processed_json(internal_url, dataset_filetype, codelist, currencies,
-                                                           dataset_metadata)
+                                                           dataset_metadata, document_ids, shadow, rejected, uploads,
+                                                           pending, previous_hashes)
         if json_path:
-            result = index_to_core(core_url, json_path, remove=True)
+            upload_start = time.time()
+            result, duration = index_dataset_file(core, json_path, shadow, rejected, pending)
+            subtype_result, subtype_duration = wait_for_uploads(uploads)
+            if result == INDEX_SUCCESS:
+                result = subtype_result
+            logging.info(f'index_dataset:: uploaded {internal_url} in {time.time() - upload_start:.1f}s, '
+                         f'{duration + subtype_duration:.1f}s of posts to Solr')
             logging.debug(f'result of indexing {result}')
             if result == 'Successfully indexed':
                 return True, result
@@ -102,9 +305,74 @@ def index_dataset(internal_url, dataset_filetype, codelist, currencies, dataset_
     except Exception as e:  # NOQA
         logging.warning(f'Exception occurred while indexing {dataset_filetype} dataset:\n{internal_url}\n{e}\nTherefore the dataset will not be indexed.')  # NOQA
         return False, str(e)
+    finally:
+        # Never leave uploads of the dataset running once it is done
+        wait_for_uploads(uploads)
+        logging.debug(f'index_dataset:: indexed {internal_url} in {time.time() - start:.1f}s')
+
 
+def index_dataset_file(core, json_path, shadow=False, rejected=None, pending=None):
+    """
+    Post the json file of the activities or organisations of a dataset to the core, and remove it.
+
+    :param core: The core to index into, activity or organisation.
+    :param json_path: The path to the json file.
+    :param shadow: Whether the file should be indexed into the shadow core.
+    :param rejected: An optional list in which the documents rejected by Solr are collected.
+    :param pending: An optional dict in which the documents are collected per core, instead of posting them.
+    :return: A tuple of 'Successfully indexed' or the error message, and the duration of the posts in seconds.
+    """
+    start = time.time()
+    if pending is not None:
+        with open(json_path) as json_file:
+            documents = json.load(json_file)
+        os.remove(json_path)
+        pending.setdefault(core, []).extend(documents if type(documents) is list else [documents])
+        return INDEX_SUCCESS, 0
+    core_url = f'{solr_core_url(core, shadow)}/update'
+    if settings.SOLR_CLOUD:
+        result = index_file_by_shard(solr_core_name(core, shadow), json_path, core=core)
+    else:
+        result = index_to_core(core_url, json_path, core=core)
+    if isinstance(result, BadRequest) and settings.SOLR_BISECT_FAILED_BATCHES:
+        with open(json_path) as json_file:
+            documents = json.load(json_file)
+        if type(documents) is not list:
+            documents = [documents]
+        result = bisect_failed_batch(core, core_url, documents, rejected, result)
+    if os.path.exists(json_path):
+        os.remove(json_path)
+    return result, time.time() - start
+
+
+def wait_for_uploads(uploads):
+    """
+    Wait for the background uploads of a dataset to finish.
 
-def convert_and_save_xml_to_processed_json(filepath, filetype, codelist, currencies, dataset_metadata):
+    :param uploads: The list of futures of the uploads, emptied once they are finished.
+    :return: A tuple of 'Successfully indexed' or the first error message, and the total duration of the uploads.
+        An upload which raised is reported by its exception, so waiting never raises itself.
+    """
+    result = INDEX_SUCCESS
+    duration = 0
+    try:
+        for upload in futures.as_completed(uploads):
+            try:
+                upload_result, upload_duration = upload.result()
+            except Exception as e:  # NOQA
+                logging.warning(f'wait_for_uploads:: upload failed: {e}')
+                upload_result, upload_duration = str(e), 0
+            duration += upload_duration
+            if upload_result != INDEX_SUCCESS and result == INDEX_SUCCESS:
+                result = upload_result
+    finally:
+        uploads.clear()
+    return result, duration
+
+
+def convert_and_save_xml_to_processed_json(filepath, filetype, codelist, currencies, dataset_metadata,
+                                           document_ids=None, shadow=False, rejected=None, uploads=None,
+                                           pending=None, previous_hashes=None):
     """
     Read the XML into a convertible format and save it to a json file,
     after extracting the activity or organisations from it and cleaning the dataset.
@@ -114,6 +382,13 @@ def convert_and_save_xml_to_processed_json(filepath, filetype, codelist, currenc
     :param codelist: An initialized codelist object
     :param currencies: An initialized currencies object
     :param dataset_metadata: The metadata of the dataset.
+    :param document_ids: An optional dict in which the ids of the indexed documents are collected per core.
+    :param shadow: Whether the subtypes should be indexed into the shadow cores.
+    :param rejected: An optional list in which the subtype documents rejected by Solr are collected.
+    :param uploads: An optional list to collect the futures of the subtype uploads in, instead of waiting for them.
+    :param pending: An optional dict in which the subtype documents are collected per core, instead of posting them.
+    :param previous_hashes: An optional dict of the hashes of the indexed activities. When given, the activities are
+        hashed, and the activities with an unchanged hash are left out of the json file along with their subtypes.
     :return: The filepath of the json file.
     """
     parser = ET.XMLParser(encoding='utf-8')
@@ -144,7 +419,23 @@ def convert_and_save_xml_to_processed_json(filepath, filetype, codelist, currenc
     if filetype == 'activity':
         data = custom_fields.add_all(data, codelist, currencies, dataset_metadata)
     if filetype == 'organisation':
-        data = organisation_custom_fields.add_all(data)
+        data = organisation_custom_fields.add_all(data, dataset_metadata)
+
+    if document_ids is None:
+        document_ids = {}
+    dataset_id = dataset_metadata.get('dataset.id') if dataset_metadata else None
+    document_ids[filetype] = set(set_document_ids(data, filetype, dataset_id, route_key(dataset_metadata)))
+
+    # The activities are hashed after all custom fields are added, as the aggregations depend on their siblings
+    unchanged = []
+    if filetype == 'activity' and previous_hashes is not None:
+        unchanged_ids = set_activity_hashes(data, previous_hashes)
+        if unchanged_ids:
+            activities = data if type(data) is list else [data]
+            unchanged = [activity for activity in activities if activity['id'] in unchanged_ids]
+            data = [activity for activity in activities if activity['id'] not in unchanged_ids]
+            logging.info(f'convert_and_save_xml_to_processed_json:: Skipping {len(unchanged)} unchanged '
+                         f'activities of {len(activities)}')
 
     json_path = json_filepath(filepath)
     if not json_path:
@@ -153,11 +444,41 @@ def convert_and_save_xml_to_processed_json(filepath, filetype, codelist, currenc
         json.dump(data, json_file)
 
     if not settings.FCDO_INSTANCE:
-        dataset_subtypes(filetype, data, json_path)
+        document_ids.update(dataset_subtypes(filetype, data, shadow, rejected, uploads, pending))
+        # The subtypes of the unchanged activities are kept as they are
+        for activity in unchanged:
+            for subtype, subtype_id in activity_subtypes.subtype_ids(activity):
+                document_ids.setdefault(subtype, set()).add(subtype_id)
+    if unchanged:
+        refresh_unchanged_documents(unchanged, shadow, rejected, uploads, pending)
 
     return json_path
 
 
+def refresh_unchanged_documents(activities, shadow=False, rejected=None, uploads=None, pending=None):
+    """
+    Set the dataset metadata which changes with every version of a dataset on the documents of the unchanged
+    activities and their subtypes, with atomic updates, as the documents themselves are not posted again.
+    The updates are batched and posted like the subtypes, see index_subtypes.
+
+    :param activities: The unchanged activities, with the dataset metadata of the new version.
+    :param shadow: Whether the documents are in the shadow cores.
+    :param rejected: An optional list in which the updates rejected by Solr are collected.
+    :param uploads: An optional list to collect the futures of the uploads in, instead of waiting for them.
+    :param pending: An optional dict in which the updates are collected per core, instead of posting them.
+    """
+    def updates():
+        for activity in activities:
+            fields = {field: activity.get(field) for field in VOLATILE_ACTIVITY_FIELDS}
+            yield 'activity', atomic_update({'id': activity['id'], **fields})
+            if settings.FCDO_INSTANCE:
+                continue
+            for subtype, subtype_id in activity_subtypes.subtype_ids(activity):
+                yield subtype, atomic_update({'id': subtype_id, **fields})
+
+    index_subtypes(updates(), shadow, rejected, uploads, pending)
+
+
 def json_filepath(filepath):
     """
     os.path provides the splitext function, which splits a
@@ -173,39 +494,127 @@ def json_filepath(filepath):
         return False
 
 
-def dataset_subtypes(filetype, data, json_path):
+def dataset_subtypes(filetype, data, shadow=False, rejected=None, uploads=None, pending=None):
     """
     extract and index the subtypes of the dataset if it is an activity dataset.
 
     :param filetype: The filetype of the dataset.
     :param data: The data of the dataset.
-    :param json_path: The filepath of the json file.
+    :param shadow: Whether the subtypes should be indexed into the shadow cores.
+    :param rejected: An optional list in which the subtype documents rejected by Solr are collected.
+    :param uploads: An optional list to collect the futures of the subtype uploads in, instead of waiting for them.
+    :param pending: An optional dict in which the subtype documents are collected per core, instead of posting them.
+    :return: A dict of the ids of the indexed subtypes, per subtype.
     """
     # Activity subtypes
-    subtypes = dict()
     if filetype == 'activity':
-        for key in activity_subtypes.AVAILABLE_SUBTYPES:
-            subtypes[key] = []
+        subtypes = activity_subtypes.extract_all_subtypes(data)
+        return index_subtypes(subtypes, shadow, rejected, uploads, pending)
+    return {}
 
-        subtypes = activity_subtypes.extract_all_subtypes(subtypes, data)
-        index_subtypes(json_path, subtypes)
 
-
-def index_subtypes(json_path, subtypes):
+def index_subtypes(subtypes, shadow=False, rejected=None, uploads=None, pending=None):
     """
     Index the subtypes of the activity.
-    Subtypes being the transactions, budgets and results stored in the dict.
+    Subtypes being the transactions, budgets and results yielded by the extraction.
 
-    First, store them to the appropriate json file. Then index them.
+    The subtypes are collected in a bounded batch per core, and every batch
+    is sent to Solr as soon as it is full, so memory does not grow with the
+    number of subtypes in the dataset. The batch size shrinks while Solr is overloaded.
 
-    :param json_path: The filepath of the json file.
-    :param subtypes: The dict of subtypes to be stored and indexed.
-    :return: None
+    When a list of uploads is given, the batches are posted concurrently by the upload threads,
+    with at most SOLR_UPLOAD_THREADS batches in flight, and their futures are collected in the list.
+
+    :param subtypes: An iterable of (subtype, subtype document) tuples.
+    :param shadow: Whether the subtypes should be indexed into the shadow cores.
+    :param rejected: An optional list in which the subtype documents rejected by Solr are collected.
+    :param uploads: An optional list to collect the futures of the subtype uploads in, instead of waiting for them.
+    :param pending: An optional dict in which the subtype documents are collected per core, instead of posting them.
+    :return: A dict of the ids of the indexed subtypes, per subtype.
+    """
+    def flush(subtype, batch):
+        if pending is not None:
+            pending.setdefault(subtype, []).extend(batch)
+            return
+        if uploads is None:
+            index_subtype_batch(subtype, batch, shadow, rejected)
+            return
+        in_flight = [upload for upload in uploads if not upload.done()]
+        if len(in_flight) >= settings.SOLR_UPLOAD_THREADS:
+            futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+        uploads.append(upload_executor().submit(timed_subtype_batch, subtype, batch, shadow, rejected))
+
+    batches = {}
+    sizes = {}
+    subtype_ids = {}
+    for subtype, subtype_dict in subtypes:
+        if 'id' in subtype_dict:
+            subtype_ids.setdefault(subtype, set()).add(subtype_dict['id'])
+        batch = batches.setdefault(subtype, [])
+        if not batch:
+            sizes[subtype] = batch_size(subtype, settings.SOLR_SUBTYPE_BATCH_SIZE)
+        batch.append(subtype_dict)
+        if len(batch) >= sizes[subtype]:
+            flush(subtype, batch)
+            batches[subtype] = []
+    # Flush the remaining, partially filled batches
+    for subtype, batch in batches.items():
+        if batch:
+            flush(subtype, batch)
+    return subtype_ids
+
+
+def index_subtype_batch(subtype, batch, shadow=False, rejected=None):
+    """
+    Index a single batch of subtypes directly into the subtype core.
+
+    :param subtype: The subtype of the batch, transaction, budget or result.
+    :param batch: The list of subtype documents.
+    :param shadow: Whether the batch should be indexed into the shadow core.
+    :param rejected: An optional list in which the subtype documents rejected by Solr are collected.
+    :return: 'Successfully indexed' or the error message returned by Solr
+    """
+    core_url = f'{solr_core_url(subtype, shadow)}/update'
+    if settings.SOLR_CLOUD:
+        result = index_documents_by_shard(solr_core_name(subtype, shadow), batch, subtype)
+    else:
+        result = index_documents(core_url, batch, core=subtype)
+    if isinstance(result, BadRequest) and settings.SOLR_BISECT_FAILED_BATCHES:
+        result = bisect_failed_batch(subtype, core_url, batch, rejected, result)
+    if result != INDEX_SUCCESS:
+        logging.warning(f'index_subtype_batch:: failed to index {len(batch)} {subtype} documents: {result}')
+    return result
+
+
+def timed_subtype_batch(subtype, batch, shadow=False, rejected=None):
+    """
+    Index a single batch of subtypes, timing the upload.
+
+    :return: A tuple of the result of index_subtype_batch and its duration in seconds.
     """
-    for subtype in subtypes:
-        subtype_json_path = f'{os.path.splitext(json_path)[0]}_{subtype}.json'
-        with open(subtype_json_path, 'w') as json_file:
-            json.dump(subtypes[subtype], json_file)
+    start = time.time()
+    result = index_subtype_batch(subtype, batch, shadow, rejected)
+    return result, time.time() - start
 
-        solr_url = activity_subtypes.AVAILABLE_SUBTYPES[subtype]
-        index_to_core(solr_url, subtype_json_path, remove=True)
+
+def bisect_failed_batch(core, core_url, documents, rejected=None, error=None):
+    """
+    Retry a batch of documents which Solr rejected as a bad request by bisecting it,
+    so only the invalid documents are left out. At most SOLR_MAX_REJECTED_DOCUMENTS
+    documents are rejected per dataset, beyond that the batch fails as a whole.
+
+    :param core: The name of the core.
+    :param core_url: The url of the update handler of the core.
+    :param documents: The documents of the failed batch.
+    :param rejected: An optional list in which the rejected documents are collected.
+    :param error: The error of the failed batch, its halves are retried without posting it again.
+    :return: 'Successfully indexed' or the error message returned by Solr.
+    """
+    if rejected is None:
+        rejected = []
+    max_rejected = max(settings.SOLR_MAX_REJECTED_DOCUMENTS - len(rejected), 0)
+    result, batch_rejected = index_documents_bisecting(core_url, documents, core, max_rejected, error)
+    rejected.extend(batch_rejected)
+    if batch_rejected:
+        logging.warning(f'bisect_failed_batch:: {len(batch_rejected)} {core} documents were rejected by Solr')
+    return result
@@ -1,8 +1,13 @@
+import hashlib
+import json
 import os
 import xml.etree.ElementTree as element_tree
 
 from django.conf import settings
 
+HASH_CHUNK_SIZE = 1048576
+# Dataset metadata which changes with every version of a dataset, left out of the activity hash
+VOLATILE_ACTIVITY_FIELDS = ['dataset.metadata_modified', 'dataset.resources.hash', 'dataset.resources.last_modified']
 VALID_VERSIONS = ['2.01', '2.02', '2.03']
 INVALID_VERSIONS = ['1.01', '1.02', '1.03', '1.04', '1.05']
 
@@ -31,6 +36,35 @@ def get_dataset_filepath(dataset):
         return None
 
 
+def get_dataset_filesize(dataset):
+    """
+    Retrieve the size of the downloaded file of a dataset.
+
+    :param dataset: the dataset metadata.
+    :return: the file size in bytes, 0 if the file is not found.
+    """
+    filepath = get_dataset_filepath(dataset)
+    if filepath and os.path.isfile(filepath):
+        return os.path.getsize(filepath)
+    return 0
+
+
+def get_file_hash(filepath):
+    """
+    Hash the content of a file, reading it in chunks so large files are not loaded into memory.
+
+    :param filepath: the path to the file.
+    :return: the hex SHA-256 digest of the file content, an empty string if the file is not found.
+    """
+    if not filepath or not os.path.isfile(filepath):
+        return ''
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def get_dataset_version_validity(dataset, dataset_filepath):
     """
     We consider a dataset valid when it is one of the following
@@ -87,6 +121,65 @@ def get_dataset_filetype(dataset):
         return 'None'
 
 
+def set_document_ids(data, filetype, dataset_id, route=None):
+    """
+    Give every activity or organisation a deterministic id, so re-indexing a dataset
+    overwrites its existing documents rather than adding new ones.
+
+    The id is derived from the dataset id and the iati-identifier or organisation-identifier,
+    an identifier which is repeated within the dataset gets its occurrence appended.
+    If there is no identifier, the position in the dataset is used instead.
+    With a SolrCloud routing key, the ids are prefixed with route! for compositeId routing.
+
+    :param data: The activities or organisations of the dataset.
+    :param filetype: The filetype of the dataset, activity or organisation.
+    :param dataset_id: The id of the dataset.
+    :param route: An optional compositeId routing key.
+    :return: The list of assigned ids.
+    """
+    identifier_key = 'iati-identifier' if filetype == 'activity' else 'organisation-identifier'
+    if type(data) is not list:
+        data = [data]
+    ids = []
+    occurrences = {}
+    for i, document in enumerate(data):
+        identifier = str(document.get(identifier_key, f'position-{i}'))
+        occurrence = occurrences.get(identifier, 0)
+        occurrences[identifier] = occurrence + 1
+        document_id = f'{dataset_id}|{identifier}'
+        if route:
+            document_id = f'{route}!{document_id}'
+        if occurrence:
+            document_id = f'{document_id}|{occurrence}'
+        document['id'] = document_id
+        ids.append(document_id)
+    return ids
+
+
+def set_activity_hashes(data, previous_hashes=None):
+    """
+    Give every activity a hash of its content, including the custom fields and aggregations,
+    so an updated dataset only needs to re-post the activities that changed.
+    The dataset metadata which changes with every version of the dataset is left out of the hash.
+
+    :param data: The activities of the dataset, with their document ids set.
+    :param previous_hashes: An optional dict of the hashes of the indexed activities, per document id.
+    :return: The set of ids of the activities with the same hash as the indexed activity.
+    """
+    if type(data) is not list:
+        data = [data]
+    previous_hashes = previous_hashes or {}
+    unchanged = set()
+    for activity in data:
+        content = {key: value for key, value in activity.items() if key not in VOLATILE_ACTIVITY_FIELDS}
+        content.pop('iati_cloud_activity_hash', None)
+        activity_hash = hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+        activity['iati_cloud_activity_hash'] = activity_hash
+        if previous_hashes.get(activity.get('id')) == activity_hash:
+            unchanged.add(activity['id'])
+    return unchanged
+
+
 def valid_version_from_file(filepath):
     """
     Extract the value of the iati version from the dataset
@@ -0,0 +1,67 @@
+from django.conf import settings
+
+from direct_indexing.processing.util import get_dataset_filesize
+
+DATASET_TASK = 'direct_indexing.metadata.dataset.subtask_process_dataset'
+DATASET_BATCH_TASK = 'direct_indexing.metadata.dataset.subtask_process_datasets'
+
+
+def route_dataset_task(name, args, kwargs, options, task=None, **kw):
+    """
+    Celery router, configured in CELERY_TASK_ROUTES, sending the dataset subtasks to a queue by the
+    size of their dataset file, so small and large datasets can be processed by separate workers.
+    Micro batches of datasets only contain small datasets.
+
+    :param name: The name of the task.
+    :param args: The positional arguments of the task.
+    :param kwargs: The keyword arguments of the task.
+    :param options: The options the task was sent with.
+    :return: The route of the task, or None to leave the routing to the next router.
+    """
+    if not settings.DATASET_QUEUE_ROUTING:
+        return None
+    if name == DATASET_BATCH_TASK:
+        return {'queue': settings.DATASET_SMALL_QUEUE}
+    if name == DATASET_TASK:
+        dataset = kwargs.get('dataset') if kwargs else None
+        if dataset is None and args:
+            dataset = args[0]
+        return {'queue': dataset_queue(dataset)}
+    return None
+
+
+def dataset_queue(dataset):
+    """
+    Retrieve the queue of a dataset, DATASET_LARGE_QUEUE if its file is larger than DATASET_LARGE_BYTES.
+
+    :param dataset: The dataset metadata.
+    :return: The name of the queue.
+    """
+    if dataset and get_dataset_filesize(dataset) > settings.DATASET_LARGE_BYTES:
+        return settings.DATASET_LARGE_QUEUE
+    return settings.DATASET_SMALL_QUEUE
+
+
+def fair_order(submissions):
+    """
+    Interleave the datasets routed to the large queue round-robin across their publishers,
+    keeping the order of the datasets of every publisher, so a publisher with many large datasets
+    does not occupy the large workers while the large datasets of other publishers wait.
+    The datasets routed to the small queue keep their order.
+
+    :param submissions: A list of (dataset, update flag) tuples.
+    :return: The reordered list of submissions.
+    """
+    if not settings.DATASET_QUEUE_ROUTING:
+        return submissions
+    rounds = {}
+    large = []
+    small = []
+    for submission in submissions:
+        if dataset_queue(submission[0]) != settings.DATASET_LARGE_QUEUE:
+            small.append(submission)
+            continue
+        publisher = (submission[0].get('organization') or {}).get('name')
+        rounds[publisher] = rounds.get(publisher, -1) + 1
+        large.append((rounds[publisher], len(large), submission))
+    return [submission for _, _, submission in sorted(large, key=lambda item: item[:2])] + small
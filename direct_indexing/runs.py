@@ -0,0 +1,90 @@
+import logging
+
+from django.utils import timezone
+
+from direct_indexing.models import IndexingRun, RunDataset
+
+
+def start_run(submissions, update=False, shadow=False):
+    """
+    Persist the manifest of a new indexing run, with every dataset it is about to index.
+
+    :param submissions: a list of (dataset, update flag) tuples.
+    :param update: bool to indicate the run only indexes new and changed datasets.
+    :param shadow: bool to indicate the run indexes into the shadow cores.
+    :return: the IndexingRun
+    """
+    run = IndexingRun.objects.create(update=update, shadow=shadow)
+    RunDataset.objects.bulk_create([
+        RunDataset(run=run, dataset_id=dataset['id'], dataset_hash=dataset_hash(dataset), update=update_flag)
+        for dataset, update_flag in submissions
+    ], batch_size=1000)
+    logging.info(f'start_run:: Started indexing run {run.pk} with {len(submissions)} datasets')
+    return run
+
+
+def mark_dataset(run_id, dataset_id, status):
+    """
+    Record the outcome of a dataset in the manifest of its run.
+
+    :param run_id: the id of the IndexingRun, None if the dataset is not part of a tracked run.
+    :param dataset_id: the id of the dataset.
+    :param status: RunDataset.DONE or RunDataset.FAILED.
+    :return: None
+    """
+    if run_id is None:
+        return
+    RunDataset.objects.filter(run_id=run_id, dataset_id=dataset_id).update(status=status, modified=timezone.now())
+
+
+def finish_run(run_id):
+    """
+    Mark an indexing run as finished, so it is no longer resumed.
+
+    :param run_id: the id of the IndexingRun, None if the run was not tracked.
+    :return: None
+    """
+    if run_id is None:
+        return
+    IndexingRun.objects.filter(pk=run_id).update(finished=timezone.now())
+
+
+def unfinished_run():
+    """
+    Retrieve the most recent indexing run, if it did not finish.
+
+    :return: the IndexingRun, or None if the most recent run finished.
+    """
+    run = IndexingRun.objects.order_by('-started').first()
+    if run is None or run.finished is not None:
+        return None
+    return run
+
+
+def unfinished_submissions(run, dataset_metadata):
+    """
+    Retrieve the datasets of a run which were not indexed successfully, from the current dataset metadata.
+    Datasets whose metadata is no longer available are skipped.
+
+    :param run: the IndexingRun to resume.
+    :param dataset_metadata: the list of dataset metadata the run was planned from.
+    :return: a list of (dataset, update flag) tuples.
+    """
+    pending = dict(
+        run.datasets.exclude(status=RunDataset.DONE).values_list('dataset_id', 'update')
+    )
+    submissions = [(dataset, pending[dataset['id']]) for dataset in dataset_metadata if dataset['id'] in pending]
+    logging.info(f'unfinished_submissions:: {len(pending)} datasets of run {run.pk} are unfinished, '
+                 f'{len(submissions)} of them are still available')
+    return submissions
+
+
+def dataset_hash(dataset):
+    """
+    Retrieve the registry hash of a dataset from its metadata.
+
+    :param dataset: the dataset metadata.
+    :return: the hash, or an empty string if it is unknown.
+    """
+    resources = dataset.get('resources') or [{}]
+    return resources[0].get('hash') or ''
@@ -45,7 +45,16 @@ docker cp ./direct_indexing/solr/cores/organisation/managed-schema $solr_contain
 docker cp ./direct_indexing/solr/cores/publisher/managed-schema $solr_container_id:/bitnami/solr/server/solr/publisher/conf/managed-schema.xml
 docker cp ./direct_indexing/solr/cores/result/managed-schema $solr_container_id:/bitnami/solr/server/solr/result/conf/managed-schema.xml
 docker cp ./direct_indexing/solr/cores/transaction/managed-schema $solr_container_id:/bitnami/solr/server/solr/transaction/conf/managed-schema.xml
+# The shadow cores are used for rebuilds, and are swapped with the live cores when a rebuild completes
+docker cp ./direct_indexing/solr/cores/activity/managed-schema $solr_container_id:/bitnami/solr/server/solr/activity_shadow/conf/managed-schema.xml
+docker cp ./direct_indexing/solr/cores/budget/managed-schema $solr_container_id:/bitnami/solr/server/solr/budget_shadow/conf/managed-schema.xml
+docker cp ./direct_indexing/solr/cores/dataset/managed-schema $solr_container_id:/bitnami/solr/server/solr/dataset_shadow/conf/managed-schema.xml
+docker cp ./direct_indexing/solr/cores/organisation/managed-schema $solr_container_id:/bitnami/solr/server/solr/organisation_shadow/conf/managed-schema.xml
+docker cp ./direct_indexing/solr/cores/publisher/managed-schema $solr_container_id:/bitnami/solr/server/solr/publisher_shadow/conf/managed-schema.xml
+docker cp ./direct_indexing/solr/cores/result/managed-schema $solr_container_id:/bitnami/solr/server/solr/result_shadow/conf/managed-schema.xml
+docker cp ./direct_indexing/solr/cores/transaction/managed-schema $solr_container_id:/bitnami/solr/server/solr/transaction_shadow/conf/managed-schema.xml
 docker cp ./direct_indexing/solr/cores/activity/xslt $solr_container_id:/bitnami/solr/server/solr/activity/conf/
+docker cp ./direct_indexing/solr/cores/activity/xslt $solr_container_id:/bitnami/solr/server/solr/activity_shadow/conf/
 
 # Ask the user if this is mounted locally, default to no. If it is, chown the files to 1001:root
 if ask_for_confirmation "Are the files locally mounted (f.ex. on extra mounted volume)?"; then
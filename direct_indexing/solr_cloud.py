@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
+
+import pysolr
+import requests
+from django.conf import settings
+
+from direct_indexing.util import INDEX_SUCCESS, index_documents, solr_error_message, solr_session
+
+_leaders = {}
+_leaders_lock = threading.Lock()
+
+
+def route_key(dataset_metadata):
+    """
+    Retrieve the compositeId routing key of a dataset, the IATI identifier of its publisher,
+    so all documents of a publisher are stored in the same shard.
+
+    :param dataset_metadata: The metadata of the dataset.
+    :return: The routing key, or None if it is unknown or SolrCloud is not used.
+    """
+    if not settings.SOLR_CLOUD or not dataset_metadata:
+        return None
+    key = dataset_metadata.get('dataset.extras.publisher_iati_id') or dataset_metadata.get('dataset.extras.publisher')
+    if not key:
+        return None
+    return str(key).replace('!', '')
+
+
+def murmurhash3_32(data, seed=0):
+    """
+    The 32 bit x86 MurmurHash3, as used by the Solr compositeId router.
+
+    :param data: The bytes to hash
+    :param seed: The seed of the hash
+    :return: The hash as a signed 32 bit integer
+    """
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+    length = len(data)
+    h = seed & 0xffffffff
+    rounded_end = length & ~3
+    for i in range(0, rounded_end, 4):
+        k = int.from_bytes(data[i:i + 4], 'little')
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & 0xffffffff
+        h = (h * 5 + 0xe6546b64) & 0xffffffff
+    k = 0
+    tail = length & 3
+    if tail == 3:
+        k ^= data[rounded_end + 2] << 16
+    if tail >= 2:
+        k ^= data[rounded_end + 1] << 8
+    if tail >= 1:
+        k ^= data[rounded_end]
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+    h ^= length
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return _signed(h)
+
+
+def document_hash(document_id):
+    """
+    Hash a document id the way the Solr compositeId router does.
+    Ids of the form route!id take the upper 16 bits of their hash from the route,
+    ids of the form a!b!id take 8 bits from a, 8 bits from b and 16 bits from the id.
+
+    :param document_id: The id of the document
+    :return: The hash as a signed 32 bit integer
+    """
+    parts = [murmurhash3_32(part.encode('utf-8')) & 0xffffffff for part in document_id.split('!', 2)]
+    if len(parts) == 1:
+        return _signed(parts[0])
+    if len(parts) == 2:
+        return _signed((parts[0] & 0xffff0000) | (parts[1] & 0x0000ffff))
+    return _signed((parts[0] & 0xff000000) | (parts[1] & 0x00ff0000) | (parts[2] & 0x0000ffff))
+
+
+def shard_leaders(collection):
+    """
+    Discover the hash range and leader of every active shard of a collection, with the Collections API.
+    The result is cached per process, call clear_shard_leaders to discover them again.
+
+    :param collection: The name of the collection
+    :return: A list of (range start, range end, leader update url) tuples
+    """
+    with _leaders_lock:
+        if collection in _leaders:
+            return _leaders[collection]
+    try:
+        response = solr_session().get(f'{settings.SOLR_URL}/admin/collections', params={
+            'action': 'CLUSTERSTATUS', 'collection': collection, 'wt': 'json'
+        }, timeout=settings.SOLR_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise pysolr.SolrError(str(e))
+    if not response.ok:
+        raise pysolr.SolrError(solr_error_message(response))
+    shards = response.json()['cluster']['collections'][collection]['shards']
+    leaders = []
+    for shard in shards.values():
+        if shard.get('state') != 'active' or not shard.get('range'):
+            continue
+        leader = next((replica for replica in shard['replicas'].values() if replica.get('leader') == 'true'), None)
+        if leader is None:
+            raise pysolr.SolrError(f'No leader found for a shard of {collection}')
+        start, end = (_signed(int(bound, 16)) for bound in shard['range'].split('-'))
+        leaders.append((start, end, _with_credentials(f"{leader['base_url']}/{leader['core']}/update")))
+    with _leaders_lock:
+        _leaders[collection] = leaders
+    return leaders
+
+
+def clear_shard_leaders():
+    """
+    Forget the discovered shard leaders, f.ex. after a leader election.
+    """
+    with _leaders_lock:
+        _leaders.clear()
+
+
+def index_documents_by_shard(collection, documents, core=None):
+    """
+    Index documents into a SolrCloud collection, with one concurrent writer per shard
+    posting directly to the shard leader. If the shards cannot be discovered,
+    the documents are posted to the collection, which routes them itself.
+
+    :param collection: The name of the collection
+    :param documents: A list of documents with compositeId ids
+    :param core: The name of the core for the write limits, defaults to the collection
+    :return: 'Successfully indexed' or the first error message returned by Solr
+    """
+    try:
+        leaders = shard_leaders(collection)
+    except (pysolr.SolrError, KeyError) as e:
+        logging.warning(f'index_documents_by_shard:: Could not discover the shards of {collection}: {e}')
+        leaders = []
+    if core is None:
+        core = collection
+    if not leaders:
+        return index_documents(f'{settings.SOLR_URL}/{collection}/update', documents, core=core)
+
+    batches = {}
+    for document in documents:
+        doc_hash = document_hash(str(document['id']))
+        url = next((url for start, end, url in leaders if start <= doc_hash <= end), leaders[0][2])
+        batches.setdefault(url, []).append(document)
+
+    with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+        results = list(executor.map(lambda item: index_documents(*item, core=core), batches.items()))
+    errors = [result for result in results if result != INDEX_SUCCESS]
+    if errors:
+        # A leader may have moved, discover the shards again for the next request
+        clear_shard_leaders()
+        return errors[0]
+    return INDEX_SUCCESS
+
+
+def index_file_by_shard(collection, json_path, remove=False, core=None):
+    """
+    Index a json file of documents into a SolrCloud collection, with one writer per shard.
+
+    :param collection: The name of the collection
+    :param json_path: The path to the json file
+    :param remove: bool to indicate the json file should be removed after indexing, defaults to False
+    :param core: The name of the core for the write limits, defaults to the collection
+    :return: 'Successfully indexed' or the error message returned by Solr
+    """
+    with open(json_path) as json_file:
+        documents = json.load(json_file)
+    if remove:
+        os.remove(json_path)
+    if type(documents) is not list:
+        documents = [documents]
+    return index_documents_by_shard(collection, documents, core)
+
+
+def _with_credentials(url):
+    """
+    Add the credentials of SOLR_URL to a url of a Solr node, as the cluster state only holds its host and port.
+
+    :param url: The url of a Solr node
+    :return: The url with the user info of SOLR_URL, if it has any and the url has none
+    """
+    credentials, has_credentials, _ = urlsplit(settings.SOLR_URL).netloc.rpartition('@')
+    parts = urlsplit(url)
+    if not has_credentials or '@' in parts.netloc:
+        return url
+    return urlunsplit(parts._replace(netloc=f'{credentials}@{parts.netloc}'))
+
+
+def _signed(value):
+    """
+    Interpret an unsigned 32 bit integer as a signed 32 bit integer.
+    """
+    return value - 0x100000000 if value & 0x80000000 else value
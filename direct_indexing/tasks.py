@@ -33,23 +33,44 @@ def clear_cores_with_name(core="publisher"):
 
 
 @shared_task
-def start(update=False):
+def start(update=False, rebuild=False, resume=False, ignore_content_hash=False):
+    """
+    Start indexing the IATI data.
+
+    :param update: only index the new and changed datasets, rather than re-indexing everything.
+    :param rebuild: do a full re-index into the shadow cores, which replace the live cores once finished.
+        The live cores keep serving the current data while the rebuild runs.
+    :param resume: resume the last indexing run if it did not finish, only indexing its unfinished datasets.
+        The cores are not cleared and the downloaded data is reused.
+    :param ignore_content_hash: when updating, also index the datasets whose registry hash changed
+        while their file content did not.
+    """
+    if resume:
+        subtask_dataset_metadata.delay(resume=True)
+        logging.info("start:: Resuming the last indexing run.")
+        return "Resuming the last indexing run."
     # Only if the most recent data dump was a success
     if not datadump_success():
         logging.info("start:: The CodeForIATI Data Dump failed, aborting the process!")
         raise ValueError("The CodeForIATI Data Dump failed, aborting the process!")
+    if rebuild:
+        update = False
     # Clear the cores, do not use a task as this needs to finish before continuing
     try:
         if not update:
-            direct_indexing.clear_indices()
+            direct_indexing.clear_indices(shadow=rebuild)
     except pysolr.SolrError:
         # Stop the process and send a message to Celery Flower
         logging.info("start:: Error clearing the direct indexing cores, check your Solr instance.")
         return "Error clearing the direct indexing cores, check your Solr instance."
-    # Run the publisher metadata indexing subtask
-    subtask_publisher_metadata.delay()
+    # Run the publisher metadata indexing subtask,
+    # when rebuilding it must be done before the cores are swapped at the end of the dataset indexing.
+    if rebuild:
+        direct_indexing.run_publisher_metadata(shadow=True)
+    else:
+        subtask_publisher_metadata.delay()
     # Run the dataset metadata indexing subtask
-    subtask_dataset_metadata.delay(update)
+    subtask_dataset_metadata.delay(update, shadow=rebuild, ignore_content_hash=ignore_content_hash)
     # Send clear message to Celery Flower
     logging.info("start:: Both the publisher and dataset metadata indexing have begun.")
     return "Both the publisher and dataset metadata indexing have begun."
@@ -64,9 +85,10 @@ def subtask_publisher_metadata():
 
 
 @shared_task
-def subtask_dataset_metadata(update=False):
+def subtask_dataset_metadata(update=False, shadow=False, resume=False, ignore_content_hash=False):
     logging.info("subtask_dataset_metadata:: Starting dataset metadata indexing.")
-    result = direct_indexing.run_dataset_metadata(update)
+    result = direct_indexing.run_dataset_metadata(update, shadow=shadow, resume=resume,
+                                                  ignore_content_hash=ignore_content_hash)
     logging.info(f"subtask_dataset_metadata:: result: {result}")
     return result
 
@@ -120,8 +142,8 @@ def fcdo_replace_partial_url(find_url, replace_url):
     with open(path, 'w') as file:
         json.dump(dataset_metadata, file, indent=4)
 
-    # run the dataset metadata with update = True and force_update = True
-    # this will automatically all the files that have a new URL and a new HASH
+    # run the dataset metadata with update = True and force_update = True, to use the updated metadata file
+    # this will automatically all the files that have a new URL and a new HASH, as their content changed
     logging.info("fcdo_replace_partial_url:: run the dataset metadata to process the files which have been updated.")
     direct_indexing.run_dataset_metadata(True, force_update=True)
     logging.info(f"fcdo_replace_partial_url:: Finished partial url match and replace, updated {num_updated_datasets} datasets.")  # NOQA
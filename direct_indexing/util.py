@@ -1,12 +1,57 @@
+import json
 import logging
 import os
-import re
-import subprocess
+import tempfile
+import time
 import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import pysolr
+import requests
 from django.conf import settings
 
+from direct_indexing.backpressure import write_slot
+
+INDEX_SUCCESS = 'Successfully indexed'
+
+_session = None
+_upload_executor = None
+
+
+def solr_session():
+    """
+    Retrieve the requests session used for all Solr update requests.
+    The session is created lazily, once per (worker) process, and keeps a pool
+    of keep-alive connections open to Solr.
+
+    :return: the shared requests.Session
+    """
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=settings.SOLR_POOL_SIZE,
+                                                pool_maxsize=settings.SOLR_POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session = session
+    return _session
+
+
+def upload_executor():
+    """
+    Retrieve the thread pool which uploads documents to Solr concurrently.
+    The pool is created lazily, once per (worker) process, and its threads
+    share the pooled connections of the Solr session.
+
+    :return: the shared concurrent.futures.ThreadPoolExecutor
+    """
+    global _upload_executor
+    if _upload_executor is None:
+        _upload_executor = ThreadPoolExecutor(max_workers=settings.SOLR_UPLOAD_THREADS,
+                                              thread_name_prefix='solr-upload')
+    return _upload_executor
+
 
 def clear_core(core_url):
     """
@@ -24,34 +69,480 @@ def clear_core(core_url):
         raise
 
 
-def index_to_core(url, json_path, remove=False):
+def solr_core_name(core, shadow=False):
+    """
+    Retrieve the name of a Solr core, or of the shadow core used to rebuild it.
+
+    :param core: The name of the core
+    :param shadow: bool to indicate the shadow core should be used, defaults to False
+    :return: The name of the core
+    """
+    suffix = settings.SOLR_SHADOW_SUFFIX if shadow else ''
+    return f'{core}{suffix}'
+
+
+def solr_core_url(core, shadow=False):
+    """
+    Retrieve the url of a Solr core, or of the shadow core used to rebuild it.
+
+    :param core: The name of the core
+    :param shadow: bool to indicate the shadow core should be used, defaults to False
+    :return: The url of the core
+    """
+    return f'{settings.SOLR_URL}/{solr_core_name(core, shadow)}'
+
+
+def count_documents(core_url):
+    """
+    Count the documents in a core.
+
+    :param core_url: The url of the core
+    :return: The number of documents
+    """
+    response = solr_session().get(f'{core_url}/select', params={'q': '*:*', 'rows': 0, 'wt': 'json'},
+                                  timeout=settings.SOLR_TIMEOUT)
+    response.raise_for_status()
+    return response.json()['response']['numFound']
+
+
+def _core_admin(action, **params):
+    """
+    Run a CoreAdmin API action.
+
+    :param action: The CoreAdmin action, f.ex. SWAP or UNLOAD
+    :param params: The parameters of the action
+    :return: The JSON response of Solr
+    """
+    try:
+        response = solr_session().get(f'{settings.SOLR_URL}/admin/cores', params={
+            'action': action, 'wt': 'json', **params
+        }, timeout=settings.SOLR_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise pysolr.SolrError(str(e))
+    if not response.ok:
+        raise pysolr.SolrError(solr_error_message(response))
+    return response.json()
+
+
+def swap_cores(core, other):
+    """
+    Atomically swap the names of two cores with the CoreAdmin SWAP action.
+
+    :param core: The name of the first core
+    :param other: The name of the second core
+    :return: None
+    """
+    try:
+        _core_admin('SWAP', core=core, other=other)
+    except pysolr.SolrError:
+        logging.error(f"swap_cores:: Unable to swap core {core} with {other}")
+        raise
+
+
+def reset_core(core):
+    """
+    Empty a core by unloading it together with its index, and creating it again
+    from the configuration in its instance directory. Unlike a *:* delete by query,
+    this does not leave deleted documents behind in the index.
+
+    :param core: The name of the core
+    :return: None
+    """
+    status = _core_admin('STATUS', core=core)['status'].get(core)
+    if not status:
+        raise pysolr.SolrError(f'Core {core} not found')
+    _core_admin('UNLOAD', core=core, deleteIndex='true')
+    try:
+        _core_admin('CREATE', name=core, instanceDir=status['instanceDir'])
+    except pysolr.SolrError:
+        logging.error(f"reset_core:: Unloaded core {core} but could not create it again")
+        raise
+
+
+def commit_core(core_url, soft=False):
+    """
+    Hard commit all pending updates of a core.
+
+    :param core_url: The url of the core to commit
+    :param soft: bool to soft commit the updates instead, making them visible without flushing them to disk
+    :return: None
     """
-    Call the Solr post tool to index the json file into the Solr core.
+    try:
+        core = pysolr.Solr(core_url)
+        core.commit(softCommit=soft)
+    except pysolr.SolrError:
+        logging.error(f"commit_core:: Unable to commit core {core_url}")
+        raise
+
+
+def optimize_core(core_url, max_segments):
+    """
+    Merge the segments of a core down to at most max_segments segments.
+
+    :param core_url: The url of the core to optimize
+    :param max_segments: The maximum number of segments to keep
+    :return: None
+    """
+    try:
+        core = pysolr.Solr(core_url, timeout=settings.SOLR_TIMEOUT)
+        core.optimize(maxSegments=max_segments)
+    except pysolr.SolrError:
+        logging.error(f"optimize_core:: Unable to optimize core {core_url}")
+        raise
+
+
+def warm_core(core_url, queries):
+    """
+    Run queries against a core, to fill its caches after an indexing run.
+    Failing queries are logged, as warming is an optimization only.
+
+    :param core_url: The url of the core
+    :param queries: A list of dicts of select request parameters
+    :return: The number of queries which succeeded
+    """
+    warmed = 0
+    for query in queries:
+        params = {'q': '*:*', 'rows': 0, 'wt': 'json', **query}
+        try:
+            response = solr_session().get(f'{core_url}/select', params=params, timeout=settings.SOLR_TIMEOUT)
+            response.raise_for_status()
+            warmed += 1
+        except requests.exceptions.RequestException as e:
+            logging.warning(f'warm_core:: Warming query {query} failed on {core_url}: {e}')
+    return warmed
+
+
+def commit_params(final=False):
+    """
+    Translate the configured commit policy into update request parameters.
+    The hard and soft policies only commit with the final request of an update,
+    so the requests of a dataset are committed once instead of each on their own.
+
+    :param final: bool to indicate the request completes an update, defaults to False
+    :return: a dict of request parameters
+    """
+    if settings.SOLR_COMMIT_POLICY == 'within':
+        return {'commitWithin': settings.SOLR_COMMIT_WITHIN}
+    if not final or settings.SOLR_COMMIT_POLICY == 'none':
+        return {}
+    if settings.SOLR_COMMIT_POLICY == 'soft':
+        return {'softCommit': 'true'}
+    return {'commit': 'true'}
+
+
+def index_to_core(url, json_path, remove=False, commit=False, core=None):
+    """
+    Stream the json file to the update handler of the Solr core.
 
     :param url: The url of the core to index into
     :param json_path: The path to the json file to index
     :param remove: bool to indicate if the created json file should be removed, defaults to False
+    :param commit: bool to commit the file according to the commit policy, defaults to False
+    :param core: The name of the core for the write limits, see _post
+    :return: 'Successfully indexed' or the error message returned by Solr
     """
     try:
-        solr_out = subprocess.check_output([settings.SOLR_POST_TOOL, '-url', url, json_path],
-                                           stderr=subprocess.STDOUT).decode('utf-8')
-        result = 'Successfully indexed'
-        if 'SolrException' in solr_out or 'Failed to index' in solr_out:
-            message_index = re.search(r'\b(msg)\b', solr_out).start()+5  # +5 to get past the 'msg:'
-            solr_out = solr_out[message_index:]
-            result = solr_out[:re.search(r'\n', solr_out).start()-1]  # stop at newline excluding the ,
-            if remove:
-                os.remove(json_path)
-        else:
-            if remove:
-                os.remove(json_path)  # On success, remove the json file
+        with open(json_path, 'rb') as json_file:
+            result = _post_update(url, json_file, commit_params(commit), core)
+        if remove:
+            os.remove(json_path)
         return result
-    except subprocess.CalledProcessError as e:
+    except requests.exceptions.RequestException as e:
         result = f'Failed to index due to:\n {e}'
         logging.error(f'index_to_core:: error: {result}')
         return result
 
 
+def index_documents(url, documents, commit=False, core=None):
+    """
+    Post a list of documents directly to the update handler of the Solr core,
+    without storing them to disk first.
+
+    :param url: The url of the core to index into
+    :param documents: A list of documents to index
+    :param commit: bool to commit the documents according to the commit policy, defaults to False
+    :param core: The name of the core for the write limits, see _post
+    :return: 'Successfully indexed' or the error message returned by Solr
+    """
+    try:
+        return _post_update(url, json.dumps(documents), commit_params(commit), core)
+    except requests.exceptions.RequestException as e:
+        result = f'Failed to index due to:\n {e}'
+        logging.error(f'index_documents:: error: {result}')
+        return result
+
+
+def index_documents_bisecting(url, documents, core=None, max_rejected=None, error=None):
+    """
+    Post a list of documents to the update handler of the Solr core, isolating invalid documents.
+    When Solr rejects a batch as a bad request, the batch is split in halves which are retried,
+    until every invalid document is rejected on its own and all other documents are indexed.
+    Other errors, such as connection errors, are returned without retrying, as is the error
+    of the document that exceeds max_rejected.
+
+    :param url: The url of the core to index into
+    :param documents: A list of documents to index
+    :param core: The name of the core, reported with the rejected documents and used for the write limits
+    :param max_rejected: The maximum number of documents to reject, defaults to SOLR_MAX_REJECTED_DOCUMENTS
+    :param error: The bad request error of the batch when it was already posted,
+        to start from its halves instead of posting it again
+    :return: a tuple of 'Successfully indexed' or the error message returned by Solr,
+        and a list of the rejected documents as dicts with their core, id and error
+    """
+    if max_rejected is None:
+        max_rejected = settings.SOLR_MAX_REJECTED_DOCUMENTS
+    rejected = []
+    pending = [] if error else [documents]
+    failed = [(documents, error)] if error else []
+    while pending or failed:
+        if failed:
+            batch, error = failed.pop()
+            if len(batch) == 1:
+                if len(rejected) >= max_rejected:
+                    return error, rejected
+                logging.warning(f'index_documents_bisecting:: rejected document {batch[0].get("id")}: {error}')
+                rejected.append({'core': core, 'id': batch[0].get('id'), 'error': error})
+                continue
+            middle = len(batch) // 2
+            pending.extend([batch[middle:], batch[:middle]])
+            continue
+        batch = pending.pop()
+        try:
+            response = _post(url, json.dumps(batch), core=core)
+        except requests.exceptions.RequestException as e:
+            result = f'Failed to index due to:\n {e}'
+            logging.error(f'index_documents_bisecting:: error: {result}')
+            return result, rejected
+        if response.ok:
+            continue
+        if response.status_code != 400:
+            return solr_error_message(response), rejected
+        failed.append((batch, solr_error_message(response)))
+    return INDEX_SUCCESS, rejected
+
+
+def update_fields(url, updates, commit=False):
+    """
+    Patch fields of existing documents with Solr atomic updates, without resending the documents.
+    Every update is a dict with the id of the document and the values of the fields to set.
+    Solr rejects updates of documents that do not exist, instead of creating partial documents.
+
+    :param url: The url of the update handler of the core
+    :param updates: A list of dicts with the id and the fields to set, f.ex. [{'id': 'a', 'field': 'value'}]
+    :param commit: bool to commit the updates according to the commit policy, defaults to False
+    :return: 'Successfully indexed' or the error message returned by Solr
+    """
+    return index_documents(url, [atomic_update(update) for update in updates], commit)
+
+
+def atomic_update(update):
+    """
+    Convert a dict with the id of a document and the values of its fields into a Solr atomic update,
+    which only applies to an existing document.
+
+    :param update: A dict with the id and the fields to set, f.ex. {'id': 'a', 'field': 'value'}
+    :return: The atomic update document
+    """
+    return {'id': update['id'], '_version_': 1,
+            **{field: {'set': value} for field, value in update.items() if field != 'id'}}
+
+
+def delete_datasets(dataset_ids, cores):
+    """
+    Delete the documents of the given datasets from the given cores.
+    The ids are combined into dataset.id:("a" OR "b" ...) queries of at most
+    SOLR_DELETE_BATCH_SIZE ids, and every core is committed once, with its last query.
+
+    :param dataset_ids: The ids of the datasets to delete
+    :param cores: The names of the cores to delete the datasets from
+    :return: None
+    """
+    for core in cores:
+        bodies = [
+            {'delete': {'query': 'dataset.id:(%s)' % ' OR '.join(f'"{dataset_id}"' for dataset_id in chunk)}}
+            for chunk in _chunks(dataset_ids)
+        ]
+        _post_deletes(core, bodies)
+        logging.info(f'delete_datasets:: Deleted {len(dataset_ids)} datasets from {core} core')
+
+
+def delete_documents(core, document_ids, commit=True):
+    """
+    Delete the documents with the given ids from the core, in batches of at most
+    SOLR_DELETE_BATCH_SIZE ids, committing once with the last batch.
+
+    :param core: The name of the core to delete the documents from
+    :param document_ids: The ids of the documents to delete
+    :param commit: bool to commit with the last batch, False when the caller commits the core, defaults to True
+    :return: None
+    """
+    _post_deletes(core, [{'delete': chunk} for chunk in _chunks(list(document_ids))], commit)
+    logging.info(f'delete_documents:: Deleted {len(document_ids)} documents from {core} core')
+
+
+def _chunks(items):
+    return [items[i:i + settings.SOLR_DELETE_BATCH_SIZE] for i in range(0, len(items), settings.SOLR_DELETE_BATCH_SIZE)]
+
+
+def _post_deletes(core, bodies, commit=True):
+    """
+    Post the delete request bodies to the core, committing with the last one.
+
+    :param core: The name of the core
+    :param bodies: A list of JSON delete commands
+    :param commit: bool to commit with the last body, defaults to True
+    :raises pysolr.SolrError: if any of the deletes fails
+    """
+    url = f'{settings.SOLR_URL}/{core}/update'
+    for i, body in enumerate(bodies):
+        params = commit_params(commit and i == len(bodies) - 1)
+        try:
+            result = _post_update(url, json.dumps(body), params)
+        except requests.exceptions.RequestException as e:
+            result = str(e)
+        if result != INDEX_SUCCESS:
+            logging.error(f'_post_deletes:: Unable to delete from {core} core: {result}')
+            raise pysolr.SolrError(result)
+
+
+def iterate_documents(core, query, fields):
+    """
+    Page through all documents in the core matching the query, using cursorMark deep paging.
+    Only a single page of SOLR_PAGE_SIZE documents is held in memory at a time.
+
+    :param core: The name of the core
+    :param query: The Solr query
+    :param fields: The comma separated fields to return
+    :return: a generator of documents
+    """
+    url = f'{settings.SOLR_URL}/{core}/select'
+    cursor_mark = '*'
+    while True:
+        response = solr_session().get(url, params={
+            'q': query,
+            'fl': fields,
+            'rows': settings.SOLR_PAGE_SIZE,
+            'sort': 'id asc',
+            'cursorMark': cursor_mark,
+            'wt': 'json',
+        }, timeout=settings.SOLR_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+        yield from data['response']['docs']
+        if data['nextCursorMark'] == cursor_mark:
+            break
+        cursor_mark = data['nextCursorMark']
+
+
+def _post_update(url, body, params=None, core=None):
+    """
+    Post a JSON body to a Solr update handler, committing according to the commit policy.
+
+    :param url: The url of the update handler
+    :param body: The JSON request body, as a string or an open file
+    :param params: The request parameters, defaults to those of the commit policy for a request that is not final
+    :param core: The name of the core for the write limits, see _post
+    :return: 'Successfully indexed' or the error message returned by Solr, as a BadRequest for a bad request
+        or for an atomic update of a document which does not exist
+    """
+    response = _post(url, body, params, core)
+    if response.ok:
+        return INDEX_SUCCESS
+    if response.status_code in (400, 409):
+        return BadRequest(solr_error_message(response))
+    return solr_error_message(response)
+
+
+def _post(url, body, params=None, core=None):
+    """
+    Post a JSON body to a Solr update handler, within the shared write limit of its core.
+
+    :param url: The url of the update handler
+    :param body: The JSON request body, as a string or an open file
+    :param params: The request parameters, defaults to those of the commit policy for a request that is not final
+    :param core: The name of the core whose write limits apply, as used for its batch sizes.
+        Defaults to the core in the url, pass it for shadow cores and SolrCloud shard replicas,
+        so their writes count against the same limits as the core itself.
+    :return: The requests response
+    """
+    if params is None:
+        params = commit_params()
+    if core is None:
+        core = url.rstrip('/').split('/')[-2]
+    data, headers, size, wire_size = _compress(body)
+    try:
+        with write_slot(core) as record:
+            start = time.time()
+            try:
+                response = solr_session().post(url, data=data, params=params, headers=headers,
+                                               timeout=settings.SOLR_TIMEOUT)
+            except requests.exceptions.RequestException:
+                record(time.time() - start, False)
+                raise
+            duration = time.time() - start
+            record(duration, response.status_code < 500)
+    finally:
+        if data is not body and hasattr(data, 'close'):
+            data.close()
+    logging.debug(f'_post:: {core}: sent {size} bytes as {wire_size} bytes in {duration:.2f}s')
+    return response
+
+
+def _compress(body):
+    """
+    Compress a request body with the SOLR_COMPRESSION encoding, gzip or deflate,
+    if it holds at least SOLR_COMPRESSION_MIN_BYTES. Files are compressed in chunks
+    into a temporary file, so they are never read into memory as a whole.
+    Note that Solr only accepts compressed requests when its Jetty gzip handler inflates them.
+
+    :param body: The JSON request body, as a string or an open binary file
+    :return: a tuple of the body to send, its headers, its size and the size sent, in bytes
+    """
+    headers = {'Content-Type': 'application/json'}
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    size = len(body) if isinstance(body, bytes) else os.fstat(body.fileno()).st_size
+    if settings.SOLR_COMPRESSION not in ('gzip', 'deflate') or size < settings.SOLR_COMPRESSION_MIN_BYTES:
+        return body, headers, size, size
+    # wbits 31 writes a gzip container, 15 the zlib container used by HTTP deflate
+    compressor = zlib.compressobj(settings.SOLR_COMPRESSION_LEVEL, zlib.DEFLATED,
+                                  31 if settings.SOLR_COMPRESSION == 'gzip' else 15)
+    headers['Content-Encoding'] = settings.SOLR_COMPRESSION
+    if isinstance(body, bytes):
+        data = compressor.compress(body) + compressor.flush()
+        return data, headers, size, len(data)
+    data = tempfile.TemporaryFile()
+    for chunk in iter(lambda: body.read(1024 * 1024), b''):
+        data.write(compressor.compress(chunk))
+    data.write(compressor.flush())
+    wire_size = data.tell()
+    data.seek(0)
+    return data, headers, size, wire_size
+
+
+class BadRequest(str):
+    """
+    The error message of an update which Solr rejected as a bad request, because of invalid documents,
+    or as a version conflict, because an atomic update applies to a document which does not exist.
+    Only such updates are bisected to isolate the invalid documents, retrying them cannot help otherwise.
+    """
+
+
+def solr_error_message(response):
+    """
+    Extract the error message from a failed Solr response.
+    Solr reports errors as {"error": {"msg": ..., "code": ...}},
+    if the response is not structured we fall back to the HTTP status.
+
+    :param response: The requests response of the failed request
+    :return: The error message
+    """
+    try:
+        return response.json()['error']['msg']
+    except (ValueError, KeyError, TypeError):
+        return f'Failed to index due to:\n {response.status_code} {response.reason}'
+
+
 def datadump_success():
     """
     Check if the most recent IATI Data dump by CodeForIATI was a success.
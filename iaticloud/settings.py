@@ -10,7 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import json
 import os  # CUSTOM ADDITION FOR .ENV USE
+import tempfile
 from pathlib import Path
 
 from celery.schedules import crontab  # Added for celery scheduled tasks
@@ -140,14 +142,18 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # CELERY #
 CELERY_WORKER_PREFETCH_MULTIPLIER = 1  # limiting the number of reserved tasks.
-CELERY_TASK_ROUTES = {
-    # Here we force specific tasks to flow through specified queues.
-    # This allows us to simultaneously run multiple workers, each with different functions.
-    # N for dataset processing, one for revoking tasks.
-    'direct_indexing.tasks.revoke_all_tasks': {
-        'queue': 'revoke_queue'
+CELERY_TASK_ROUTES = (
+    {
+        # Here we force specific tasks to flow through specified queues.
+        # This allows us to simultaneously run multiple workers, each with different functions.
+        # N for dataset processing, one for revoking tasks.
+        'direct_indexing.tasks.revoke_all_tasks': {
+            'queue': 'revoke_queue'
+        },
     },
-}  # NOQA: E501
+    # Routes the dataset subtasks to the small or large dataset queue, if DATASET_QUEUE_ROUTING is enabled
+    'direct_indexing.routing.route_dataset_task',
+)  # NOQA: E501
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'amqp://localhost')
 CELERY_RESULT_BACKEND = 'django-db'
 CELERY_BEAT_SCHEDULE = {
@@ -187,14 +193,72 @@ SOLR_RESULT = f'{SOLR_URL}/result'
 SOLR_RESULT_URL = f'{SOLR_RESULT}/update'
 SOLR_ORGANISATION = f'{SOLR_URL}/organisation'
 SOLR_ORGANISATION_URL = f'{SOLR_ORGANISATION}/update'
+SOLR_CORES = ['dataset', 'publisher', 'activity', 'transaction', 'budget', 'result', 'organisation']
+# With SolrCloud, the cores are collections using the compositeId router. Documents are routed by their publisher,
+# and posted by one concurrent writer per shard directly to the shard leader.
+SOLR_CLOUD = env_bool('SOLR_CLOUD')
+# Full rebuilds index into shadow cores, named <core><SOLR_SHADOW_SUFFIX>, which are swapped with the live cores
+# once the rebuild is done, provided every shadow core holds at least SOLR_REBUILD_MIN_RATIO of the live documents.
+SOLR_SHADOW_SUFFIX = os.getenv('SOLR_SHADOW_SUFFIX', '_shadow')
+SOLR_REBUILD_MIN_RATIO = float(os.getenv('SOLR_REBUILD_MIN_RATIO', 0.9))
+# How cores are cleared before a full index:
+# - 'delete': delete every document with a *:* delete by query.
+# - 'reset': unload the core with its index and create it again from the configuration in its instance directory,
+#   falling back to 'delete' when the CoreAdmin API is unavailable.
+SOLR_CLEAR_MODE = os.getenv('SOLR_CLEAR_MODE', 'delete')
+# Commit policy for updates sent to Solr during an indexing run:
+# - 'hard': hard commit the cores updated for a dataset once it is indexed, so it is visible as soon as it is done.
+# - 'within': ask Solr to commit within SOLR_COMMIT_WITHIN milliseconds of an update.
+# - 'soft': soft commit the cores updated for a dataset once it is indexed, without flushing segments to disk.
+# A micro batch of datasets commits its cores once for the whole batch, and rebuilds only commit when they finish.
+# - 'none': do not commit updates, they become visible when the run finishes.
+# With 'within', 'soft' and 'none', every core receives a single hard commit when the run finishes.
+SOLR_COMMIT_POLICY = os.getenv('SOLR_COMMIT_POLICY', 'hard')
+SOLR_COMMIT_WITHIN = int(os.getenv('SOLR_COMMIT_WITHIN', 60000))
+# Maintenance when an indexing run finishes: merge every core down to at most this many segments (0 to skip),
+# and run the warming queries, a JSON object of a list of select request parameters per core.
+SOLR_OPTIMIZE_MAX_SEGMENTS = int(os.getenv('SOLR_OPTIMIZE_MAX_SEGMENTS', 0))
+SOLR_WARM_QUERIES = json.loads(os.getenv('SOLR_WARM_QUERIES', '{}'))
+# Number of pooled keep-alive connections to Solr per worker process, and the timeout of a request in seconds
+SOLR_POOL_SIZE = int(os.getenv('SOLR_POOL_SIZE', 10))
+SOLR_TIMEOUT = int(os.getenv('SOLR_TIMEOUT', 600))
+# Maximum number of dataset ids combined into a single delete query
+SOLR_DELETE_BATCH_SIZE = int(os.getenv('SOLR_DELETE_BATCH_SIZE', 500))
+# Number of documents retrieved per page when paging through a core
+SOLR_PAGE_SIZE = int(os.getenv('SOLR_PAGE_SIZE', 10000))
+# Number of transaction, budget or result documents held in memory before they are sent to Solr
+SOLR_SUBTYPE_BATCH_SIZE = int(os.getenv('SOLR_SUBTYPE_BATCH_SIZE', 5000))
+# Number of threads per worker process uploading transaction, budget and result batches, while the activities are
+# posted. This is also the maximum number of subtype batches held in memory while waiting to be uploaded.
+SOLR_UPLOAD_THREADS = int(os.getenv('SOLR_UPLOAD_THREADS', 3))
+# Compress update request bodies of at least SOLR_COMPRESSION_MIN_BYTES with 'gzip' or 'deflate', disabled if empty.
+# Solr only accepts compressed requests when its Jetty gzip handler is set up to inflate them.
+SOLR_COMPRESSION = os.getenv('SOLR_COMPRESSION', '')
+SOLR_COMPRESSION_MIN_BYTES = int(os.getenv('SOLR_COMPRESSION_MIN_BYTES', 32768))
+SOLR_COMPRESSION_LEVEL = int(os.getenv('SOLR_COMPRESSION_LEVEL', 6))
+# When Solr rejects a batch, split it in halves and retry them, until only the invalid documents are rejected
+# The dataset fails as a whole once more than SOLR_MAX_REJECTED_DOCUMENTS of its documents are rejected.
+SOLR_BISECT_FAILED_BATCHES = env_bool('SOLR_BISECT_FAILED_BATCHES', 'True')
+SOLR_MAX_REJECTED_DOCUMENTS = int(os.getenv('SOLR_MAX_REJECTED_DOCUMENTS', 100))
+# Back-pressure for Solr writes: the workers on a host share a limit of in-flight writes per core, with file locks
+# in SOLR_WRITE_LOCK_DIR. The limit, at most SOLR_MAX_CONCURRENT_WRITES, and the subtype batch size grow while
+# writes finish within SOLR_WRITE_TARGET_LATENCY seconds, and are halved when writes fail or are slower.
+SOLR_BACKPRESSURE = env_bool('SOLR_BACKPRESSURE', 'True')
+SOLR_WRITE_LOCK_DIR = os.getenv('SOLR_WRITE_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'iaticloud-solr-writes'))
+SOLR_MAX_CONCURRENT_WRITES = int(os.getenv('SOLR_MAX_CONCURRENT_WRITES', 8))
+SOLR_WRITE_TARGET_LATENCY = float(os.getenv('SOLR_WRITE_TARGET_LATENCY', 10))
 
 # # IATI Data
 METADATA_PUBLISHER_URL = 'https://registry.codeforiati.org/publisher_list.json'
 METADATA_DATASET_URL = 'https://registry.codeforiati.org/dataset_list.json'
 DATASET_URL = 'https://gitlab.com/codeforIATI/iati-data/-/archive/main/iati-data-main.zip'
+# How the datasets are retrieved: 'zip' downloads and unzips the full archive,
+# 'git' keeps a clone of the data repository and only fetches its new commits.
+DATASET_SYNC_MODE = os.getenv('DATASET_SYNC_MODE', 'zip')
+DATASET_GIT_URL = os.getenv('DATASET_GIT_URL', 'https://gitlab.com/codeforIATI/iati-data.git')
+DATASET_GIT_BRANCH = os.getenv('DATASET_GIT_BRANCH', 'main')
 
 # # PATHS
-SOLR_POST_TOOL = os.path.join(BASE_DIR, 'direct_indexing/solr/bin/post')
 DATASET_PARENT_PATH = os.path.join(BASE_DIR, 'direct_indexing/data_sources/datasets')
 DATA_EXTRACTED_PATH = os.path.join(DATASET_PARENT_PATH, 'iati-data-main/data')
 CURRENCIES_JSON = os.path.join(BASE_DIR, 'direct_indexing/data_sources/currency_monthlyaverage.json')
@@ -207,6 +271,27 @@ MONGO_CONNECTION_STRING = os.getenv('MONGO_CONNECTION_STRING', 'localhost:27017'
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = env_bool('DEBUG', 'True')
 THROTTLE_DATASET = env_bool('THROTTLE_DATASET', 'False')
+# Route the dataset subtasks to separate queues by the size of their file, for workers with different memory limits
+DATASET_QUEUE_ROUTING = env_bool('DATASET_QUEUE_ROUTING', 'False')
+DATASET_SMALL_QUEUE = os.getenv('DATASET_SMALL_QUEUE', 'datasets_small')
+DATASET_LARGE_QUEUE = os.getenv('DATASET_LARGE_QUEUE', 'datasets_large')
+DATASET_LARGE_BYTES = int(os.getenv('DATASET_LARGE_BYTES', 20971520))
+# Pack small datasets into micro batches processed by a single task, with one combined Solr post per core.
+# This is also what batches the dataset metadata: without it, every dataset task indexes its own metadata.
+DATASET_MICRO_BATCH = env_bool('DATASET_MICRO_BATCH', 'False')
+DATASET_MICRO_BATCH_SMALL_BYTES = int(os.getenv('DATASET_MICRO_BATCH_SMALL_BYTES', 262144))
+DATASET_MICRO_BATCH_BYTES = int(os.getenv('DATASET_MICRO_BATCH_BYTES', 4194304))
+DATASET_MICRO_BATCH_COUNT = int(os.getenv('DATASET_MICRO_BATCH_COUNT', 25))
+# Number of dataset subtasks processed concurrently by the workers, used to estimate the duration of a run.
+# Celery defaults the concurrency of a worker to the number of CPUs.
+DATASET_WORKER_CONCURRENCY = int(os.getenv('DATASET_WORKER_CONCURRENCY', os.cpu_count() or 1))
+# Re-post only the activities of a changed dataset whose content hash changed, and their subtypes
+ACTIVITY_INCREMENTAL_UPDATE = env_bool('ACTIVITY_INCREMENTAL_UPDATE', 'False')
+# Seconds between checks whether all dataset subtasks of a run have finished
+RUN_FINALIZE_INTERVAL = int(os.getenv('RUN_FINALIZE_INTERVAL', 60))
+# Seconds after dispatching the dataset subtasks of a run after which unfinished subtasks are considered lost,
+# and the run is finalized without them
+RUN_FINALIZE_TIMEOUT = int(os.getenv('RUN_FINALIZE_TIMEOUT', 86400))
 
 # # Fresh dataset
 FRESH = env_bool('FRESH', 'True')
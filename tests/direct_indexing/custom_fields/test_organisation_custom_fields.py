@@ -19,6 +19,10 @@ def test_add_all(mocker):
     add_all(data)
     assert mock.call_count == len(data) + 1  # +1 because of previous tests
 
+    # Test that the dataset metadata is added, apart from the fields the organisation core does not have
+    data = add_all({}, {'dataset.id': 'ds', 'dataset.extras.validation_status': 'Valid'})
+    assert data == [{'dataset.id': 'ds'}]
+
 
 def test_index_many_to_many_relations(mocker):
     # Test that nothing changes if total-expenditure is not present
@@ -1,10 +1,15 @@
+from datetime import datetime, timezone
+
 import pytest
 import requests
+from celery.exceptions import Retry
 
 from direct_indexing.metadata.dataset import (
-    DatasetException, _get_existing_datasets, index_datasets_and_dataset_metadata, load_codelists, prepare_update,
-    subtask_process_dataset
+    DatasetException, estimate_makespan, finalize_run, index_datasets_and_dataset_metadata, load_codelists,
+    micro_batches, order_by_cost, prepare_update, report_makespan, run_summary, subtask_finalize_run,
+    subtask_process_dataset, subtask_process_datasets, swap_shadow_cores, track_run
 )
+from direct_indexing.processing.util import get_file_hash
 
 
 def test_dataset_exception():
@@ -21,13 +26,16 @@ def test_subtask_process_dataset(mocker, fixture_dataset):
     res_str = 'Successfully indexed'
     fun_path = "direct_indexing.metadata.dataset.dataset_processing.fun"
     mocker.patch(fun_path, return_value=(res_str, res_str))
-    res = subtask_process_dataset(None, False)
+    mock_mark = mocker.patch('direct_indexing.metadata.dataset.runs.mark_dataset')
+    res = subtask_process_dataset(fixture_dataset, False, run_id=1)
     assert res == res_str
+    # The outcome of the dataset is recorded in the manifest of its run
+    mock_mark.assert_called_once_with(1, fixture_dataset['id'], 'done')
 
     # Test Dataset invalid
     res_str_dataset = 'Dataset invalid'
     mocker.patch(fun_path, return_value=(res_str_dataset, res_str))
-    res = subtask_process_dataset(None, False)
+    res = subtask_process_dataset(fixture_dataset, False)
     assert res == res_str_dataset
 
     # Test DatasetException
@@ -36,6 +44,64 @@ def test_subtask_process_dataset(mocker, fixture_dataset):
     with pytest.raises(DatasetException) as excinfo:
         subtask_process_dataset(fixture_dataset, False)
     assert str(excinfo.value) == f'Error indexing dataset {fixture_dataset["id"]}\nDataset metadata:\n{res_str}\nDataset indexing:\n{str(res_str_err)}'  # NOQA
+    assert mock_mark.call_args[0][2] == 'failed'
+
+    # Test an unexpected error marks the dataset as not indexed, and is raised
+    mock_status = mocker.patch('direct_indexing.metadata.dataset.update_dataset_status')
+    mocker.patch(fun_path, side_effect=KeyError('test'))
+    with pytest.raises(KeyError):
+        subtask_process_dataset(fixture_dataset, True)
+    mock_status.assert_called_once()
+    assert mock_status.call_args[0] == (fixture_dataset['id'], False)
+    assert mock_status.call_args[1]['iati_cloud_indexed'] is False
+
+
+def test_subtask_process_datasets(mocker):
+    res_str = 'Successfully indexed'
+    fun_path = 'direct_indexing.metadata.dataset.dataset_processing.fun_batch'
+    datasets = [({'id': 'ds1'}, False), ({'id': 'ds2'}, True)]
+    mock_fun = mocker.patch(fun_path, return_value=[(res_str, res_str), ('Dataset invalid', res_str)])
+    assert subtask_process_datasets(datasets) == res_str
+    mock_fun.assert_called_once_with(datasets, False)
+
+    # Test that the failed datasets are reported
+    mock_fun.return_value = [(res_str, res_str), ('Failed to index', res_str)]
+    mock_mark = mocker.patch('direct_indexing.metadata.dataset.runs.mark_dataset')
+    with pytest.raises(DatasetException) as excinfo:
+        subtask_process_datasets(datasets, run_id=1)
+    assert str(excinfo.value).startswith('Error indexing 1 of 2 datasets\nds2')
+    # The outcome of every dataset is recorded in the manifest of the run
+    assert mock_mark.call_args_list == [mocker.call(1, 'ds1', 'done'), mocker.call(1, 'ds2', 'failed')]
+
+    # Test an unexpected error marks every dataset of the batch as not indexed, and is raised
+    mock_status = mocker.patch('direct_indexing.metadata.dataset.update_dataset_status')
+    mocker.patch(fun_path, side_effect=KeyError('test'))
+    with pytest.raises(KeyError):
+        subtask_process_datasets(datasets, True)
+    assert mock_status.call_count == 2
+    assert mock_status.call_args[0] == ('ds2', True)
+
+
+def test_micro_batches(mocker):
+    sizes = {'large': 1000, 'a': 10, 'b': 20, 'c': 30, 'd': 10}
+    mocker.patch('direct_indexing.metadata.dataset.get_dataset_filesize',
+                 side_effect=lambda dataset: sizes[dataset['id']])
+    submissions = [({'id': dataset_id}, False) for dataset_id in sizes]
+    mocker.patch('direct_indexing.metadata.dataset.settings.DATASET_MICRO_BATCH', False)
+    assert micro_batches(submissions) == [[submission] for submission in submissions]
+
+    mocker.patch('direct_indexing.metadata.dataset.settings.DATASET_MICRO_BATCH', True)
+    mocker.patch('direct_indexing.metadata.dataset.settings.DATASET_MICRO_BATCH_SMALL_BYTES', 100)
+    mocker.patch('direct_indexing.metadata.dataset.settings.DATASET_MICRO_BATCH_BYTES', 40)
+    mocker.patch('direct_indexing.metadata.dataset.settings.DATASET_MICRO_BATCH_COUNT', 3)
+    # Large datasets are submitted on their own, small ones are packed up to the byte budget
+    batches = micro_batches(submissions)
+    assert [[dataset['id'] for dataset, _ in batch] for batch in batches] == [['large'], ['a', 'b'], ['c', 'd']]
+    # And up to the count budget
+    mocker.patch('direct_indexing.metadata.dataset.settings.DATASET_MICRO_BATCH_BYTES', 1000)
+    mocker.patch('direct_indexing.metadata.dataset.settings.DATASET_MICRO_BATCH_COUNT', 2)
+    batches = micro_batches(submissions)
+    assert [[dataset['id'] for dataset, _ in batch] for batch in batches] == [['large'], ['a', 'b'], ['c', 'd']]
 
 
 def test_index_datasets_and_dataset_metadata(mocker, fixture_datasets):
@@ -48,6 +114,11 @@ def test_index_datasets_and_dataset_metadata(mocker, fixture_datasets):
     mock_load_cl = mocker.patch('direct_indexing.metadata.dataset.load_codelists')
     mock_subtask = mocker.patch(subtask_path)
     mock_prep = mocker.patch('direct_indexing.metadata.dataset.prepare_update', return_value=(fixture_datasets, [True, False, True]))  # NOQA
+    mock_track = mocker.patch('direct_indexing.metadata.dataset.track_run')
+    mock_order = mocker.patch('direct_indexing.metadata.dataset.order_by_cost',
+                              side_effect=lambda submissions: (submissions, 42))
+    mock_start_run = mocker.patch('direct_indexing.metadata.dataset.runs.start_run')
+    mock_start_run.return_value.pk = 1
 
     # run index_datasets_and_dataset_metadata
     res = index_datasets_and_dataset_metadata(False, False)
@@ -58,15 +129,45 @@ def test_index_datasets_and_dataset_metadata(mocker, fixture_datasets):
     mock_load_cl.assert_called_once()
     assert mock_subtask.call_count == len(fixture_datasets)
     mock_prep.assert_not_called()
+    mock_order.assert_called_once()
+    # Assert the manifest of the run is saved before the datasets are dispatched
+    mock_start_run.assert_called_once_with([(dataset, False) for dataset in fixture_datasets], False, False)
+    # Assert the run is tracked with the results of every subtask
+    mock_track.assert_called_once_with([mock_subtask.return_value] * len(fixture_datasets), False, mocker.ANY, 42, 1)
 
     # Test with update = True, and only the first dataset is to be updated
     # Reset subtask mock
     mock_subtask = mocker.patch(subtask_path)
     index_datasets_and_dataset_metadata(True, False)
-    mock_prep.assert_called_once()
+    # Assert the changed files of the synced data repository are passed to the planner
+    mock_prep.assert_called_once_with(fixture_datasets, False, mock_download.return_value)
+    # Assert the pre-downloaded metadata does not switch off the content hash check, ignoring it does
+    mock_prep.reset_mock()
+    index_datasets_and_dataset_metadata(True, True)
+    mock_prep.assert_called_once_with(fixture_datasets, False, mock_download.return_value)
+    mock_prep.reset_mock()
+    index_datasets_and_dataset_metadata(True, False, ignore_content_hash=True)
+    mock_prep.assert_called_once_with(fixture_datasets, True, mock_download.return_value)
     # Assert the subtask was triggered once with update True and once with update False
-    mock_subtask.assert_any_call(dataset=fixture_datasets[0], update=True)
-    mock_subtask.assert_any_call(dataset=fixture_datasets[1], update=False)
+    mock_subtask.assert_any_call(dataset=fixture_datasets[0], update=True, shadow=False, run_id=1)
+    mock_subtask.assert_any_call(dataset=fixture_datasets[1], update=False, shadow=False, run_id=1)
+
+    # Test that a rebuild indexes the datasets into the shadow cores
+    mock_subtask = mocker.patch(subtask_path)
+    index_datasets_and_dataset_metadata(False, False, shadow=True)
+    mock_subtask.assert_any_call(dataset=fixture_datasets[0], update=False, shadow=True, run_id=1)
+
+    # Test that micro batches of datasets are submitted to the batch task
+    mock_batch = mocker.patch('direct_indexing.metadata.dataset.subtask_process_datasets.delay')
+    mocker.patch('direct_indexing.metadata.dataset.micro_batches',
+                 side_effect=lambda submissions: [submissions[:1], submissions[1:]])
+    mock_subtask = mocker.patch(subtask_path)
+    index_datasets_and_dataset_metadata(False, False)
+    mock_subtask.assert_called_once_with(dataset=fixture_datasets[0], update=False, shadow=False, run_id=1)
+    mock_batch.assert_called_once_with(datasets=[(dataset, False) for dataset in fixture_datasets[1:]], shadow=False,
+                                       run_id=1)
+    mocker.patch('direct_indexing.metadata.dataset.micro_batches',
+                 side_effect=lambda submissions: [[submission] for submission in submissions])
 
     # Test throttle dataset
     # Mock settings.THROTTLE_DATASET to True
@@ -77,6 +178,218 @@ def test_index_datasets_and_dataset_metadata(mocker, fixture_datasets):
     # Assert the subtask was called once times
     mock_subtask.assert_called_once()
 
+    # Test that resuming without an unfinished run does nothing
+    mock_unfinished = mocker.patch('direct_indexing.metadata.dataset.runs.unfinished_run', return_value=None)
+    mock_download.reset_mock()
+    assert index_datasets_and_dataset_metadata(False, False, resume=True) == '- No unfinished indexing run to resume'
+    mock_download.assert_not_called()
+
+    # Test that resuming dispatches the unfinished datasets of the last run, with its shadow flag
+    mock_unfinished.return_value = mocker.MagicMock(shadow=True, pk=2)
+    mocker.patch('direct_indexing.metadata.dataset.runs.unfinished_submissions',
+                 return_value=[(fixture_datasets[1], True)])
+    mock_start_run.reset_mock()
+    mock_subtask = mocker.patch(subtask_path)
+    index_datasets_and_dataset_metadata(False, False, resume=True)
+    mock_download.assert_called_once_with(resume=True)
+    assert mock_retrieve.call_args[0][2] is True
+    mock_start_run.assert_not_called()
+    mock_subtask.assert_called_once_with(dataset=fixture_datasets[1], update=True, shadow=True, run_id=2)
+
+
+def test_track_run(mocker):
+    mock_group = mocker.patch('direct_indexing.metadata.dataset.GroupResult')
+    mock_finalize = mocker.patch('direct_indexing.metadata.dataset.subtask_finalize_run.apply_async')
+    track_run(['res'])
+    # Assert the group of subtasks is saved and the finalize task is started for it
+    assert mock_group.call_args[0][1] == ['res']
+    mock_group.return_value.save.assert_called_once()
+    mock_finalize.assert_called_once()
+    assert mock_finalize.call_args[1]['args'] == [mock_group.return_value.id, False]
+    assert mock_finalize.call_args[1]['kwargs'] == {'started': None, 'estimated_makespan': None, 'run_id': None}
+
+    track_run(['res'], True, 100, 42, 7)
+    assert mock_finalize.call_args[1]['kwargs'] == {'started': 100, 'estimated_makespan': 42, 'run_id': 7}
+
+
+def test_order_by_cost(mocker):
+    submissions = [({'id': 'small'}, False), ({'id': 'large'}, False), ({'id': 'known'}, True)]
+    sizes = {'small': 100, 'large': 1000, 'known': 500}
+    mocker.patch('direct_indexing.metadata.dataset.get_dataset_filesize',
+                 side_effect=lambda dataset: sizes[dataset['id']])
+    mocker.patch('direct_indexing.metadata.dataset.settings.DATASET_WORKER_CONCURRENCY', 2)
+    mock_seed = mocker.patch('direct_indexing.metadata.dataset.ledger.ensure_seeded')
+    mock_times = mocker.patch('direct_indexing.metadata.dataset.ledger.processing_times', return_value={})
+
+    # Without previous processing times, the datasets are ordered by size and the makespan is unknown
+    ordered, makespan = order_by_cost(submissions)
+    assert [dataset['id'] for dataset, _ in ordered] == ['large', 'known', 'small']
+    assert makespan is None
+    # The processing times are read from the dataset ledger, once it is seeded
+    mock_seed.assert_called_once()
+
+    # A known processing time calibrates the cost of the other datasets, 0.1 seconds per byte
+    mock_times.return_value = {'known': 50}
+    ordered, makespan = order_by_cost(submissions)
+    assert [dataset['id'] for dataset, _ in ordered] == ['large', 'known', 'small']
+    assert ordered[1] == ({'id': 'known'}, True)
+    assert makespan == 100
+
+    # The previous processing time takes precedence over the file size
+    mock_times.return_value = {'known': 50, 'small': 60}
+    ordered, makespan = order_by_cost(submissions)
+    assert [dataset['id'] for dataset, _ in ordered] == ['large', 'small', 'known']
+
+
+def test_estimate_makespan():
+    assert estimate_makespan([], 2) == 0
+    assert estimate_makespan([5, 4, 3, 3], 2) == 8
+    # Largest first balances the workers better than smallest first
+    assert estimate_makespan([4, 1, 1, 1, 1], 2) == 4
+    assert estimate_makespan([1, 1, 1, 1, 4], 2) == 6
+    assert estimate_makespan([5, 4], 0) == 9
+
+
+def test_report_makespan(mocker):
+    group_result = mocker.MagicMock()
+    done = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    group_result.results = [mocker.MagicMock(date_done=done), mocker.MagicMock(date_done=None)]
+    started = done.timestamp() - 90
+    assert report_makespan(group_result, started, 60.4) == '- Makespan: estimated 60s, actual 90s'
+    assert report_makespan(group_result, started) == '- Makespan: estimated unknown, actual 90s'
+    group_result.results = []
+    assert report_makespan(group_result, started) == '- Makespan: estimated unknown, actual unknown'
+
+
+def test_subtask_finalize_run(mocker):
+    mock_restore = mocker.patch('direct_indexing.metadata.dataset.GroupResult.restore')
+    mock_finalize = mocker.patch('direct_indexing.metadata.dataset.finalize_run', return_value='finalized')
+    # Test that the task retries as long as the group is not ready
+    mock_restore.return_value.ready.return_value = False
+    mock_retry = mocker.patch('direct_indexing.metadata.dataset.subtask_finalize_run.retry', side_effect=Retry)
+    with pytest.raises(Retry):
+        subtask_finalize_run('group_id')
+    mock_retry.assert_called_once()
+    mock_finalize.assert_not_called()
+
+    # Test that the run is finalized and summarized once the group is ready
+    mock_restore.return_value.ready.return_value = True
+    mock_summary = mocker.patch('direct_indexing.metadata.dataset.run_summary', return_value='summary')
+    assert subtask_finalize_run('group_id') == 'finalized\nsummary'
+    mock_finalize.assert_called_once()
+    mock_summary.assert_called_once_with(mock_restore.return_value)
+
+    # Test that the makespan is reported when the dispatch time is known
+    mocker.patch('direct_indexing.metadata.dataset.report_makespan', return_value='makespan')
+    assert subtask_finalize_run('group_id', False, 100, 42) == 'finalized\nsummary\nmakespan'
+
+    # Test that the run is marked finished in its manifest
+    mock_finish = mocker.patch('direct_indexing.metadata.dataset.runs.finish_run')
+    subtask_finalize_run('group_id', run_id=3)
+    mock_finish.assert_called_once_with(3)
+
+    # Test that subtasks which did not finish in time are considered lost, finalizing the run without finishing it
+    mock_finalize.reset_mock()
+    mock_finish.reset_mock()
+    mock_restore.return_value.ready.return_value = False
+    mocker.patch('direct_indexing.metadata.dataset.settings.RUN_FINALIZE_TIMEOUT', 3600)
+    mocker.patch('direct_indexing.metadata.dataset.time.time', return_value=100 + 1800)
+    with pytest.raises(Retry):
+        subtask_finalize_run('group_id', False, 100, 42, run_id=3)
+    mock_finalize.assert_not_called()
+    mocker.patch('direct_indexing.metadata.dataset.time.time', return_value=100 + 3600)
+    assert subtask_finalize_run('group_id', False, 100, 42, run_id=3) == 'finalized\nsummary\nmakespan'
+    mock_finalize.assert_called_once()
+    mock_finish.assert_not_called()
+
+    # Test that a run without a saved group is finalized without a summary
+    mock_restore.return_value = None
+    assert subtask_finalize_run('group_id') == 'finalized'
+
+
+def test_run_summary(mocker):
+    group_result = mocker.MagicMock()
+    succeeded = mocker.MagicMock(**{'successful.return_value': True, 'failed.return_value': False})
+    failed = mocker.MagicMock(**{'successful.return_value': False, 'failed.return_value': True})
+    group_result.results = [succeeded, succeeded, failed]
+    mocker.patch('direct_indexing.metadata.dataset.settings.SOLR_CORES', ['activity', 'budget'])
+    mocker.patch('direct_indexing.metadata.dataset.count_documents',
+                 side_effect=[10, requests.exceptions.ConnectionError('down')])
+    res = run_summary(group_result)
+    # Cores which cannot be counted are left out of the summary
+    assert res == '- Dataset subtasks: 2 succeeded, 1 failed, of 3\n- activity: 10 documents'
+
+    # Subtasks which did not finish are reported
+    lost = mocker.MagicMock(**{'successful.return_value': False, 'failed.return_value': False,
+                               'ready.return_value': False})
+    group_result.results = [succeeded, lost]
+    mocker.patch('direct_indexing.metadata.dataset.count_documents', return_value=10)
+    assert run_summary(group_result).startswith(
+        '- Dataset subtasks: 1 succeeded, 0 failed, of 2, 1 did not finish and are considered failed\n')
+
+
+def test_finalize_run(mocker):
+    mock_commit = mocker.patch('direct_indexing.metadata.dataset.commit_core')
+    # Test that with the hard commit policy, nothing is committed at the end of the run
+    mocker.patch('direct_indexing.metadata.dataset.settings.SOLR_COMMIT_POLICY', 'hard')
+    assert finalize_run() == '- Indexing run finalized'
+    mock_commit.assert_not_called()
+
+    # Test that with other policies, every core is committed once
+    mocker.patch('direct_indexing.metadata.dataset.settings.SOLR_COMMIT_POLICY', 'within')
+    finalize_run()
+    assert mock_commit.call_count == 7
+
+    # Test that after a rebuild, the shadow cores are committed and swapped in
+    mocker.patch('direct_indexing.metadata.dataset.settings.SOLR_COMMIT_POLICY', 'hard')
+    mock_swap = mocker.patch('direct_indexing.metadata.dataset.swap_shadow_cores', return_value='- Rebuild swapped in')
+    mock_reseed = mocker.patch('direct_indexing.metadata.dataset.ledger.reseed')
+    assert finalize_run(shadow=True) == '- Rebuild swapped in'
+    assert mock_commit.call_count == 14
+    assert mock_commit.call_args[0][0].endswith('_shadow')
+    mock_swap.assert_called_once()
+    # The datasets of the rebuild are recorded in the ledger once it is swapped in, and not when it is refused
+    mock_reseed.assert_called_once()
+    mock_swap.return_value = '- Rebuild not swapped in'
+    finalize_run(shadow=True)
+    mock_reseed.assert_called_once()
+    # A ledger which cannot be replaced does not fail the swapped in rebuild
+    mock_swap.return_value = '- Rebuild swapped in'
+    mock_reseed.side_effect = requests.exceptions.ConnectionError
+    assert finalize_run(shadow=True) == '- Rebuild swapped in'
+
+    # Test the optional merging and warming of the cores
+    mock_optimize = mocker.patch('direct_indexing.metadata.dataset.optimize_core')
+    mock_warm = mocker.patch('direct_indexing.metadata.dataset.warm_core')
+    mocker.patch('direct_indexing.metadata.dataset.settings.SOLR_OPTIMIZE_MAX_SEGMENTS', 0)
+    mocker.patch('direct_indexing.metadata.dataset.settings.SOLR_WARM_QUERIES', {})
+    finalize_run()
+    mock_optimize.assert_not_called()
+    mock_warm.assert_not_called()
+    mocker.patch('direct_indexing.metadata.dataset.settings.SOLR_OPTIMIZE_MAX_SEGMENTS', 4)
+    mocker.patch('direct_indexing.metadata.dataset.settings.SOLR_WARM_QUERIES',
+                 {'activity': [{'q': 'iati-identifier:*'}]})
+    finalize_run()
+    assert mock_optimize.call_count == 7
+    assert mock_optimize.call_args[0][1] == 4
+    mock_warm.assert_called_once_with(mocker.ANY, [{'q': 'iati-identifier:*'}])
+    assert mock_warm.call_args[0][0].endswith('/activity')
+
+
+def test_swap_shadow_cores(mocker):
+    mock_swap = mocker.patch('direct_indexing.metadata.dataset.swap_cores')
+    mocker.patch('direct_indexing.metadata.dataset.settings.SOLR_REBUILD_MIN_RATIO', 0.9)
+    # Test that the cores are not swapped if a shadow core has too few documents
+    mocker.patch('direct_indexing.metadata.dataset.count_documents', side_effect=[100, 89])
+    assert 'Rebuild not swapped in' in swap_shadow_cores()
+    mock_swap.assert_not_called()
+
+    # Test that every core is swapped with its shadow core if the counts are acceptable
+    mocker.patch('direct_indexing.metadata.dataset.count_documents', side_effect=[100, 95] * 7)
+    assert swap_shadow_cores() == '- Rebuild swapped in'
+    assert mock_swap.call_count == 7
+    mock_swap.assert_any_call('activity', 'activity_shadow')
+
 
 def test_load_codelists(mocker):
     # Integration
@@ -91,26 +404,18 @@ def test_load_codelists(mocker):
         load_codelists()
 
 
-def test__get_existing_datasets(mocker, requests_mock, fixture_solr_dataset, fixture_existing_datasets):
-    mocker.patch('direct_indexing.metadata.dataset.settings.SOLR_DATASET', "https://test.com")
-    requests_mock.get("https://test.com" + (
-        '/select?q=resources.hash:* AND extras.filetype:*'
-        ' AND id:*&rows=100000&wt=json&fl=resources.hash,id,extras.filetype'
-    ), json=fixture_solr_dataset)
-    res = _get_existing_datasets()
-    # Expected res is a dict with the id as key and a dict with hash and filetype as value
-    assert res == fixture_existing_datasets
-
-
 def test_prepare_update(mocker, fixture_existing_datasets, fixture_datasets):
     # add a changed dataset to fixture_existing_datasets
     fixture_existing_datasets["id_test_2"] = {
         "hash": "changed",
         "filetype": "activity"
     }
-    mocker.patch('direct_indexing.metadata.dataset._get_existing_datasets', return_value=fixture_existing_datasets)
+    mock_seed = mocker.patch('direct_indexing.metadata.dataset.ledger.ensure_seeded')
+    mocker.patch('direct_indexing.metadata.dataset.ledger.existing_datasets', return_value=fixture_existing_datasets)
     # run prepare_update
     ds, bools = prepare_update(fixture_datasets)
+    # the indexed datasets are read from the dataset ledger, once it is seeded
+    mock_seed.assert_called_once()
 
     # we provide 3 datasets, one new, one existing with a matching hash, and one existing with a changed hash
     # therefore, we expect 2 datasets to be returned, one with update=False and a second with update=True
@@ -120,6 +425,72 @@ def test_prepare_update(mocker, fixture_existing_datasets, fixture_datasets):
     assert ds[0]["id"] == "id_test_1"
     assert ds[1]["id"] == "id_test_2"
 
+    # A dataset marked to be indexed again is updated, although its hash did not change
+    fixture_existing_datasets['f783cb92-7039-44a8-b0ad-f6438566a6fa']['reindex'] = True
+    ds, bools = prepare_update(fixture_datasets)
+    assert [d['id'] for d in ds] == ['id_test_1', 'f783cb92-7039-44a8-b0ad-f6438566a6fa', 'id_test_2']
+    assert bools == [False, True, True]
+
+
+def test_prepare_update_unchanged_content(mocker, tmp_path, fixture_existing_datasets, fixture_datasets):
+    file_path = tmp_path / 'ds.xml'
+    file_path.write_text('<iati-activities/>')
+    content_hash = get_file_hash(str(file_path))
+    mocker.patch('direct_indexing.metadata.dataset.get_dataset_filepath', return_value=str(file_path))
+    mock_update_hashes = mocker.patch('direct_indexing.metadata.dataset.ledger.update_registry_hashes')
+    fixture_existing_datasets['id_test_1'] = {'hash': 'old', 'filetype': 'activity', 'content_hash': content_hash}
+    fixture_existing_datasets['id_test_2'] = {'hash': 'old', 'filetype': 'activity', 'content_hash': 'other'}
+    mocker.patch('direct_indexing.metadata.dataset.ledger.ensure_seeded')
+    mocker.patch('direct_indexing.metadata.dataset.ledger.existing_datasets', return_value=fixture_existing_datasets)
+
+    # A changed registry hash with an unchanged file is skipped, and its new registry hash recorded
+    ds, bools = prepare_update(fixture_datasets)
+    assert [d['id'] for d in ds] == ['id_test_2']
+    assert bools == [True]
+    mock_update_hashes.assert_called_once_with({'id_test_1': 'cc612755d0b822bb9af82f43e121428634be255a'})
+
+    # Ignoring the content hash indexes every dataset with a changed registry hash
+    ds, bools = prepare_update(fixture_datasets, ignore_content_hash=True)
+    assert [d['id'] for d in ds] == ['id_test_1', 'id_test_2']
+
+
+def test_prepare_update_changed_files(mocker, fixture_existing_datasets, fixture_datasets):
+    mocker.patch('direct_indexing.metadata.dataset.get_dataset_filepath',
+                 side_effect=lambda dataset: f'/data/{dataset["id"]}.xml')
+    mock_hash = mocker.patch('direct_indexing.metadata.dataset.get_file_hash', return_value='c')
+    mock_update_hashes = mocker.patch('direct_indexing.metadata.dataset.ledger.update_registry_hashes')
+    fixture_existing_datasets['id_test_1'] = {'hash': 'old', 'filetype': 'activity', 'content_hash': 'c'}
+    fixture_existing_datasets['id_test_2'] = {'hash': 'old', 'filetype': 'activity', 'content_hash': 'c'}
+    mocker.patch('direct_indexing.metadata.dataset.ledger.ensure_seeded')
+    mocker.patch('direct_indexing.metadata.dataset.ledger.existing_datasets', return_value=fixture_existing_datasets)
+    changed_files = {'added': [], 'modified': ['/data/./f783cb92-7039-44a8-b0ad-f6438566a6fa.xml'],
+                     'removed': ['/data/id_test_2.xml']}
+
+    # The changed files decide which datasets changed, also when their registry hash did not change
+    ds, bools = prepare_update(fixture_datasets, changed_files=changed_files)
+    assert [d['id'] for d in ds] == ['f783cb92-7039-44a8-b0ad-f6438566a6fa', 'id_test_2']
+    assert bools == [True, True]
+    # Only the dataset with a changed registry hash whose file is not in the changes is hashed
+    mock_hash.assert_called_once_with('/data/id_test_1.xml')
+    mock_update_hashes.assert_called_once_with({'id_test_1': 'cc612755d0b822bb9af82f43e121428634be255a'})
+
+    # Ignoring the content hash also indexes the datasets with a changed registry hash
+    mock_hash.reset_mock()
+    ds, _ = prepare_update(fixture_datasets, True, changed_files)
+    assert [d['id'] for d in ds] == ['id_test_1', 'f783cb92-7039-44a8-b0ad-f6438566a6fa', 'id_test_2']
+    mock_hash.assert_not_called()
+
+    # A file which changed in an earlier sync, but was not indexed since, is selected by its content hash
+    mock_hash.return_value = 'new'
+    ds, _ = prepare_update(fixture_datasets, changed_files={'added': [], 'modified': [], 'removed': []})
+    assert [d['id'] for d in ds] == ['id_test_1', 'id_test_2']
+
+    # A dataset with a changed registry hash which was not indexed successfully is retried
+    mock_hash.return_value = 'c'
+    fixture_existing_datasets['id_test_1']['content_hash'] = ''
+    ds, _ = prepare_update(fixture_datasets, changed_files={'added': [], 'modified': [], 'removed': []})
+    assert [d['id'] for d in ds] == ['id_test_1']
+
 
 @pytest.fixture
 def fixture_dataset():
@@ -152,39 +523,12 @@ def fixture_datasets():
     ]
 
 
-@pytest.fixture
-def fixture_solr_dataset():
-    return {
-        "responseHeader": {
-            "status": 0,
-            "QTime": 1,
-            "params": {
-                "q": "*:*",
-                "rows": "1"
-            }
-        },
-        "response": {
-            "numFound": 10740,
-            "start": 0,
-            "numFoundExact": True,
-            "docs": [
-                {
-                    "id": "f783cb92-7039-44a8-b0ad-f6438566a6fa",
-                    "resources.hash": [
-                        "cc612755d0b822bb9af82f43e121428634be255a"
-                    ],
-                    "extras.filetype": "activity",
-                }
-            ]
-        }
-    }
-
-
 @pytest.fixture
 def fixture_existing_datasets():
     return {
         "f783cb92-7039-44a8-b0ad-f6438566a6fa": {
             "hash": "cc612755d0b822bb9af82f43e121428634be255a",
-            "filetype": "activity"
+            "filetype": "activity",
+            "content_hash": ""
         },
     }
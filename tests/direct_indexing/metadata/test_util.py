@@ -1,11 +1,14 @@
 import json
-import urllib
+import subprocess
 import zipfile
 
 import pytest
 import requests
 
-from direct_indexing.metadata.util import download_dataset, index, retrieve
+from direct_indexing.metadata import util
+from direct_indexing.metadata.util import (
+    download_dataset, index, index_dataset_metadata, retrieve, update_dataset_status
+)
 
 # consts
 SETTINGS_FRESH = 'direct_indexing.metadata.util.settings.FRESH'
@@ -62,6 +65,30 @@ def test_index(mocker, tmp_path, sample_data):
     assert (test_dir / 'test.json').exists()
 
 
+def test_index_dataset_metadata(mocker):
+    mock_index = mocker.patch('direct_indexing.metadata.util.index_documents', return_value='Successfully indexed')
+    mocker.patch('direct_indexing.metadata.util.settings.SOLR_URL', TEST_URL)
+
+    # Test that a document is indexed immediately, and the result of Solr is returned
+    assert index_dataset_metadata({'id': 1}) == 'Successfully indexed'
+    mock_index.assert_called_once_with(f'{TEST_URL}/dataset/update', [{'id': 1}])
+
+    # Test that a list of documents is indexed with a single request, into the shadow core for a rebuild
+    mock_index.return_value = 'error'
+    assert index_dataset_metadata([{'id': 2}, {'id': 3}], shadow=True) == 'error'
+    mock_index.assert_called_with(f'{TEST_URL}/dataset_shadow/update', [{'id': 2}, {'id': 3}])
+
+
+def test_update_dataset_status(mocker):
+    mocker.patch('direct_indexing.metadata.util.settings.SOLR_URL', 'https://example.com/solr')
+    mock_update = mocker.patch('direct_indexing.metadata.util.update_fields', return_value='Successfully indexed')
+    assert update_dataset_status('ds', iati_cloud_indexed=False) == 'Successfully indexed'
+    mock_update.assert_called_once_with('https://example.com/solr/dataset/update',
+                                        [{'id': 'ds', 'iati_cloud_indexed': False}], commit=True)
+    update_dataset_status('ds', True, dataset_valid='Invalid')
+    assert mock_update.call_args[0][0] == 'https://example.com/solr/dataset_shadow/update'
+
+
 def test_download_dataset(mocker, tmp_path):
     # Set up test path
     test_dir = tmp_path / 'test'
@@ -71,31 +98,217 @@ def test_download_dataset(mocker, tmp_path):
     mocker.patch(SETTINGS_DATASET_PARENT_PATH, test_dir)
 
     # Test that if not settings.FRESH, we return None and no further behaviour occurs
-    mocker.patch("urllib.request.URLopener")
+    mock_download = mocker.patch('direct_indexing.metadata.util.resume_download')
     mocker.patch(SETTINGS_FRESH, False)
     ret_val = download_dataset()
     assert ret_val == None  # NOQA: E711
-    assert urllib.request.URLopener.call_count == 0
+    mock_download.assert_not_called()
 
     # mocks and instances
     mocker.patch(SETTINGS_FRESH, True)
-    mocker.patch("urllib.request.URLopener")
     mocker.patch('zipfile.ZipFile')
+    (test_dir / 'iati-data-main.zip.part').write_text('old partial download')
     download_dataset()
 
     # Assert idm_dir was removed
     assert not idm_dir.exists()
-    # Assert urllib.request.URLopener was called once
-    urllib.request.URLopener.assert_called_once()
+    # Assert the dataset was downloaded once, through a new partial download
+    mock_download.assert_called_once_with(mocker.ANY, f'{test_dir}/iati-data-main.zip')
+    assert not (test_dir / 'iati-data-main.zip.part').exists()
     # Assert zipfile.ZipFile was called once
     zipfile.ZipFile.assert_called_once()
 
-    # Assert any urllib errors are raised
-    mocker.patch('urllib.request.URLopener', side_effect=urllib.error.URLError("Test"))
-    with pytest.raises(urllib.error.URLError):
+    # Assert any download errors are raised
+    mock_download.side_effect = requests.exceptions.ConnectionError("Test")
+    with pytest.raises(requests.exceptions.ConnectionError):
         download_dataset()
 
 
+def test_download_dataset_resume(mocker, tmp_path):
+    mocker.patch(SETTINGS_DATASET_PARENT_PATH, tmp_path)
+    mocker.patch(SETTINGS_FRESH, True)
+    mock_resume = mocker.patch('direct_indexing.metadata.util.resume_download')
+    with zipfile.ZipFile(tmp_path / 'iati-data-main.zip', 'w') as data_zip:
+        data_zip.writestr('iati-data-main/data/fcdo/fcdo-set-1.xml', '<xml/>')
+
+    # Test that a downloaded zip file is only unzipped, and the download is marked complete
+    download_dataset(resume=True)
+    mock_resume.assert_not_called()
+    assert (tmp_path / 'iati-data-main' / 'data' / 'fcdo' / 'fcdo-set-1.xml').exists()
+    assert (tmp_path / 'iati-data-main.complete').exists()
+
+    # Test that a completed download is kept as is
+    mock_zip = mocker.patch('zipfile.ZipFile')
+    download_dataset(resume=True)
+    mock_zip.assert_not_called()
+
+    # Test that a partial download is resumed, keeping its .part file, and a fresh download removes the marker first
+    (tmp_path / 'iati-data-main.complete').unlink()
+    (tmp_path / 'iati-data-main.zip').write_text('partial')
+    (tmp_path / 'iati-data-main.zip.part').write_text('partial')
+    download_dataset(resume=True)
+    mock_resume.assert_called_once()
+    assert (tmp_path / 'iati-data-main.zip.part').exists()
+    download_dataset()
+    assert mock_resume.call_count == 2
+
+
+def test_extract_changed(mocker, tmp_path):
+    zip_path = tmp_path / 'iati-data-main.zip'
+    folder = tmp_path / 'iati-data-main'
+    files = folder / 'data' / 'fcdo'
+
+    def write_zip(members):
+        with zipfile.ZipFile(zip_path, 'w') as data_zip:
+            data_zip.writestr('iati-data-main/', '')
+            for name, content in members.items():
+                data_zip.writestr(f'iati-data-main/data/fcdo/{name}', content)
+
+    # Test that without a manifest, the folder is replaced by a full extraction
+    files.mkdir(parents=True)
+    (files / 'stale.xml').write_text('<stale/>')
+    write_zip({'a.xml': '<a/>', 'b.xml': '<b/>'})
+    assert util.extract_changed(str(zip_path), str(folder)) is None
+    assert not (files / 'stale.xml').exists()
+    assert (files / 'a.xml').read_text() == '<a/>'
+    manifest = json.loads((tmp_path / 'iati-data-main.manifest.json').read_text())
+    assert sorted(manifest) == ['iati-data-main/data/fcdo/a.xml', 'iati-data-main/data/fcdo/b.xml']
+
+    # Test that only the changed members are extracted, and the removed files deleted
+    unchanged_mtime = (files / 'a.xml').stat().st_mtime_ns
+    write_zip({'a.xml': '<a/>', 'b.xml': '<b>changed</b>', 'c.xml': '<c/>'})
+    assert util.extract_changed(str(zip_path), str(folder)) == {
+        'added': [f'{files}/c.xml'], 'modified': [f'{files}/b.xml'], 'removed': []
+    }
+    assert (files / 'a.xml').stat().st_mtime_ns == unchanged_mtime
+    assert (files / 'b.xml').read_text() == '<b>changed</b>'
+    write_zip({'a.xml': '<a/>', 'c.xml': '<c/>'})
+    assert util.extract_changed(str(zip_path), str(folder)) == {
+        'added': [], 'modified': [], 'removed': [f'{files}/b.xml']
+    }
+    assert not (files / 'b.xml').exists()
+
+    # Test that a missing file is extracted again
+    (files / 'a.xml').unlink()
+    assert util.extract_changed(str(zip_path), str(folder))['modified'] == [f'{files}/a.xml']
+
+    # Test that a file changed on disk, f.ex. by fcdo_replace_partial_url, is restored from the zip file
+    (files / 'c.xml').write_text('<staging/>')
+    (files / 'a.xml').write_text('<x/>')
+    assert util.extract_changed(str(zip_path), str(folder))['modified'] == [f'{files}/a.xml', f'{files}/c.xml']
+    assert (files / 'a.xml').read_text() == '<a/>'
+    assert (files / 'c.xml').read_text() == '<c/>'
+
+    # Test that a member which could not be extracted is extracted again next time
+    write_zip({'a.xml': '<a>changed</a>', 'c.xml': '<c/>'})
+    mocker.patch('direct_indexing.metadata.util._extract_member', return_value=False)
+    assert util.extract_changed(str(zip_path), str(folder))['modified'] == []
+    mocker.stopall()
+    assert util.extract_changed(str(zip_path), str(folder))['added'] == [f'{files}/a.xml']
+    assert (files / 'a.xml').read_text() == '<a>changed</a>'
+
+    # Test that members outside of the extraction folder are skipped
+    with zipfile.ZipFile(zip_path, 'a') as data_zip:
+        data_zip.writestr('../outside.xml', '<x/>')
+    assert util.extract_changed(str(zip_path), str(folder))['added'] == []
+    assert not (tmp_path.parent / 'outside.xml').exists()
+
+
+def git(*args, cwd=None):
+    subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args], cwd=cwd, check=True,
+                   capture_output=True)
+
+
+def test_download_dataset_git(mocker, tmp_path):
+    mocker.patch(SETTINGS_DATASET_PARENT_PATH, tmp_path)
+    mocker.patch(SETTINGS_FRESH, True)
+    mocker.patch('direct_indexing.metadata.util.settings.DATASET_SYNC_MODE', 'git')
+    mock_download = mocker.patch('direct_indexing.metadata.util.resume_download')
+    mock_sync = mocker.patch('direct_indexing.metadata.util.sync_repository', return_value={'added': []})
+    # Test that the data repository is synced instead of downloading the zip file
+    assert download_dataset() == {'added': []}
+    mock_sync.assert_called_once_with(f'{tmp_path}/iati-data-main')
+    mock_download.assert_not_called()
+
+
+def test_sync_repository(mocker, tmp_path):
+    # A local bare repository stands in for the remote data repository
+    work = tmp_path / 'work'
+    remote = tmp_path / 'remote.git'
+    (work / 'data' / 'fcdo').mkdir(parents=True)
+    (work / 'data' / 'fcdo' / 'a.xml').write_text('<a/>')
+    (work / 'data' / 'fcdo' / 'b.xml').write_text('<b/>')
+    git('init', '--quiet', '--initial-branch', 'main', str(work))
+    git('add', '.', cwd=work)
+    git('commit', '--quiet', '-m', 'first', cwd=work)
+    git('clone', '--quiet', '--bare', str(work), str(remote))
+    mocker.patch('direct_indexing.metadata.util.settings.DATASET_GIT_URL', f'file://{remote}')
+    mocker.patch('direct_indexing.metadata.util.settings.DATASET_GIT_BRANCH', 'main')
+    clone = tmp_path / 'iati-data-main'
+
+    # Test that an unzipped archive is replaced by a clone, which has no changes to report
+    (clone / 'data').mkdir(parents=True)
+    assert util.sync_repository(str(clone)) is None
+    assert (clone / 'data' / 'fcdo' / 'a.xml').read_text() == '<a/>'
+
+    # Test that an up to date clone has no changes
+    assert util.sync_repository(str(clone)) == {'added': [], 'modified': [], 'removed': []}
+
+    # Test that only the new commits are fetched, and the changed files are reported
+    (work / 'data' / 'fcdo' / 'a.xml').write_text('<a>changed</a>')
+    (work / 'data' / 'fcdo' / 'b.xml').unlink()
+    (work / 'data' / 'fcdo' / 'c.xml').write_text('<c/>')
+    git('add', '--all', '.', cwd=work)
+    git('commit', '--quiet', '-m', 'second', cwd=work)
+    git('push', '--quiet', str(remote), 'main', cwd=work)
+    assert util.sync_repository(str(clone)) == {
+        'added': [f'{clone}/data/fcdo/c.xml'],
+        'modified': [f'{clone}/data/fcdo/a.xml'],
+        'removed': [f'{clone}/data/fcdo/b.xml'],
+    }
+    assert (clone / 'data' / 'fcdo' / 'a.xml').read_text() == '<a>changed</a>'
+    assert not (clone / 'data' / 'fcdo' / 'b.xml').exists()
+
+    # Test that git errors are raised
+    mocker.patch('direct_indexing.metadata.util.settings.DATASET_GIT_URL', f'file://{tmp_path}/missing.git')
+    with pytest.raises(subprocess.CalledProcessError):
+        util.sync_repository(str(clone))
+
+
+def test_resume_download(tmp_path, requests_mock):
+    path = tmp_path / 'data.zip'
+    part_path = tmp_path / 'data.zip.part'
+    # Test that a partial download continues from its size
+    part_path.write_bytes(b'abc')
+    download = requests_mock.get(TEST_URL, content=b'def', status_code=206)
+    util.resume_download(TEST_URL, str(path))
+    assert download.last_request.headers['Range'] == 'bytes=3-'
+    assert path.read_bytes() == b'abcdef'
+    assert not part_path.exists()
+
+    # Test that a server without range support restarts the download
+    part_path.write_bytes(b'abc')
+    requests_mock.get(TEST_URL, content=b'abcdef', status_code=200)
+    util.resume_download(TEST_URL, str(path))
+    assert path.read_bytes() == b'abcdef'
+
+    # Test that a complete partial download is kept
+    part_path.write_bytes(b'abcdef')
+    requests_mock.get(TEST_URL, status_code=416)
+    util.resume_download(TEST_URL, str(path))
+    assert path.read_bytes() == b'abcdef'
+
+    # Test that a fresh download has no range
+    download = requests_mock.get(TEST_URL, content=b'xyz', status_code=200)
+    util.resume_download(TEST_URL, str(path))
+    assert 'Range' not in download.last_request.headers
+    assert path.read_bytes() == b'xyz'
+
+    requests_mock.get(TEST_URL, status_code=500)
+    with pytest.raises(requests.exceptions.HTTPError):
+        util.resume_download(TEST_URL, str(path))
+
+
 @pytest.fixture
 def sample_data():
     return {
@@ -1,4 +1,6 @@
-from direct_indexing.processing.activity_subtypes import extract_all_subtypes, extract_subtype, process_subtype_dict
+from direct_indexing.processing.activity_subtypes import (
+    extract_all_subtypes, extract_subtype, process_subtype_dict, subtype_ids
+)
 
 
 def test_extract_subtype(mocker):
@@ -23,6 +25,33 @@ def test_extract_subtype(mocker):
     assert mock_process.call_count == len(data.keys())  # once for each key in data
 
 
+def test_extract_subtype_ids():
+    # Test that subtypes get a deterministic id from the activity id, the subtype and the position
+    data = {'id': 'ds|a', 'transaction': [{'value': 1}, {'value': 2}]}
+    res = extract_subtype(data, 'transaction')
+    assert [subtype['id'] for subtype in res] == ['ds|a|transaction|0', 'ds|a|transaction|1']
+    # Test that without an activity id, no id is set
+    del data['id']
+    res = extract_subtype(data, 'transaction')
+    assert 'id' not in res[0]
+
+
+def test_extract_subtype_without_activity_hash():
+    data = {'id': 'ds|a', 'iati_cloud_activity_hash': 'h', 'budget': {'value': 1}}
+    assert 'iati_cloud_activity_hash' not in extract_subtype(data, 'budget')[0]
+
+
+def test_subtype_ids():
+    # Test that the ids match the ids of the extracted subtypes
+    data = {'id': 'ds|a', 'transaction': [{'value': 1}, None, {'value': 2}], 'budget': {'value': 1}}
+    expected = [(subtype, document['id']) for subtype in ['transaction', 'budget']
+                for document in extract_subtype(data, subtype)]
+    assert list(subtype_ids(data)) == expected
+    assert ('transaction', 'ds|a|transaction|2') in expected
+    # Test that without an activity id, there are no ids
+    assert list(subtype_ids({'transaction': {'value': 1}})) == []
+
+
 def test_process_subtype_dict(mocker):
     tvu = 'transaction.value-usd'
     bvu = 'budget.value-usd'
@@ -64,11 +93,13 @@ def test_extract_all_subtypes(mocker):
     mock_extract = mocker.patch('direct_indexing.processing.activity_subtypes.extract_subtype',
                                 return_value=[{}])
     data = {}
-    subtypes = {}
-    subtypes = extract_all_subtypes(subtypes, data)
-    mock_index.assert_called_once()
+    subtypes = extract_all_subtypes(data)
+    # Assert nothing is extracted until the generator is consumed
+    mock_index.assert_not_called()
     mock_extract.assert_not_called()
-    assert subtypes == {}
+    # A single activity is extracted for every available subtype
+    assert list(subtypes) == [('transaction', {}), ('budget', {}), ('result', {})]
+    mock_index.assert_called_once()
     assert data == {}
 
     data = [
@@ -82,8 +113,8 @@ def test_extract_all_subtypes(mocker):
             'transaction': {}
         }
     ]
-    subtypes = {'budget': [], 'result': [], 'transaction': []}
-    extract_all_subtypes(subtypes, data)
+    subtypes = list(extract_all_subtypes(data))
     # assert mock_index called 3 times
     assert mock_index.call_count == len(data) + 1  # +1 for the previous test
-    assert mock_extract.call_count == len(data) * len(subtypes)  # 2 * 3
+    assert mock_extract.call_count == len(data) * 3 + 3  # 2 * 3, +3 for the previous test
+    assert len(subtypes) == len(data) * 3
@@ -1,10 +1,17 @@
+import json
 import xml.etree.ElementTree as ET
+from concurrent import futures
 
+import pysolr
 import pytest
+import requests
 
 from direct_indexing.processing.dataset import (
-    convert_and_save_xml_to_processed_json, dataset_subtypes, fun, index_dataset, index_subtypes, json_filepath
+    bisect_failed_batch, commit_dataset_cores, convert_and_save_xml_to_processed_json, dataset_subtypes,
+    drop_stale_documents, fun, fun_batch, get_activity_hashes, index_dataset, index_dataset_file, index_subtype_batch,
+    index_subtypes, json_filepath, process_dataset, refresh_unchanged_documents, timed_subtype_batch, wait_for_uploads
 )
+from direct_indexing.util import BadRequest
 
 TEST_PATH = '/test/path/test.json'
 TEST_JSON = 'test.json'
@@ -29,10 +36,14 @@ def test_fun(mocker):
     mock_metadata = mocker.patch('direct_indexing.processing.dataset.custom_fields.get_custom_metadata')
     # mock index_dataset
     mock_index_ds = mocker.patch('direct_indexing.processing.dataset.index_dataset', return_value=(True, INDEX_SUCCESS))  # NOQA: 501
-    # mock index
-    mock_index = mocker.patch('direct_indexing.processing.dataset.index', return_value=INDEX_SUCCESS)
-    # mock Solr
-    mock_solr = mocker.patch('direct_indexing.processing.dataset.Solr')
+    # mock index_dataset_metadata
+    mock_index = mocker.patch('direct_indexing.processing.dataset.index_dataset_metadata', return_value=INDEX_SUCCESS)
+    # mock drop_stale_documents
+    mock_drop = mocker.patch('direct_indexing.processing.dataset.drop_stale_documents', return_value=['transaction'])
+    # mock commit_dataset_cores
+    mock_commit = mocker.patch('direct_indexing.processing.dataset.commit_dataset_cores')
+    # mock ledger.record_dataset
+    mock_record = mocker.patch('direct_indexing.processing.dataset.ledger.record_dataset')
     mock_metadata.return_value = {validation_status: 'Critical'}
 
     fun({}, False)
@@ -44,21 +55,195 @@ def test_fun(mocker):
     mock_validity.assert_called_once()
     mock_filetype.assert_called_once()
     mock_metadata.assert_called_once()
-    # assert mock_solr was not called
-    mock_solr.assert_not_called()
     # assert mock index_dataset was not called
     mock_index_ds.assert_not_called()
     # assert mock index was called
     mock_index.assert_called_once()
+    # assert no documents are dropped when the dataset is not updated
+    mock_drop.assert_not_called()
+    # assert the state of the dataset is recorded in the ledger
+    mock_record.assert_called_once()
 
     # Test that index_dataset is called if the dataset is considered valid
     mock_metadata.return_value = {validation_status: 'Valid'}
-    fun({}, True)
+    mock_clean.return_value = {'id': 'ds'}
+    fun({'id': 'ds'}, True)
     mock_index_ds.assert_called_once()
-    assert mock_solr.call_count == 4
-
-
-def test_index_dataset(mocker):
+    # assert the documents which were not overwritten are dropped for an updated dataset
+    mock_drop.assert_called_once_with('ds', {}, [])
+
+    # Test that rejected documents are reported in the dataset metadata, and their previous versions dropped
+    def index_with_rejection(*args):
+        args[5]['activity'] = {'ds|a', 'ds|b'}
+        args[7].append({'core': 'activity', 'id': 'ds|b', 'error': 'bad date'})
+        return True, INDEX_SUCCESS
+    mock_index_ds.side_effect = index_with_rejection
+    mock_drop.reset_mock()
+    fun({'id': 'ds'}, True)
+    mock_drop.assert_called_once_with('ds', {'activity': {'ds|a'}}, [])
+    dataset = mock_index.call_args[0][0]
+    assert dataset['iati_cloud_rejected_count'] == 1
+    assert dataset['iati_cloud_rejected_documents'] == ['activity ds|b: bad date']
+    assert mock_record.call_args[0][:2] == (dataset, {'activity': {'ds|a'}})
+    assert mock_record.call_args[0][3] is False
+    # The cores updated for the dataset are committed once, after its metadata is indexed
+    mock_commit.assert_called_with({'activity', 'transaction', 'dataset'}, False)
+
+    # A dataset whose stale documents could not be dropped is still recorded, to be indexed again by the next update
+    mock_drop.side_effect = lambda dataset_id, document_ids, failed: failed.append('activity') or []
+    assert fun({'id': 'ds'}, True) == (INDEX_SUCCESS, INDEX_SUCCESS)
+    assert mock_record.call_args[0][3] is True
+    mock_drop.side_effect = None
+
+    # A rebuild is not recorded in the ledger, as its shadow cores may never be swapped in
+    mock_record.reset_mock()
+    fun({'id': 'ds'}, False, shadow=True)
+    mock_record.assert_not_called()
+
+
+def test_fun_batch(mocker):
+    mock_currencies = mocker.patch('direct_indexing.processing.dataset.cu.Currencies')
+    mock_codelist = mocker.patch('direct_indexing.processing.dataset.codelists.Codelists')
+    mocker.patch('direct_indexing.processing.dataset.clean_dataset_metadata', side_effect=lambda dataset: dataset)
+    mocker.patch('direct_indexing.processing.dataset.get_dataset_version_validity')
+    mocker.patch('direct_indexing.processing.dataset.get_dataset_filetype')
+    mocker.patch('direct_indexing.processing.dataset.custom_fields.get_custom_metadata', return_value={})
+    mock_index = mocker.patch('direct_indexing.processing.dataset.index_dataset_metadata', return_value=INDEX_SUCCESS)
+    mock_drop = mocker.patch('direct_indexing.processing.dataset.drop_stale_documents', return_value=[])
+    mock_commit = mocker.patch('direct_indexing.processing.dataset.commit_dataset_cores')
+    mock_record = mocker.patch('direct_indexing.processing.dataset.ledger.record_dataset')
+
+    # Every dataset collects its documents instead of posting them
+    def collect(*args):
+        dataset_id = args[0]
+        args[5]['activity'] = {f'{dataset_id}|a'}
+        args[8].setdefault('activity', []).append({'id': f'{dataset_id}|a'})
+        if dataset_id == 'ds2':
+            args[5]['transaction'] = {'ds2|t'}
+            args[8].setdefault('transaction', []).append({'id': 'ds2|t'})
+        return True, INDEX_SUCCESS
+    mocker.patch('direct_indexing.processing.dataset.get_dataset_filepath', side_effect=lambda dataset: dataset['id'])
+    mocker.patch('direct_indexing.processing.dataset.index_dataset', side_effect=collect)
+
+    def post(core, documents, shadow, rejected):
+        if core == 'transaction':
+            return 'Failed to index'
+        rejected.append({'core': core, 'id': 'ds1|a', 'error': 'bad date'})
+        return INDEX_SUCCESS
+    mock_post = mocker.patch('direct_indexing.processing.dataset.index_subtype_batch', side_effect=post)
+
+    outcomes = fun_batch([({'id': 'ds1'}, True), ({'id': 'ds2'}, False)])
+    # The codelists and currencies are set up once for the batch
+    mock_currencies.assert_called_once()
+    mock_codelist.assert_called_once()
+    # The documents of all datasets are posted in one request per core
+    assert mock_post.call_count == 2
+    mock_post.assert_any_call('activity', [{'id': 'ds1|a'}, {'id': 'ds2|a'}], False, mocker.ANY)
+    # The status of every dataset is recorded individually
+    assert outcomes == [(INDEX_SUCCESS, INDEX_SUCCESS), ('Failed to index', INDEX_SUCCESS)]
+    # The metadata of all datasets is indexed with a single request
+    mock_index.assert_called_once()
+    first, second = mock_index.call_args[0][0]
+    assert first['iati_cloud_indexed'] is True
+    assert first['iati_cloud_rejected_documents'] == ['activity ds1|a: bad date']
+    assert second['iati_cloud_indexed'] is False
+    assert second['iati_cloud_rejected_count'] == 0
+    mock_drop.assert_called_once_with('ds1', {'activity': set()}, [])
+    assert mock_record.call_count == 2
+    # The cores updated for the batch are committed once
+    mock_commit.assert_called_once_with({'activity', 'transaction', 'dataset'}, False)
+
+
+def test_commit_dataset_cores(mocker):
+    mocker.patch('direct_indexing.processing.dataset.settings.SOLR_URL', 'https://example.com/solr')
+    mock_commit = mocker.patch('direct_indexing.processing.dataset.commit_core')
+    policy = 'direct_indexing.processing.dataset.settings.SOLR_COMMIT_POLICY'
+    mocker.patch(policy, 'hard')
+    commit_dataset_cores({'dataset', 'activity'})
+    assert mock_commit.call_args_list == [
+        mocker.call('https://example.com/solr/activity', soft=False),
+        mocker.call('https://example.com/solr/dataset', soft=False),
+    ]
+    # A failed commit is picked up by the next commit of the core
+    mock_commit.side_effect = pysolr.SolrError
+    commit_dataset_cores({'activity'})
+
+    mock_commit.reset_mock(side_effect=True)
+    mocker.patch(policy, 'soft')
+    commit_dataset_cores({'activity'})
+    mock_commit.assert_called_once_with('https://example.com/solr/activity', soft=True)
+
+    # Rebuilds and the other policies commit when the run is finalized, or leave it to Solr
+    mock_commit.reset_mock()
+    commit_dataset_cores({'activity'}, shadow=True)
+    mocker.patch(policy, 'within')
+    commit_dataset_cores({'activity'})
+    mock_commit.assert_not_called()
+
+
+def test_process_dataset_activity_hashes(mocker):
+    mocker.patch('direct_indexing.processing.dataset.clean_dataset_metadata', side_effect=lambda dataset: dataset)
+    mocker.patch('direct_indexing.processing.dataset.get_dataset_filepath')
+    mocker.patch('direct_indexing.processing.dataset.get_dataset_version_validity')
+    mocker.patch('direct_indexing.processing.dataset.get_dataset_filetype')
+    mocker.patch('direct_indexing.processing.dataset.custom_fields.get_custom_metadata', return_value={})
+    mock_index = mocker.patch('direct_indexing.processing.dataset.index_dataset', return_value=(True, INDEX_SUCCESS))
+    mock_hashes = mocker.patch('direct_indexing.processing.dataset.get_activity_hashes', return_value={'ds|a': 'h'})
+
+    # Without incremental activity updates, the activities are not hashed
+    mocker.patch('direct_indexing.processing.dataset.settings.ACTIVITY_INCREMENTAL_UPDATE', False)
+    process_dataset({'id': 'ds'}, None, None, update=True)
+    assert mock_index.call_args[0][9] is None
+    mock_hashes.assert_not_called()
+
+    # The hashes of the indexed activities are used when updating the live cores
+    mocker.patch('direct_indexing.processing.dataset.settings.ACTIVITY_INCREMENTAL_UPDATE', True)
+    process_dataset({'id': 'ds'}, None, None, update=True)
+    assert mock_index.call_args[0][9] == {'ds|a': 'h'}
+    mock_hashes.assert_called_once_with('ds')
+    # A new dataset or a rebuild hashes the activities, without previous hashes
+    process_dataset({'id': 'ds'}, None, None)
+    assert mock_index.call_args[0][9] == {}
+    process_dataset({'id': 'ds'}, None, None, shadow=True, update=True)
+    assert mock_index.call_args[0][9] == {}
+    mock_hashes.assert_called_once()
+
+
+def test_get_activity_hashes(mocker):
+    mock_iterate = mocker.patch('direct_indexing.processing.dataset.iterate_documents',
+                                return_value=[{'id': 'a', 'iati_cloud_activity_hash': 'h'}, {'id': 'b'}])
+    assert get_activity_hashes('ds') == {'a': 'h'}
+    mock_iterate.assert_called_once_with('activity', 'dataset.id:"ds"', 'id,iati_cloud_activity_hash')
+    # Without the hashes, every activity is posted
+    mock_iterate.side_effect = requests.exceptions.ConnectionError
+    assert get_activity_hashes('ds') == {}
+
+
+def test_drop_stale_documents(mocker):
+    mock_iterate = mocker.patch('direct_indexing.processing.dataset.iterate_documents',
+                                return_value=[{'id': 'a'}, {'id': 'b'}])
+    mock_delete = mocker.patch('direct_indexing.processing.dataset.delete_documents')
+
+    cores = drop_stale_documents('ds', {'activity': {'a', 'b'}, 'transaction': {'a'}})
+    # Every core containing dataset documents is checked
+    assert mock_iterate.call_count == 5
+    mock_iterate.assert_any_call('activity', 'dataset.id:"ds"', 'id')
+    # Only the documents that were not indexed again are deleted, in every core that is not overwritten entirely,
+    # leaving the commit to the caller
+    mock_delete.assert_any_call('transaction', {'b'}, commit=False)
+    mock_delete.assert_any_call('organisation', {'a', 'b'}, commit=False)
+    assert cores == ['organisation', 'transaction', 'budget', 'result']
+    assert mock_delete.call_count == 4
+
+    # A core which cannot be read or deleted from is skipped and reported, without failing the others
+    mock_iterate.side_effect = [requests.exceptions.HTTPError('500'), [{'id': 'b'}], [], [], []]
+    mock_delete.side_effect = pysolr.SolrError('delete failed')
+    failed = []
+    assert drop_stale_documents('ds', {'activity': {'a'}}, failed) == []
+    assert failed == ['activity', 'organisation']
+
+
+def test_index_dataset(mocker, tmp_path):
     convert_save = 'direct_indexing.processing.dataset.convert_and_save_xml_to_processed_json'
     # mock convert_and_save_xml_to_processed_json, index_to_core
     mock_convert = mocker.patch(convert_save, return_value=False)  # NOQA: 501
@@ -71,9 +256,54 @@ def test_index_dataset(mocker):
     assert index_dataset(None, None, None, None, None) == (True, INDEX_SUCCESS)
     mock_index.assert_called_once()
 
+    mocker.patch('direct_indexing.processing.dataset.settings.SOLR_BISECT_FAILED_BATCHES', False)
     mock_index.return_value = 'Failed to index'
     assert index_dataset(None, None, None, None, None) == (False, 'Failed to index')
 
+    # Test that a failing conversion is reported, also when one of its background uploads raised
+    def convert_with_failed_upload(*args):
+        upload = futures.Future()
+        upload.set_exception(requests.exceptions.ConnectionError('connection refused'))
+        args[8].append(upload)
+        raise ValueError('invalid xml')
+    mock_convert.side_effect = convert_with_failed_upload
+    assert index_dataset(None, None, None, None, None) == (False, 'invalid xml')
+    mock_convert.side_effect = None
+
+    # Test that a failed file is retried by bisecting its documents, and is removed afterwards
+    mocker.patch('direct_indexing.processing.dataset.settings.SOLR_BISECT_FAILED_BATCHES', True)
+    json_path = tmp_path / TEST_JSON
+    json_path.write_text('[{"id": "a"}, {"id": "b"}]')
+    mock_convert.return_value = str(json_path)
+    mock_bisect = mocker.patch('direct_indexing.processing.dataset.bisect_failed_batch', return_value=INDEX_SUCCESS)
+    rejected = []
+    # Only bad requests are bisected
+    assert index_dataset(None, 'activity', None, None, None, rejected=rejected) == (False, 'Failed to index')
+    mock_bisect.assert_not_called()
+    json_path.write_text('[{"id": "a"}, {"id": "b"}]')
+    mock_index.return_value = BadRequest('bad date')
+    assert index_dataset(None, 'activity', None, None, None, rejected=rejected) == (True, INDEX_SUCCESS)
+    mock_bisect.assert_called_once_with('activity', mocker.ANY, [{'id': 'a'}, {'id': 'b'}], rejected, 'bad date')
+    assert not json_path.exists()
+    mock_convert.return_value = TEST_PATH
+
+    # Test that with SolrCloud the file is written per shard into the collection
+    mocker.patch('direct_indexing.processing.dataset.settings.SOLR_CLOUD', True)
+    mock_shard = mocker.patch('direct_indexing.processing.dataset.index_file_by_shard', return_value=INDEX_SUCCESS)
+    assert index_dataset(None, 'activity', None, None, None) == (True, INDEX_SUCCESS)
+    mock_shard.assert_called_once_with('activity', TEST_PATH, core='activity')
+    mocker.patch('direct_indexing.processing.dataset.settings.SOLR_CLOUD', False)
+
+    # Test that the subtypes uploaded in the background are waited for, and their failure is reported
+    def convert_with_upload(*args):
+        upload = futures.Future()
+        upload.set_result(('Failed to index transactions', 1.0))
+        args[8].append(upload)
+        return TEST_PATH
+    mocker.patch(convert_save, side_effect=convert_with_upload)
+    mock_index.return_value = INDEX_SUCCESS
+    assert index_dataset(None, 'activity', None, None, None) == (False, 'Failed to index transactions')
+
     # Test that if index_dataset raises an exception with error message 'test', it returns a tuple False, 'test'
     mocker.patch(convert_save, side_effect=Exception('test'))  # NOQA: 501
     assert index_dataset(None, None, None, None, None) == (False, 'test')
@@ -86,7 +316,7 @@ def test_convert_and_save_xml_to_processed_json(mocker, tmp_path, fixture_xml_ac
     mock_add_all_org = mocker.patch('direct_indexing.processing.dataset.organisation_custom_fields.add_all', return_value={})  # NOQA: 501
     mock_json_filepath = mocker.patch('direct_indexing.processing.dataset.json_filepath', return_value=str(tmp_path / TEST_JSON))  # NOQA: 501
     mock_json = mocker.patch('direct_indexing.processing.dataset.json.dump')
-    mock_subtypes = mocker.patch('direct_indexing.processing.dataset.dataset_subtypes')
+    mock_subtypes = mocker.patch('direct_indexing.processing.dataset.dataset_subtypes', return_value={})
     xml_path = tmp_path / 'test.xml'
     xml_path.write_text("<test>test</test>")
 
@@ -121,17 +351,23 @@ def test_convert_and_save_xml_to_processed_json(mocker, tmp_path, fixture_xml_ac
     mocker.patch('direct_indexing.processing.dataset.settings.FCDO_INSTANCE', False)
     convert_and_save_xml_to_processed_json(xml_path, 'activity', None, None, None)
     mock_subtypes.assert_called_once()
+    # Test that the ids of the documents are collected per core
+    document_ids = {}
+    mock_add_all.return_value = [{'iati-identifier': 'a'}]
+    mock_subtypes.return_value = {'transaction': {'ds|a|transaction|0'}}
+    convert_and_save_xml_to_processed_json(xml_path, 'activity', None, None, {'dataset.id': 'ds'}, document_ids)
+    assert document_ids == {'activity': {'ds|a'}, 'transaction': {'ds|a|transaction|0'}}
 
     # Test that if there is an organisation, we call recursive_attribute_cleaning,
     # organisation_custom_fields.add_all, json.dump, dataset_subtypes
     xml_path.write_text(fixture_xml_org)
     convert_and_save_xml_to_processed_json(xml_path, 'organisation', None, None, None)
     # Assert that recursive_attribute_cleaning is called with the data
-    assert mock_clean.call_count == 3  # +2 for the previous tests
-    assert mock_add_all.call_count == 2  # not more than 2, because only once for the previous tests
+    assert mock_clean.call_count == 4  # +3 for the previous tests
+    assert mock_add_all.call_count == 3  # not more than 3, because only once for the previous tests
     mock_add_all_org.assert_called_once()
-    assert mock_json_filepath.call_count == 3  # +2 for the previous tests
-    assert mock_json.call_count == 3  # +2 for the previous tests
+    assert mock_json_filepath.call_count == 4  # +3 for the previous tests
+    assert mock_json.call_count == 4  # +3 for the previous tests
 
     # Assert if json_filepath returns False, the return value is False
     mock_json_filepath.return_value = False
@@ -142,6 +378,58 @@ def test_convert_and_save_xml_to_processed_json(mocker, tmp_path, fixture_xml_ac
     assert convert_and_save_xml_to_processed_json(None, None, None, None, None) is None
 
 
+def test_convert_and_save_organisation_dataset(tmp_path, fixture_xml_org):
+    xml_path = tmp_path / 'test.xml'
+    xml_path.write_text(fixture_xml_org)
+    metadata = {'dataset.id': 'ds', 'dataset.name': 'org-file', 'dataset.extras.validation_status': 'Valid'}
+
+    # Test that the organisations carry the dataset id, so their stale and removed documents can be found
+    document_ids = {}
+    json_path = convert_and_save_xml_to_processed_json(str(xml_path), 'organisation', None, None, metadata,
+                                                       document_ids)
+    with open(json_path) as json_file:
+        organisations = json.load(json_file)
+    assert [organisation['dataset.id'] for organisation in organisations] == ['ds']
+    assert organisations[0]['dataset.name'] == 'org-file'
+    assert 'dataset.extras.validation_status' not in organisations[0]
+    assert document_ids == {'organisation': {organisations[0]['id']}}
+
+
+def test_convert_and_save_unchanged_activities(mocker, tmp_path, fixture_xml_act):
+    mocker.patch('direct_indexing.processing.dataset.settings.FCDO_INSTANCE', False)
+    mocker.patch('direct_indexing.processing.dataset.recursive_attribute_cleaning')
+    mocker.patch('direct_indexing.processing.dataset.custom_fields.add_all', return_value=[
+        {'iati-identifier': 'a', 'budget': {'value': 1}}, {'iati-identifier': 'b'}
+    ])
+    mocker.patch('direct_indexing.processing.dataset.json_filepath', return_value=str(tmp_path / TEST_JSON))
+    mock_json = mocker.patch('direct_indexing.processing.dataset.json.dump')
+    mock_subtypes = mocker.patch('direct_indexing.processing.dataset.dataset_subtypes', return_value={})
+    mock_hashes = mocker.patch('direct_indexing.processing.dataset.set_activity_hashes', return_value={'ds|a'})
+    mock_refresh = mocker.patch('direct_indexing.processing.dataset.refresh_unchanged_documents')
+    xml_path = tmp_path / 'test.xml'
+    xml_path.write_text(fixture_xml_act)
+
+    # Test that only the changed activities are saved, and the subtype ids of the unchanged ones are kept
+    document_ids = {}
+    convert_and_save_xml_to_processed_json(xml_path, 'activity', None, None, {'dataset.id': 'ds'}, document_ids,
+                                           previous_hashes={'ds|a': 'h'})
+    mock_hashes.assert_called_once()
+    assert mock_hashes.call_args[0][1] == {'ds|a': 'h'}
+    assert [activity['id'] for activity in mock_json.call_args[0][0]] == ['ds|b']
+    assert [activity['id'] for activity in mock_subtypes.call_args[0][1]] == ['ds|b']
+    assert document_ids == {'activity': {'ds|a', 'ds|b'}, 'budget': {'ds|a|budget|0'}}
+    # Test that the dataset metadata of the unchanged activity is refreshed
+    assert [activity['id'] for activity in mock_refresh.call_args[0][0]] == ['ds|a']
+
+    # Test that the activities are not hashed without previous hashes
+    mock_hashes.reset_mock()
+    mock_refresh.reset_mock()
+    convert_and_save_xml_to_processed_json(xml_path, 'activity', None, None, {'dataset.id': 'ds'})
+    mock_hashes.assert_not_called()
+    mock_refresh.assert_not_called()
+    assert len(mock_json.call_args[0][0]) == 2
+
+
 def test_json_filepath(mocker):
     # Assert that given a filepath with any file extension, we return the same filepath with .json appended
     assert json_filepath('/test/path/test.xml') == TEST_PATH
@@ -156,40 +444,174 @@ def test_json_filepath(mocker):
 def test_dataset_subtypes(mocker):
     # mock activity_subtypes.extract_all_subtypes and index_subtypes
     mock_extract = mocker.patch('direct_indexing.processing.dataset.activity_subtypes.extract_all_subtypes',
-                                return_value={})
+                                return_value=iter([]))
     mock_index = mocker.patch('direct_indexing.processing.dataset.index_subtypes')
 
     # Test that if filetype is not activity, we do not call extract_all_subtypes or index_subtypes
-    dataset_subtypes('organisation', {}, TEST_JSON)
+    assert dataset_subtypes('organisation', {}) == {}
     mock_extract.assert_not_called()
     mock_index.assert_not_called()
 
     # Test that we call extract_all_subtypes and index_subtypes if filetype is activity
-    dataset_subtypes('activity', {}, TEST_JSON)
+    dataset_subtypes('activity', {})
     mock_extract.assert_called_once()
-    mock_extract.assert_called_with({'transaction': [], 'budget': [], 'result': []}, {})
-    mock_index.assert_called_once()
+    mock_extract.assert_called_with({})
+    mock_index.assert_called_once_with(mock_extract.return_value, False, None, None, None)
 
 
-def test_index_subtypes(mocker, tmp_path):
-    # mock index_to_core and json.dump
-    mock_index = mocker.patch('direct_indexing.processing.dataset.index_to_core')
-    mock_json = mocker.patch('direct_indexing.processing.dataset.json.dump')
-    mock_open = mocker.patch('builtins.open', mocker.mock_open())
+def test_index_dataset_file(tmp_path):
+    # Test that with a dict of pending documents, the documents are collected instead of posted
+    json_path = tmp_path / TEST_JSON
+    json_path.write_text('{"id": "a"}')
+    pending = {'activity': [{'id': 'b'}]}
+    assert index_dataset_file('activity', str(json_path), pending=pending) == (INDEX_SUCCESS, 0)
+    assert pending == {'activity': [{'id': 'b'}, {'id': 'a'}]}
+    assert not json_path.exists()
 
-    # Test that we don't call index_to_core or json.dump if there are no subtypes
-    json_path = tmp_path / 'activity.json'
-    subtypes = {}
-    index_subtypes(json_path, subtypes)
-    mock_index.assert_not_called()
-    mock_json.assert_not_called()
 
-    # Assert that we index the result subtype
-    subtypes = {'result': {}}
-    index_subtypes(json_path, subtypes)
-    mock_index.assert_called_once()
-    mock_json.assert_called_once()
-    mock_open.assert_called_with(str(tmp_path / 'activity_result.json'), 'w')
+def test_refresh_unchanged_documents(mocker):
+    mocker.patch('direct_indexing.processing.dataset.settings.FCDO_INSTANCE', False)
+    mock_index = mocker.patch('direct_indexing.processing.dataset.index_subtypes')
+    activity = {'id': 'ds|a', 'dataset.metadata_modified': 'm', 'dataset.resources.hash': 'h', 'budget': [{}, {}]}
+    uploads = []
+
+    # Test that the volatile dataset metadata is set on the activity and its subtypes, removing missing values
+    refresh_unchanged_documents([activity], False, None, uploads)
+    fields = {'dataset.metadata_modified': {'set': 'm'}, 'dataset.resources.hash': {'set': 'h'},
+              'dataset.resources.last_modified': {'set': None}}
+    assert list(mock_index.call_args[0][0]) == [
+        ('activity', {'id': 'ds|a', '_version_': 1, **fields}),
+        ('budget', {'id': 'ds|a|budget|0', '_version_': 1, **fields}),
+        ('budget', {'id': 'ds|a|budget|1', '_version_': 1, **fields}),
+    ]
+    assert mock_index.call_args[0][1:] == (False, None, uploads, None)
+
+    # Test that an FCDO instance, which does not index subtypes, only refreshes the activity
+    mocker.patch('direct_indexing.processing.dataset.settings.FCDO_INSTANCE', True)
+    refresh_unchanged_documents([activity])
+    assert [core for core, _ in mock_index.call_args[0][0]] == ['activity']
+
+
+def test_index_subtypes(mocker):
+    # mock index_subtype_batch
+    mock_batch = mocker.patch('direct_indexing.processing.dataset.index_subtype_batch')
+    mocker.patch('direct_indexing.processing.dataset.settings.SOLR_SUBTYPE_BATCH_SIZE', 2)
+    mock_size = mocker.patch('direct_indexing.processing.dataset.batch_size', side_effect=lambda core, size: size)
+
+    # Test that we don't index anything if there are no subtypes
+    index_subtypes(iter([]))
+    mock_batch.assert_not_called()
+
+    # Test that full batches are flushed as they fill, and the remainder is flushed at the end
+    subtypes = iter([('transaction', {'a': 1, 'id': 't1'}), ('result', {'b': 1}), ('transaction', {'a': 2}),
+                     ('transaction', {'a': 3})])
+    # Assert the ids of the indexed subtypes are returned
+    assert index_subtypes(subtypes) == {'transaction': {'t1'}}
+    assert mock_batch.call_args_list == [
+        mocker.call('transaction', [{'a': 1, 'id': 't1'}, {'a': 2}], False, None),
+        mocker.call('transaction', [{'a': 3}], False, None),
+        mocker.call('result', [{'b': 1}], False, None),
+    ]
+    # Assert the batch size is adapted to Solr once per batch
+    assert mock_size.call_count == 3
+    mock_size.assert_called_with('transaction', 2)
+
+    # Test that with a list of uploads, the batches are uploaded concurrently and their futures collected
+    mock_timed = mocker.patch('direct_indexing.processing.dataset.timed_subtype_batch', return_value=(INDEX_SUCCESS, 1))
+    uploads = []
+    subtypes = iter([('transaction', {'a': 1}), ('result', {'b': 1}), ('budget', {'c': 1})])
+    index_subtypes(subtypes, uploads=uploads)
+    assert len(uploads) == 3
+    assert wait_for_uploads(uploads) == (INDEX_SUCCESS, 3)
+    assert mock_timed.call_count == 3
+    assert uploads == []
+
+    # Test that with a dict of pending documents, the batches are collected instead of posted
+    pending = {}
+    mock_batch.reset_mock()
+    index_subtypes(iter([('result', {'b': 1}), ('result', {'b': 2}), ('result', {'b': 3})]), pending=pending)
+    assert pending == {'result': [{'b': 1}, {'b': 2}, {'b': 3}]}
+    mock_batch.assert_not_called()
+
+    # Test that a reduced batch size flushes smaller batches
+    mock_size.side_effect = lambda core, size: 1
+    mock_batch.reset_mock()
+    index_subtypes(iter([('result', {'b': 1}), ('result', {'b': 2})]))
+    assert mock_batch.call_count == 2
+
+
+def test_index_subtype_batch(mocker):
+    # mock index_documents
+    mock_index = mocker.patch('direct_indexing.processing.dataset.index_documents', return_value=INDEX_SUCCESS)
+
+    # Assert that we index the result batch into the result core
+    index_subtype_batch('result', [{}])
+    mock_index.assert_called_once_with(mocker.ANY, [{}], core='result')
+    assert mock_index.call_args[0][0].endswith('/result/update')
+
+    # Assert a shadow batch is indexed into the shadow core
+    index_subtype_batch('result', [{}], shadow=True)
+    assert mock_index.call_args[0][0].endswith('/result_shadow/update')
+
+    # Assert a failed batch does not raise
+    mock_index.return_value = 'Failed to index'
+    index_subtype_batch('result', [{}])
+
+    # Assert a failed batch is retried by bisecting it
+    mocker.patch('direct_indexing.processing.dataset.settings.SOLR_BISECT_FAILED_BATCHES', True)
+    mock_bisect = mocker.patch('direct_indexing.processing.dataset.bisect_failed_batch', return_value=INDEX_SUCCESS)
+    rejected = []
+    index_subtype_batch('result', [{}], rejected=rejected)
+    mock_bisect.assert_not_called()
+    mock_index.return_value = BadRequest('bad date')
+    assert index_subtype_batch('result', [{}], rejected=rejected) == INDEX_SUCCESS
+    mock_bisect.assert_called_once_with('result', mocker.ANY, [{}], rejected, 'bad date')
+
+    # Assert that with SolrCloud the batch is written per shard
+    mocker.patch('direct_indexing.processing.dataset.settings.SOLR_CLOUD', True)
+    mock_shard = mocker.patch('direct_indexing.processing.dataset.index_documents_by_shard',
+                              return_value=INDEX_SUCCESS)
+    index_subtype_batch('result', [{}], shadow=True)
+    mock_shard.assert_called_once_with('result_shadow', [{}], 'result')
+
+
+def test_wait_for_uploads():
+    assert wait_for_uploads([]) == (INDEX_SUCCESS, 0)
+    uploads = []
+    for result in [INDEX_SUCCESS, 'error 1', 'error 1']:
+        upload = futures.Future()
+        upload.set_result((result, 0.5))
+        uploads.append(upload)
+    # Assert the failure is reported, with the total upload duration
+    assert wait_for_uploads(uploads) == ('error 1', 1.5)
+    assert uploads == []
+
+    # Assert an upload which raised is reported as a failure, and the list is still cleared
+    upload = futures.Future()
+    upload.set_exception(requests.exceptions.ConnectionError('connection refused'))
+    uploads = [upload]
+    assert wait_for_uploads(uploads) == ('connection refused', 0)
+    assert uploads == []
+
+
+def test_timed_subtype_batch(mocker):
+    mock_batch = mocker.patch('direct_indexing.processing.dataset.index_subtype_batch', return_value=INDEX_SUCCESS)
+    result, duration = timed_subtype_batch('result', [{}], True)
+    assert result == INDEX_SUCCESS
+    assert duration >= 0
+    mock_batch.assert_called_once_with('result', [{}], True, None)
+
+
+def test_bisect_failed_batch(mocker):
+    mocker.patch('direct_indexing.processing.dataset.settings.SOLR_MAX_REJECTED_DOCUMENTS', 3)
+    rejection = {'core': 'result', 'id': 'b', 'error': 'bad date'}
+    mock_bisect = mocker.patch('direct_indexing.processing.dataset.index_documents_bisecting',
+                               return_value=(INDEX_SUCCESS, [rejection]))
+    rejected = [{'core': 'activity', 'id': 'a', 'error': 'bad date'}]
+    assert bisect_failed_batch('result', 'url', [{'id': 'b'}], rejected, 'bad date') == INDEX_SUCCESS
+    # Assert the rejections are collected, and the maximum applies to the whole dataset
+    mock_bisect.assert_called_once_with('url', [{'id': 'b'}], 'result', 2, 'bad date')
+    assert rejected[-1] == rejection
 
 
 @pytest.fixture
@@ -1,7 +1,10 @@
+import hashlib
+
 import pytest
 
 from direct_indexing.processing.util import (
-    get_dataset_filepath, get_dataset_filetype, get_dataset_version_validity, valid_version_from_file
+    get_dataset_filepath, get_dataset_filesize, get_dataset_filetype, get_dataset_version_validity, get_file_hash,
+    set_activity_hashes, set_document_ids, valid_version_from_file
 )
 
 PATCH_FN = 'direct_indexing.processing.util.valid_version_from_file'
@@ -25,6 +28,44 @@ def test_get_dataset_filepath(mocker, fixture_dataset_activity, fixture_dataset_
     assert get_dataset_filepath(None) is None
 
 
+def test_get_dataset_filesize(mocker, tmp_path):
+    file_path = tmp_path / 'fcdo-set-1.xml'
+    mock_filepath = mocker.patch('direct_indexing.processing.util.get_dataset_filepath', return_value=str(file_path))
+    # Test that a missing file has no size
+    assert get_dataset_filesize({}) == 0
+    file_path.write_text('<xml>test</xml>')
+    assert get_dataset_filesize({}) == 15
+    mock_filepath.return_value = None
+    assert get_dataset_filesize({}) == 0
+
+
+def test_get_file_hash(mocker, tmp_path):
+    file_path = tmp_path / 'fcdo-set-1.xml'
+    # Test that a missing file has no hash
+    assert get_file_hash(None) == ''
+    assert get_file_hash(str(file_path)) == ''
+    file_path.write_text('<xml>test</xml>')
+    expected = hashlib.sha256(b'<xml>test</xml>').hexdigest()
+    assert get_file_hash(str(file_path)) == expected
+    # Test that the file is hashed in chunks
+    mocker.patch('direct_indexing.processing.util.HASH_CHUNK_SIZE', 4)
+    assert get_file_hash(str(file_path)) == expected
+
+
+def test_set_activity_hashes():
+    data = [{'id': 'ds|a', 'title': 'a'}, {'id': 'ds|b', 'title': 'b'}]
+    assert set_activity_hashes(data) == set()
+    hashes = {activity['id']: activity['iati_cloud_activity_hash'] for activity in data}
+    assert hashes['ds|a'] != hashes['ds|b']
+
+    # Test that the activities with the same content are unchanged, regardless of the volatile dataset metadata
+    data = [{'id': 'ds|a', 'title': 'a', 'dataset.resources.hash': 'new'}, {'id': 'ds|b', 'title': 'changed'},
+            {'id': 'ds|c', 'title': 'c'}]
+    assert set_activity_hashes(data, hashes) == {'ds|a'}
+    # Test that the hash is stable when the activity is hashed again
+    assert set_activity_hashes(data[0], hashes) == {'ds|a'}
+
+
 def test_get_dataset_version_validity(mocker, tmp_path):
     field_name = 'extras.iati_version'
     file_path = tmp_path / "fcdo-set-1.xml"
@@ -80,6 +121,22 @@ def test_valid_version_from_file(tmp_path):
     assert not valid_version_from_file(file_path)
 
 
+def test_set_document_ids():
+    # Test activities get an id from the dataset id and their identifier, repeated identifiers are numbered
+    data = [{'iati-identifier': 'a'}, {'iati-identifier': 'b'}, {'iati-identifier': 'a'}, {}]
+    assert set_document_ids(data, 'activity', 'ds') == ['ds|a', 'ds|b', 'ds|a|1', 'ds|position-3']
+    assert data[0]['id'] == 'ds|a'
+    assert data[2]['id'] == 'ds|a|1'
+
+    # Test a single organisation uses the organisation-identifier
+    data = {'organisation-identifier': 'org'}
+    assert set_document_ids(data, 'organisation', 'ds') == ['ds|org']
+    assert data['id'] == 'ds|org'
+
+    # Test a SolrCloud routing key is prefixed for compositeId routing
+    assert set_document_ids([{'iati-identifier': 'a'}], 'activity', 'ds', 'GB-1') == ['GB-1!ds|a']
+
+
 @pytest.fixture
 def fixture_dataset_activity():
     return {
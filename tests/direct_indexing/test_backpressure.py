@@ -0,0 +1,77 @@
+import fcntl
+import json
+
+import pytest
+
+from direct_indexing.backpressure import _acquire_slot, batch_size, record_write, write_slot
+
+CORE = 'activity'
+
+
+@pytest.fixture(autouse=True)
+def lock_dir(mocker, tmp_path):
+    mocker.patch('direct_indexing.backpressure.settings.SOLR_BACKPRESSURE', True)
+    mocker.patch('direct_indexing.backpressure.settings.SOLR_WRITE_LOCK_DIR', str(tmp_path))
+    mocker.patch('direct_indexing.backpressure.settings.SOLR_MAX_CONCURRENT_WRITES', 4)
+    mocker.patch('direct_indexing.backpressure.settings.SOLR_WRITE_TARGET_LATENCY', 10)
+    return tmp_path
+
+
+def read_state(lock_dir):
+    with open(lock_dir / f'{CORE}.json') as state_file:
+        return json.load(state_file)
+
+
+def test_record_write(mocker, lock_dir):
+    # A slow write halves the limit and the batch size
+    record_write(CORE, 20, True)
+    state = read_state(lock_dir)
+    assert state['limit'] == 2
+    assert state['batch_scale'] == 0.5
+    # Errors seen by writes in flight at the same moment only decrease once
+    record_write(CORE, 1, False)
+    assert read_state(lock_dir)['limit'] == 2
+
+    # Fast writes increase the limit additively, up to the maximum
+    record_write(CORE, 1, True)
+    assert read_state(lock_dir)['limit'] == 2.5
+    for _ in range(20):
+        record_write(CORE, 1, True)
+    state = read_state(lock_dir)
+    assert state['limit'] == 4
+    assert state['batch_scale'] > 0.5
+
+    # After the cool down, errors decrease the limit again, to at least one write
+    mocker.patch('direct_indexing.backpressure.time.time', return_value=state['decreased'] + 100)
+    record_write(CORE, 1, False)
+    assert read_state(lock_dir)['limit'] == 2
+
+
+def test_batch_size(mocker):
+    assert batch_size(CORE, 5000) == 5000
+    record_write(CORE, 20, True)
+    assert batch_size(CORE, 5000) == 2500
+    assert batch_size(CORE, 1) == 1
+    mocker.patch('direct_indexing.backpressure.settings.SOLR_BACKPRESSURE', False)
+    assert batch_size(CORE, 5000) == 5000
+
+
+def test_write_slot(mocker, lock_dir):
+    mock_record = mocker.patch('direct_indexing.backpressure.record_write')
+    with write_slot(CORE) as record:
+        # The first slot is taken, so the next write gets the second slot
+        slot = _acquire_slot(CORE)
+        assert slot.name.endswith(f'{CORE}.slot1')
+        slot.close()
+        record(1, True)
+    mock_record.assert_called_once_with(CORE, 1, True)
+
+    # The slot is released after the write
+    with open(lock_dir / f'{CORE}.slot0', 'a') as slot:
+        fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_acquire_slot_times_out(mocker, lock_dir):
+    mocker.patch('direct_indexing.backpressure.settings.SOLR_TIMEOUT', 0)
+    # Without a free slot in time, the write continues without a slot
+    assert _acquire_slot(CORE) is None
@@ -6,6 +6,7 @@ import pytest
 from direct_indexing.direct_indexing import (
     clear_indices, clear_indices_for_core, drop_removed_data, run, run_dataset_metadata, run_publisher_metadata
 )
+from direct_indexing.processing.dataset import DATASET_CORES
 
 SOLR = 'pysolr.Solr'
 
@@ -28,6 +29,7 @@ def test_clear_indices_clears_all_indices(mocker):
     # UNIT TEST
     solr_instance_mock = mocker.MagicMock()
     mocker.patch(SOLR, return_value=solr_instance_mock)
+    mock_clear = mocker.patch('direct_indexing.direct_indexing.ledger.clear')
 
     result = clear_indices()
     # Check that the Solr delete method was called
@@ -36,6 +38,33 @@ def test_clear_indices_clears_all_indices(mocker):
     assert solr_instance_mock.delete.call_count == 7
     # Check that the output is "success"
     assert result == 'Success'
+    # Check that the dataset ledger is cleared along with the data
+    mock_clear.assert_called_once()
+
+
+def test_clear_indices_shadow(mocker):
+    mock_solr = mocker.patch(SOLR)
+    mock_clear = mocker.patch('direct_indexing.direct_indexing.ledger.clear')
+    clear_indices(shadow=True)
+    assert mock_solr.call_args[0][0].endswith('_shadow')
+    # The live data and its ledger remain
+    mock_clear.assert_not_called()
+
+
+def test_clear_indices_reset(mocker):
+    mocker.patch('direct_indexing.direct_indexing.settings.SOLR_CLEAR_MODE', 'reset')
+    mock_reset = mocker.patch('direct_indexing.direct_indexing.reset_core')
+    mock_solr = mocker.patch(SOLR)
+    mocker.patch('direct_indexing.direct_indexing.ledger.clear')
+    clear_indices()
+    # Assert every core is reset, without deleting by query
+    assert mock_reset.call_count == 7
+    mock_solr.assert_not_called()
+
+    # Assert the cores are cleared by query when they cannot be reset
+    mock_reset.side_effect = pysolr.SolrError
+    clear_indices_for_core('activity')
+    mock_solr.return_value.delete.assert_called_once_with(q='*:*')
 
 
 def test_clear_indices_raises_error(mocker):
@@ -85,12 +114,7 @@ def test_run_dataset_metadata(mocker):
     mock.assert_called_once()
 
 
-def test_drop_removed_data(mocker, tmp_path, requests_mock, fixture_solr_response, fixture_dataset_metadata):
-    # Mock settings.SOLR_DATASET to https://test.com
-    mocker.patch('direct_indexing.direct_indexing.settings.SOLR_DATASET', 'https://test.com')
-    test_url = 'https://test.com/select?fl=name%2Cid%2Ciati_cloud_indexed&indent=true&q.op=OR&q=*%3A*&rows=10000000'
-    requests_mock.get(test_url, json=fixture_solr_response)
-
+def test_drop_removed_data(mocker, tmp_path, fixture_dataset_metadata):
     # mock settings.BASE_DIR to be tmp_path
     mocker.patch('direct_indexing.direct_indexing.settings.BASE_DIR', tmp_path)
     paths = ['direct_indexing', 'data_sources', 'datasets']
@@ -100,43 +124,27 @@ def test_drop_removed_data(mocker, tmp_path, requests_mock, fixture_solr_respons
     with open(path / 'dataset_metadata.json', 'w') as f:
         json.dump(fixture_dataset_metadata, f)
 
-    # Mock pysolr.Solr
-    solr_instance_mock = mocker.MagicMock()
-    mock_solr = mocker.patch(SOLR, return_value=solr_instance_mock)
-    # mock solr.search to return a list with 2 elements
-    solr_instance_mock.search.return_value = [{}]
+    mock_delete_datasets = mocker.patch('direct_indexing.direct_indexing.delete_datasets')
+    mock_delete_documents = mocker.patch('direct_indexing.direct_indexing.delete_documents')
+    mock_seed = mocker.patch('direct_indexing.direct_indexing.ledger.ensure_seeded')
+    mock_ledger_ids = mocker.patch('direct_indexing.direct_indexing.ledger.dataset_ids',
+                                   return_value={'drop1', 'drop2', 'test'})
+    mock_forget = mocker.patch('direct_indexing.direct_indexing.ledger.forget_datasets')
     # Run drop_removed_data
     drop_removed_data()
 
-    # assert mock_solr was called 5 times, once for each core including datasets
-    assert mock_solr.call_count == 5
-
-    # assert solr's search and delete function is called a total of 10 times
-    # 2 times for each of the 5 cores, where 2 times represents drop1 and drop2
-    assert solr_instance_mock.search.call_count == 10
-    assert solr_instance_mock.delete.call_count == 10
-
+    # assert the indexed datasets are read from the dataset ledger, once it is seeded
+    mock_seed.assert_called_once()
+    # assert drop1 and drop2 are deleted from every dataset core in a single batch, and from the dataset core
+    mock_delete_datasets.assert_called_once_with(['drop1', 'drop2'], DATASET_CORES)
+    mock_delete_documents.assert_called_once_with('dataset', ['drop1', 'drop2'])
+    mock_forget.assert_called_once_with(['drop1', 'drop2'])
 
-@pytest.fixture
-def fixture_solr_response():
-    return {
-        'response': {
-            'docs': [
-                {
-                    'name': 'test',
-                    'iati_cloud_indexed': True,
-                },
-                {
-                    'name': 'drop1',
-                    'iati_cloud_indexed': True,
-                },
-                {
-                    'name': 'drop2',
-                    'iati_cloud_indexed': True,
-                }
-            ]
-        }
-    }
+    # assert nothing is deleted when no datasets were removed
+    mock_ledger_ids.return_value = {'test'}
+    mock_delete_datasets.reset_mock()
+    drop_removed_data()
+    mock_delete_datasets.assert_not_called()
 
 
 @pytest.fixture
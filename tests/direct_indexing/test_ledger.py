@@ -0,0 +1,138 @@
+import pytest
+import requests
+
+from direct_indexing import ledger
+
+
+def test_record_dataset(mocker):
+    mock_state = mocker.patch('direct_indexing.ledger.DatasetState')
+    mock_state.objects.update_or_create.return_value = ('state', True)
+    dataset = {'id': 'ds1', 'resources': [{'hash': 'h1'}], 'extras.filetype': 'activity', 'iati_cloud_indexed': True}
+    assert ledger.record_dataset(dataset, {'activity': {'a', 'b'}, 'result': set()}, 1.5) == 'state'
+    kwargs = mock_state.objects.update_or_create.call_args[1]
+    assert kwargs['dataset_id'] == 'ds1'
+    defaults = kwargs['defaults']
+    assert defaults['registry_hash'] == 'h1'
+    assert defaults['content_hash'] == ''
+    assert defaults['filetype'] == 'activity'
+    assert defaults['indexed'] is True
+    assert defaults['last_indexed'] is not None
+    assert defaults['document_counts'] == {'activity': 2, 'result': 0}
+    assert defaults['processing_seconds'] == 1.5
+    assert defaults['reindex'] is False
+
+    # A dataset which failed to index is recorded without an indexing time
+    ledger.record_dataset({'id': 'ds2', 'iati_cloud_indexed': False})
+    defaults = mock_state.objects.update_or_create.call_args[1]['defaults']
+    assert defaults['registry_hash'] == ''
+    assert defaults['last_indexed'] is None
+    assert defaults['document_counts'] == {}
+
+    # A dataset whose stale documents could not be dropped is marked to be indexed again
+    ledger.record_dataset(dataset, reindex=True)
+    assert mock_state.objects.update_or_create.call_args[1]['defaults']['reindex'] is True
+
+
+def test_ensure_seeded(mocker):
+    mock_state = mocker.patch('direct_indexing.ledger.DatasetState')
+    mock_seed = mocker.patch('direct_indexing.ledger.LedgerSeed')
+    mock_seed.objects.exists.return_value = False
+    docs = [
+        {'id': 'ds1', 'resources.hash': ['h1'], 'extras.filetype': 'activity', 'iati_cloud_content_hash': 'c1',
+         'iati_cloud_indexed': True, 'iati_cloud_processing_seconds': 1.5},
+        {'id': 'ds2', 'iati_cloud_indexed': False},
+    ]
+    mock_iterate = mocker.patch('direct_indexing.ledger.iterate_documents', return_value=iter(docs))
+    ledger.ensure_seeded()
+    # Every indexed dataset is recorded, keeping the state of the datasets which are already recorded
+    assert mock_iterate.call_args[0][:2] == ('dataset', 'id:*')
+    mock_state.assert_any_call(dataset_id='ds1', registry_hash='h1', content_hash='c1', filetype='activity',
+                               indexed=True, processing_seconds=1.5)
+    mock_state.assert_any_call(dataset_id='ds2', registry_hash='', content_hash='', filetype='',
+                               indexed=False, processing_seconds=None)
+    assert len(mock_state.objects.bulk_create.call_args[0][0]) == 2
+    assert mock_state.objects.bulk_create.call_args[1]['ignore_conflicts'] is True
+    mock_seed.objects.create.assert_called_once_with(datasets=2)
+
+    # A seeded ledger is complete, and not seeded again
+    mock_seed.objects.exists.return_value = True
+    mock_iterate.reset_mock()
+    ledger.ensure_seeded()
+    mock_iterate.assert_not_called()
+
+
+def test_reseed(mocker):
+    mock_state = mocker.patch('direct_indexing.ledger.DatasetState')
+    mock_atomic = mocker.patch('direct_indexing.ledger.transaction.atomic')
+    mock_state.objects.values_list.return_value = [('ds1', {'activity': 2}, 1.5)]
+    states = [mocker.Mock(dataset_id='ds1', processing_seconds=None), mocker.Mock(dataset_id='ds2')]
+    mocker.patch('direct_indexing.ledger._seed_state', side_effect=states)
+    mocker.patch('direct_indexing.ledger.iterate_documents', return_value=iter([{'id': 'ds1'}, {'id': 'ds2'}]))
+    ledger.reseed()
+    # The state of every dataset is replaced with the datasets in the swapped in dataset core, at once
+    mock_atomic.assert_called_once()
+    mock_state.objects.all.return_value.delete.assert_called_once()
+    assert mock_state.objects.bulk_create.call_args[0][0] == states
+    # Keeping the document counts and processing times which were recorded before
+    assert states[0].document_counts == {'activity': 2}
+    assert states[0].processing_seconds == 1.5
+
+    # If the dataset core cannot be read, the ledger is left as it is
+    mock_state.reset_mock()
+    mocker.patch('direct_indexing.ledger.iterate_documents', side_effect=requests.exceptions.ConnectionError)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        ledger.reseed()
+    mock_state.objects.all.return_value.delete.assert_not_called()
+
+
+def test_existing_datasets(mocker):
+    mock_state = mocker.patch('direct_indexing.ledger.DatasetState')
+    rows = mock_state.objects.exclude.return_value.exclude.return_value.values_list
+    rows.return_value = [
+        ('ds1', 'h1', 'activity', 'c1', True, False), ('ds2', 'h2', 'organisation', 'c2', False, False),
+        ('ds3', 'h3', 'activity', 'c3', True, True),
+    ]
+    # The content hash of a dataset which was not indexed, or needs to be indexed again, is not used
+    assert ledger.existing_datasets() == {
+        'ds1': {'hash': 'h1', 'filetype': 'activity', 'content_hash': 'c1', 'reindex': False},
+        'ds2': {'hash': 'h2', 'filetype': 'organisation', 'content_hash': '', 'reindex': False},
+        'ds3': {'hash': 'h3', 'filetype': 'activity', 'content_hash': '', 'reindex': True},
+    }
+    mock_state.objects.exclude.assert_called_once_with(registry_hash='')
+
+
+def test_update_registry_hashes(mocker):
+    mock_state = mocker.patch('direct_indexing.ledger.DatasetState')
+    ledger.update_registry_hashes({'ds1': 'h1'})
+    mock_state.objects.filter.assert_called_once_with(dataset_id='ds1')
+    mock_state.objects.filter.return_value.update.assert_called_once_with(registry_hash='h1')
+
+
+def test_dataset_ids(mocker):
+    mock_state = mocker.patch('direct_indexing.ledger.DatasetState')
+    mock_state.objects.values_list.return_value = ['ds1', 'ds2']
+    assert ledger.dataset_ids() == {'ds1', 'ds2'}
+
+
+def test_processing_times(mocker):
+    mock_state = mocker.patch('direct_indexing.ledger.DatasetState')
+    mock_state.objects.exclude.return_value.values_list.return_value = [('ds1', 1.5)]
+    assert ledger.processing_times() == {'ds1': 1.5}
+    mock_state.objects.exclude.assert_called_once_with(processing_seconds=None)
+
+
+def test_forget_datasets(mocker):
+    mock_state = mocker.patch('direct_indexing.ledger.DatasetState')
+    mock_state.objects.filter.return_value.delete.return_value = (2, {})
+    ledger.forget_datasets(['ds1', 'ds2'])
+    mock_state.objects.filter.assert_called_once_with(dataset_id__in=['ds1', 'ds2'])
+
+
+def test_clear(mocker):
+    mock_state = mocker.patch('direct_indexing.ledger.DatasetState')
+    mock_seed = mocker.patch('direct_indexing.ledger.LedgerSeed')
+    mock_seed.objects.exists.return_value = False
+    ledger.clear()
+    mock_state.objects.all.return_value.delete.assert_called_once()
+    # With the cores cleared, the empty ledger is complete
+    mock_seed.objects.create.assert_called_once_with()
@@ -0,0 +1,55 @@
+from direct_indexing.routing import DATASET_BATCH_TASK, DATASET_TASK, dataset_queue, fair_order, route_dataset_task
+
+SIZE_PATH = 'direct_indexing.routing.get_dataset_filesize'
+
+
+def dataset(name, publisher, size):
+    return {'id': name, 'organization': {'name': publisher}, 'size': size}
+
+
+def enable_routing(mocker):
+    mocker.patch('direct_indexing.routing.settings.DATASET_QUEUE_ROUTING', True)
+    mocker.patch('direct_indexing.routing.settings.DATASET_SMALL_QUEUE', 'datasets_small')
+    mocker.patch('direct_indexing.routing.settings.DATASET_LARGE_QUEUE', 'datasets_large')
+    mocker.patch('direct_indexing.routing.settings.DATASET_LARGE_BYTES', 100)
+    mocker.patch(SIZE_PATH, side_effect=lambda dataset: dataset['size'])
+
+
+def test_route_dataset_task(mocker):
+    large = dataset('a', 'fcdo', 1000)
+    mocker.patch('direct_indexing.routing.settings.DATASET_QUEUE_ROUTING', False)
+    assert route_dataset_task(DATASET_TASK, (), {'dataset': large}, {}) is None
+
+    enable_routing(mocker)
+    assert route_dataset_task(DATASET_TASK, (), {'dataset': large}, {}) == {'queue': 'datasets_large'}
+    assert route_dataset_task(DATASET_TASK, (large,), {}, {}) == {'queue': 'datasets_large'}
+    assert route_dataset_task(DATASET_TASK, (), {'dataset': dataset('b', 'fcdo', 10)}, {}) == {
+        'queue': 'datasets_small'
+    }
+    # Micro batches only hold small datasets
+    assert route_dataset_task(DATASET_BATCH_TASK, (), {'datasets': [(large, False)]}, {}) == {
+        'queue': 'datasets_small'
+    }
+    # Other tasks are left to the other routes
+    assert route_dataset_task('direct_indexing.tasks.revoke_all_tasks', (), {}, {}) is None
+
+
+def test_dataset_queue(mocker):
+    enable_routing(mocker)
+    assert dataset_queue(dataset('a', 'fcdo', 101)) == 'datasets_large'
+    assert dataset_queue(dataset('a', 'fcdo', 100)) == 'datasets_small'
+    assert dataset_queue(None) == 'datasets_small'
+
+
+def test_fair_order(mocker):
+    submissions = [(dataset('a1', 'a', 500), False), (dataset('a2', 'a', 400), False),
+                   (dataset('s', 'a', 50), True), (dataset('a3', 'a', 300), False),
+                   (dataset('b1', 'b', 200), False), (dataset('c1', None, 150), False)]
+    mocker.patch('direct_indexing.routing.settings.DATASET_QUEUE_ROUTING', False)
+    assert fair_order(submissions) == submissions
+
+    enable_routing(mocker)
+    # The large datasets take turns per publisher, the small datasets keep their order
+    ordered = fair_order(submissions)
+    assert [submission[0]['id'] for submission in ordered] == ['a1', 'b1', 'c1', 'a2', 'a3', 's']
+    assert ordered[-1] == submissions[2]
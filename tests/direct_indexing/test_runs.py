@@ -0,0 +1,70 @@
+from direct_indexing import runs
+from direct_indexing.models import RunDataset
+
+DATASETS = [
+    {'id': 'ds1', 'resources': [{'hash': 'h1'}]},
+    {'id': 'ds2', 'resources': [{}]},
+    {'id': 'ds3'},
+]
+
+
+def test_start_run(mocker):
+    mock_run = mocker.patch('direct_indexing.runs.IndexingRun')
+    mock_dataset = mocker.patch('direct_indexing.runs.RunDataset')
+    run = runs.start_run([(DATASETS[0], True), (DATASETS[1], False)], update=True)
+    assert run == mock_run.objects.create.return_value
+    mock_run.objects.create.assert_called_once_with(update=True, shadow=False)
+    # Every planned dataset is recorded with its hash and update flag
+    mock_dataset.assert_any_call(run=run, dataset_id='ds1', dataset_hash='h1', update=True)
+    mock_dataset.assert_any_call(run=run, dataset_id='ds2', dataset_hash='', update=False)
+    assert len(mock_dataset.objects.bulk_create.call_args[0][0]) == 2
+
+
+def test_mark_dataset(mocker):
+    mock_dataset = mocker.patch('direct_indexing.runs.RunDataset')
+    runs.mark_dataset(None, 'ds1', RunDataset.DONE)
+    mock_dataset.objects.filter.assert_not_called()
+
+    runs.mark_dataset(1, 'ds1', RunDataset.DONE)
+    mock_dataset.objects.filter.assert_called_once_with(run_id=1, dataset_id='ds1')
+    assert mock_dataset.objects.filter.return_value.update.call_args[1]['status'] == 'done'
+
+
+def test_finish_run(mocker):
+    mock_run = mocker.patch('direct_indexing.runs.IndexingRun')
+    runs.finish_run(None)
+    mock_run.objects.filter.assert_not_called()
+
+    runs.finish_run(1)
+    mock_run.objects.filter.assert_called_once_with(pk=1)
+    assert mock_run.objects.filter.return_value.update.call_args[1]['finished'] is not None
+
+
+def test_unfinished_run(mocker):
+    mock_run = mocker.patch('direct_indexing.runs.IndexingRun')
+    last = mock_run.objects.order_by.return_value.first
+    last.return_value = None
+    assert runs.unfinished_run() is None
+
+    last.return_value = mocker.MagicMock(finished=None)
+    assert runs.unfinished_run() == last.return_value
+    mock_run.objects.order_by.assert_called_with('-started')
+
+    # A finished last run is not resumed
+    last.return_value = mocker.MagicMock(finished='2024-01-01')
+    assert runs.unfinished_run() is None
+
+
+def test_unfinished_submissions(mocker):
+    run = mocker.MagicMock()
+    run.datasets.exclude.return_value.values_list.return_value = [('ds1', True), ('ds3', False), ('removed', False)]
+    # Only the unfinished datasets which are still in the dataset metadata are resubmitted
+    assert runs.unfinished_submissions(run, DATASETS) == [(DATASETS[0], True), (DATASETS[2], False)]
+    run.datasets.exclude.assert_called_once_with(status=RunDataset.DONE)
+
+
+def test_dataset_hash():
+    assert runs.dataset_hash(DATASETS[0]) == 'h1'
+    assert runs.dataset_hash(DATASETS[1]) == ''
+    assert runs.dataset_hash(DATASETS[2]) == ''
+    assert runs.dataset_hash({'resources': []}) == ''
@@ -43,6 +43,27 @@ def test_start(mocker):
     mock_subtask_dataset_metadata.assert_called_once()
     assert res == "Both the publisher and dataset metadata indexing have begun."
 
+    # Test that a rebuild clears the shadow cores, and indexes the publishers before the datasets
+    mock_clear = mocker.patch('direct_indexing.direct_indexing.clear_indices')
+    mock_run_publisher = mocker.patch('direct_indexing.direct_indexing.run_publisher_metadata')
+    start(True, rebuild=True)
+    mock_clear.assert_called_once_with(shadow=True)
+    mock_run_publisher.assert_called_once_with(shadow=True)
+    mock_subtask_publisher_metadata.assert_called_once()  # not called again
+    mock_subtask_dataset_metadata.assert_called_with(False, shadow=True, ignore_content_hash=False)
+
+    # Test that an update can ignore the content hashes of the datasets
+    start(True, ignore_content_hash=True)
+    mock_subtask_dataset_metadata.assert_called_with(True, shadow=False, ignore_content_hash=True)
+
+    # Test that resuming does not clear the cores, and only resumes the dataset indexing
+    mock_clear.reset_mock()
+    mock_datadump.reset_mock()
+    assert start(resume=True) == "Resuming the last indexing run."
+    mock_clear.assert_not_called()
+    mock_datadump.assert_not_called()
+    mock_subtask_dataset_metadata.assert_called_with(resume=True)
+
 
 def test_subtask_publisher_metadata(mocker):
     # mock direct_indexing.run_publisher_metadata
@@ -57,7 +78,7 @@ def test_subtask_dataset_metadata(mocker):
     mock_run = mocker.patch('direct_indexing.direct_indexing.run_dataset_metadata', return_value='Success')
     res = subtask_dataset_metadata(False)
     assert res == 'Success'
-    mock_run.assert_called_once()
+    mock_run.assert_called_once_with(False, shadow=False, resume=False, ignore_content_hash=False)
 
 
 def test_fcdo_replace_partial_url(mocker, tmp_path, fixture_dataset_metadata):
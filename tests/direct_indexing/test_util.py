@@ -1,12 +1,14 @@
+import gzip
+import json
 import os
-import subprocess
 import urllib.request
+import zlib
 
 import pysolr
 import pytest
+import requests
 
 from direct_indexing import util
-from iaticloud import settings
 
 
 # Test clear_core function
@@ -36,71 +38,389 @@ def test_clear_core(mocker):
         util.clear_core(core_url)
 
 
+def test_solr_core_url(mocker):
+    mocker.patch('direct_indexing.util.settings.SOLR_URL', 'https://example.com/solr')
+    assert util.solr_core_url('activity') == 'https://example.com/solr/activity'
+    assert util.solr_core_url('activity', shadow=True) == 'https://example.com/solr/activity_shadow'
+
+
+def test_count_documents(requests_mock):
+    requests_mock.get('https://example.com/solr/activity/select', json={'response': {'numFound': 42, 'docs': []}})
+    assert util.count_documents('https://example.com/solr/activity') == 42
+    assert requests_mock.last_request.qs['rows'] == ['0']
+
+
+def test_swap_cores(mocker, requests_mock):
+    mocker.patch('direct_indexing.util.settings.SOLR_URL', 'https://example.com/solr')
+    admin = requests_mock.get('https://example.com/solr/admin/cores', json={})
+    util.swap_cores('activity', 'activity_shadow')
+    assert admin.last_request.qs['action'] == ['swap']
+    assert admin.last_request.qs['other'] == ['activity_shadow']
+
+    # Assert failing swaps raise a SolrError
+    requests_mock.get('https://example.com/solr/admin/cores', status_code=400, json={'error': {'msg': 'no core'}})
+    with pytest.raises(pysolr.SolrError):
+        util.swap_cores('activity', 'activity_shadow')
+    requests_mock.get('https://example.com/solr/admin/cores', exc=requests.exceptions.ConnectionError)
+    with pytest.raises(pysolr.SolrError):
+        util.swap_cores('activity', 'activity_shadow')
+
+
+def test_reset_core(mocker, requests_mock):
+    mocker.patch('direct_indexing.util.settings.SOLR_URL', 'https://example.com/solr')
+    admin_url = 'https://example.com/solr/admin/cores'
+    admin = requests_mock.get(admin_url, json={'status': {'activity': {'instanceDir': '/var/solr/data/activity'}}})
+    util.reset_core('activity')
+    # Assert the core is unloaded with its index, and created again in its instance directory
+    actions = [request.qs['action'][0] for request in admin.request_history]
+    assert actions == ['status', 'unload', 'create']
+    assert admin.request_history[1].qs['deleteindex'] == ['true']
+    assert admin.request_history[2].qs['instancedir'] == ['/var/solr/data/activity']
+
+    # Assert an unknown core is not unloaded
+    admin = requests_mock.get(admin_url, json={'status': {'activity': {}}})
+    with pytest.raises(pysolr.SolrError):
+        util.reset_core('activity')
+    assert admin.call_count == 1
+
+    # Assert a failing CoreAdmin API raises a SolrError
+    requests_mock.get(admin_url, status_code=404, reason='Not Found')
+    with pytest.raises(pysolr.SolrError):
+        util.reset_core('activity')
+
+
+def test_commit_core(mocker):
+    core_url = "https://example.com/solr/core"
+    mock_solr = mocker.patch('pysolr.Solr')
+    util.commit_core(core_url)
+    mock_solr.assert_called_with(core_url)
+    mock_solr.return_value.commit.assert_called_once_with(softCommit=False)
+    util.commit_core(core_url, soft=True)
+    mock_solr.return_value.commit.assert_called_with(softCommit=True)
+
+    # Assert that commit_core raises its error when encountering a pysolr.SolrError
+    mock_solr.return_value.commit.side_effect = pysolr.SolrError
+    with pytest.raises(pysolr.SolrError):
+        util.commit_core(core_url)
+
+
+def test_commit_params(mocker):
+    policy = 'direct_indexing.util.settings.SOLR_COMMIT_POLICY'
+    mocker.patch(policy, 'hard')
+    assert util.commit_params(final=True) == {'commit': 'true'}
+    # Only the final request of an update commits
+    assert util.commit_params() == {}
+
+    mocker.patch(policy, 'soft')
+    assert util.commit_params(final=True) == {'softCommit': 'true'}
+    assert util.commit_params() == {}
+
+    mocker.patch(policy, 'within')
+    mocker.patch('direct_indexing.util.settings.SOLR_COMMIT_WITHIN', 1000)
+    assert util.commit_params() == {'commitWithin': 1000}
+    assert util.commit_params(final=True) == {'commitWithin': 1000}
+
+    mocker.patch(policy, 'none')
+    assert util.commit_params(final=True) == {}
+
+
+def test_optimize_core(mocker):
+    core_url = "https://example.com/solr/core"
+    mock_solr = mocker.patch('pysolr.Solr')
+    util.optimize_core(core_url, 4)
+    mock_solr.return_value.optimize.assert_called_once_with(maxSegments=4)
+
+    mock_solr.return_value.optimize.side_effect = pysolr.SolrError
+    with pytest.raises(pysolr.SolrError):
+        util.optimize_core(core_url, 4)
+
+
+def test_warm_core(requests_mock):
+    core_url = "https://example.com/solr/core"
+    select = requests_mock.get(f'{core_url}/select', [{'json': {}}, {'status_code': 500}])
+    # Failing warming queries are skipped
+    assert util.warm_core(core_url, [{'q': 'title:*', 'facet.field': 'x'}, {}]) == 1
+    assert select.request_history[0].qs['q'] == ['title:*']
+    assert select.request_history[0].qs['rows'] == ['0']
+
+
+def test_delete_datasets(mocker, requests_mock):
+    mocker.patch('direct_indexing.util.settings.SOLR_URL', 'https://example.com/solr')
+    mocker.patch('direct_indexing.util.settings.SOLR_DELETE_BATCH_SIZE', 2)
+    mocker.patch('direct_indexing.util.settings.SOLR_COMMIT_POLICY', 'hard')
+    activity = requests_mock.post('https://example.com/solr/activity/update', json={})
+    budget = requests_mock.post('https://example.com/solr/budget/update', json={})
+
+    util.delete_datasets(['a', 'b', 'c'], ['activity', 'budget'])
+    # Assert the ids are combined into batched queries, and each core is committed once with its last query
+    assert activity.call_count == 2
+    assert budget.call_count == 2
+    assert activity.request_history[0].json() == {'delete': {'query': 'dataset.id:("a" OR "b")'}}
+    assert activity.request_history[0].qs == {}
+    assert activity.request_history[1].json() == {'delete': {'query': 'dataset.id:("c")'}}
+    assert activity.request_history[1].qs == {'commit': ['true']}
+
+    # Assert a failing delete raises a SolrError
+    requests_mock.post('https://example.com/solr/activity/update', status_code=400, json={'error': {'msg': 'err'}})
+    with pytest.raises(pysolr.SolrError):
+        util.delete_datasets(['a'], ['activity'])
+    requests_mock.post('https://example.com/solr/activity/update', exc=requests.exceptions.ConnectionError)
+    with pytest.raises(pysolr.SolrError):
+        util.delete_datasets(['a'], ['activity'])
+
+
+def test_delete_documents(mocker, requests_mock):
+    mocker.patch('direct_indexing.util.settings.SOLR_URL', 'https://example.com/solr')
+    mocker.patch('direct_indexing.util.settings.SOLR_DELETE_BATCH_SIZE', 2)
+    mocker.patch('direct_indexing.util.settings.SOLR_COMMIT_POLICY', 'hard')
+    activity = requests_mock.post('https://example.com/solr/activity/update', json={})
+
+    util.delete_documents('activity', ['a', 'b', 'c'])
+    assert activity.call_count == 2
+    assert activity.request_history[0].json() == {'delete': ['a', 'b']}
+    assert activity.request_history[1].json() == {'delete': ['c']}
+    assert activity.request_history[1].qs == {'commit': ['true']}
+
+
+def test_iterate_documents(mocker, requests_mock):
+    mocker.patch('direct_indexing.util.settings.SOLR_URL', 'https://example.com/solr')
+    mocker.patch('direct_indexing.util.settings.SOLR_PAGE_SIZE', 2)
+    select = requests_mock.get('https://example.com/solr/activity/select', [
+        {'json': {'response': {'docs': [{'id': 'a'}, {'id': 'b'}]}, 'nextCursorMark': 'c1'}},
+        {'json': {'response': {'docs': [{'id': 'c'}]}, 'nextCursorMark': 'c2'}},
+        {'json': {'response': {'docs': []}, 'nextCursorMark': 'c2'}},
+    ])
+    docs = list(util.iterate_documents('activity', 'dataset.id:"ds"', 'id'))
+    # Assert all pages are retrieved using the cursor mark
+    assert docs == [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+    assert select.call_count == 3
+    assert select.request_history[0].qs['cursormark'] == ['*']
+    assert select.request_history[1].qs['cursormark'] == ['c1']
+    assert select.request_history[0].qs['rows'] == ['2']
+
+
 # Test index_to_core function
-def test_index_to_core(tmp_path, mocker):
+def test_index_to_core(tmp_path, requests_mock):
     """
     Index to core:
-    - Runs solr post tool with the correct arguments URL and JSON path (which file to submit to solr)
-        - if the solr post tool fails, returns the error message
-        - if the solr post tool succeeds, returns 'Successfully indexed'
+    - Posts the JSON file to the provided update URL, committing the changes
+        - if solr responds with an error, returns the error message
+        - if solr succeeds, returns 'Successfully indexed'
     - Removes the JSON file if remove is True
-    - If subprocess errors, return that error.
+    - If the request errors, return that error.
     """
     # SETUP
     test_dir = tmp_path / "test_data"
     test_dir.mkdir()
     json_path = test_dir / "test_data.json"
     with open(json_path, 'w') as file:
-        file.write('{"key": "value"}')
+        file.write('[{"key": "value"}]')
 
-    url = "https://example.com/solr/core"
-    OP = "subprocess.check_output"
+    url = "https://example.com/solr/core/update"
     # SUCCESSFUL INDEX:
-    # Mock subprocess.check_output to simulate success
-    mocker.patch(OP, return_value=b"Successfully indexed")
-    # Test a successful indexing
-    result = util.index_to_core(url, str(json_path), remove=True)
-    # Assert that subprocess.check_output was called with the correct arguments
-    subprocess.check_output.assert_called_with([
-        settings.SOLR_POST_TOOL,
-        '-url',
-        url,
-        str(json_path)
-    ], stderr=subprocess.STDOUT)
+    posted = []
+
+    def solr_success(request, context):
+        posted.append(request.body.read())
+        return {'responseHeader': {'status': 0}}
+    requests_mock.post(url, json=solr_success)
+    result = util.index_to_core(url, str(json_path), remove=True, commit=True)
+    # Assert that the file content was posted and committed
+    assert requests_mock.last_request.qs == {'commit': ['true']}
+    assert requests_mock.last_request.headers['Content-Type'] == 'application/json'
+    assert posted == [b'[{"key": "value"}]']
     # Assert that the function returns 'Successfully indexed' for a successful operation
     assert result == "Successfully indexed"
-    # Assert that the file at json_path was not removed, as the remove argument was False
+    # Assert that the file at json_path was removed, as the remove argument was True
     assert os.path.exists(json_path) is False
 
     # FAILED INDEX:
     # re-add the file
     with open(json_path, 'w') as file:
-        file.write('{"key": "value"}')
-
-    # Mock subprocess.check_output to simulate failure
-    mocker.patch(OP, return_value=b"msg: Failed to index\nERROR...")
-    # Test a successful indexing
-    result = util.index_to_core(url, str(json_path), remove=True)
-    # Assert that subprocess.check_output was called with the correct arguments
-    subprocess.check_output.assert_called_with([settings.SOLR_POST_TOOL, '-url', url, str(json_path)],
-                                               stderr=subprocess.STDOUT)
-    # Assert that the function does not return 'Successfully indexed
-    assert result != "Successfully indexed"
-    # Assert that the file at json_path was removed, as the remove argument was True
-    assert os.path.exists(json_path) is False
+        file.write('[{"key": "value"}]')
+    requests_mock.post(url, status_code=400, json={'error': {'msg': 'ERROR: bad date', 'code': 400}})
+    result = util.index_to_core(url, str(json_path), remove=False)
+    # Assert that the function returns the solr error message
+    assert result == "ERROR: bad date"
+    # Assert that the file at json_path was not removed, as the remove argument was False
+    assert os.path.exists(json_path) is True
 
-    # SUBPROCESS ERROR INDEX:
-    # Mock subprocess.check_output to simulate failure
-    mocker.patch(OP, side_effect=subprocess.CalledProcessError(returncode=1, cmd="solr_post_tool"))
-    # Test a failed indexing
+    # REQUEST ERROR INDEX:
+    requests_mock.post(url, exc=requests.exceptions.ConnectionError)
     result = util.index_to_core(url, str(json_path), remove=True)
-    # Assert that subprocess.check_output was called with the correct arguments
-    subprocess.check_output.assert_called_with([settings.SOLR_POST_TOOL, '-url', url, str(json_path)],
-                                               stderr=subprocess.STDOUT)
     # Assert that the function returns an error message for a failed operation
     assert "Failed to index due to:" in result
 
 
+def test_index_documents(requests_mock):
+    url = "https://example.com/solr/core/update"
+    requests_mock.post(url, json={'responseHeader': {'status': 0}})
+    assert util.index_documents(url, [{'id': 1}]) == "Successfully indexed"
+    assert requests_mock.last_request.json() == [{'id': 1}]
+    # The documents are not committed on their own, unless asked to
+    assert requests_mock.last_request.qs == {}
+    util.index_documents(url, [{'id': 1}], commit=True)
+    assert requests_mock.last_request.qs == {'commit': ['true']}
+
+    # A bad request is reported as such, other errors are not
+    requests_mock.post(url, status_code=400, json={'error': {'msg': 'bad date', 'code': 400}})
+    result = util.index_documents(url, [{'id': 1}])
+    assert result == 'bad date'
+    assert isinstance(result, util.BadRequest)
+    # As is an atomic update of a document which does not exist
+    requests_mock.post(url, status_code=409, json={'error': {'msg': 'Document not found', 'code': 409}})
+    assert isinstance(util.index_documents(url, [{'id': 1, '_version_': 1}]), util.BadRequest)
+    requests_mock.post(url, status_code=500, reason='Server Error')
+    assert not isinstance(util.index_documents(url, [{'id': 1}]), util.BadRequest)
+
+    requests_mock.post(url, exc=requests.exceptions.ConnectionError)
+    assert "Failed to index due to:" in util.index_documents(url, [{'id': 1}])
+
+
+def test_index_documents_bisecting(requests_mock):
+    url = "https://example.com/solr/core/update"
+
+    def reject_bad(request, context):
+        if any(document.get('bad') for document in request.json()):
+            context.status_code = 400
+            return {'error': {'msg': 'bad date'}}
+        return {'responseHeader': {'status': 0}}
+    documents = [{'id': str(i), 'bad': i in (2, 5)} for i in range(8)]
+    post = requests_mock.post(url, json=reject_bad)
+    result, rejected = util.index_documents_bisecting(url, documents, 'core')
+    # Assert the valid documents are indexed and only the bad documents are rejected
+    assert result == "Successfully indexed"
+    assert rejected == [
+        {'core': 'core', 'id': '2', 'error': 'bad date'}, {'core': 'core', 'id': '5', 'error': 'bad date'}
+    ]
+    indexed = {document['id'] for request in post.request_history if request.json() and not
+               any(d['bad'] for d in request.json()) for document in request.json()}
+    assert indexed == {'0', '1', '3', '4', '6', '7'}
+
+    # Assert a batch that was already rejected is not posted again, but split in halves right away
+    post.reset()
+    result, rejected = util.index_documents_bisecting(url, documents, 'core', error='bad date')
+    assert result == "Successfully indexed"
+    assert len(rejected) == 2
+    assert documents not in [request.json() for request in post.request_history]
+    assert post.request_history[0].json() == documents[:4]
+    # A single rejected document is rejected without posting it again
+    post.reset()
+    result, rejected = util.index_documents_bisecting(url, [documents[2]], 'core', error='bad date')
+    assert rejected == [{'core': 'core', 'id': '2', 'error': 'bad date'}]
+    assert post.call_count == 0
+
+    # Assert the batch fails once too many documents are rejected
+    result, rejected = util.index_documents_bisecting(url, documents, 'core', max_rejected=1)
+    assert result == 'bad date'
+    assert len(rejected) == 1
+
+    # Assert server and connection errors are not bisected
+    post = requests_mock.post(url, status_code=500, reason='Server Error')
+    result, rejected = util.index_documents_bisecting(url, documents)
+    assert result == 'Failed to index due to:\n 500 Server Error'
+    assert post.call_count == 1
+    requests_mock.post(url, exc=requests.exceptions.ConnectionError)
+    assert "Failed to index due to:" in util.index_documents_bisecting(url, documents)[0]
+
+
+def test_post_records_writes(mocker, tmp_path, requests_mock):
+    mocker.patch('direct_indexing.backpressure.settings.SOLR_BACKPRESSURE', True)
+    mocker.patch('direct_indexing.backpressure.settings.SOLR_WRITE_LOCK_DIR', str(tmp_path))
+    mock_record = mocker.patch('direct_indexing.backpressure.record_write')
+    url = "https://example.com/solr/core/update"
+    requests_mock.post(url, json={'responseHeader': {'status': 0}})
+    util.index_documents(url, [{'id': 1}])
+    # Assert the write is recorded for the core, as a success
+    assert mock_record.call_args[0][0] == 'core'
+    assert mock_record.call_args[0][2] is True
+    # Assert writes to a shadow core or shard replica can be recorded for the core they belong to
+    shard_url = "https://example.com/solr/core_shadow_shard1_replica_n1/update"
+    requests_mock.post(shard_url, json={'responseHeader': {'status': 0}})
+    util.index_documents(shard_url, [{'id': 1}], core='core')
+    assert mock_record.call_args[0][0] == 'core'
+
+    # Assert server and connection errors are recorded as failures
+    requests_mock.post(url, status_code=503)
+    util.index_documents(url, [{'id': 1}])
+    assert mock_record.call_args[0][2] is False
+    requests_mock.post(url, exc=requests.exceptions.ConnectionError)
+    util.index_documents(url, [{'id': 1}])
+    assert mock_record.call_args[0][2] is False
+
+
+def test_compress(mocker, tmp_path):
+    mocker.patch('direct_indexing.util.settings.SOLR_COMPRESSION_MIN_BYTES', 100)
+    body = json.dumps([{'activity-plus-child-aggregation.disbursement.value-usd': i} for i in range(100)])
+
+    # Assert bodies are not compressed when compression is disabled, or they are small
+    mocker.patch('direct_indexing.util.settings.SOLR_COMPRESSION', '')
+    data, headers, size, wire_size = util._compress(body)
+    assert data == body.encode('utf-8')
+    assert 'Content-Encoding' not in headers
+    assert size == wire_size == len(body)
+    mocker.patch('direct_indexing.util.settings.SOLR_COMPRESSION', 'gzip')
+    assert 'Content-Encoding' not in util._compress('[]')[1]
+
+    # Assert large bodies are compressed with gzip or deflate
+    data, headers, size, wire_size = util._compress(body)
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(data).decode('utf-8') == body
+    assert wire_size == len(data) < size
+    mocker.patch('direct_indexing.util.settings.SOLR_COMPRESSION', 'deflate')
+    data, headers, _, _ = util._compress(body)
+    assert headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(data).decode('utf-8') == body
+
+    # Assert files are compressed into a temporary file
+    json_path = tmp_path / 'test.json'
+    json_path.write_text(body)
+    with open(json_path, 'rb') as json_file:
+        data, headers, size, wire_size = util._compress(json_file)
+    assert size == len(body)
+    assert zlib.decompress(data.read()).decode('utf-8') == body
+    data.close()
+
+
+def test_post_compressed(mocker, requests_mock):
+    mocker.patch('direct_indexing.util.settings.SOLR_COMPRESSION', 'gzip')
+    mocker.patch('direct_indexing.util.settings.SOLR_COMPRESSION_MIN_BYTES', 0)
+    url = "https://example.com/solr/core/update"
+    requests_mock.post(url, json={'responseHeader': {'status': 0}})
+    assert util.index_documents(url, [{'id': 1}]) == "Successfully indexed"
+    assert requests_mock.last_request.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(requests_mock.last_request.body)) == [{'id': 1}]
+
+
+def test_update_fields(requests_mock):
+    url = "https://example.com/solr/core/update"
+    requests_mock.post(url, json={'responseHeader': {'status': 0}})
+    assert util.update_fields(url, [{'id': 'a', 'indexed': False, 'valid': 'Valid'}]) == "Successfully indexed"
+    # Assert only the given fields are set, on documents that already exist
+    assert requests_mock.last_request.json() == [
+        {'id': 'a', '_version_': 1, 'indexed': {'set': False}, 'valid': {'set': 'Valid'}}
+    ]
+
+
+def test_solr_error_message(mocker):
+    response = mocker.MagicMock(status_code=500, reason='Server Error')
+    response.json.return_value = {'error': {'msg': 'test message'}}
+    assert util.solr_error_message(response) == 'test message'
+    # Unstructured responses fall back to the HTTP status
+    response.json.side_effect = ValueError
+    assert util.solr_error_message(response) == 'Failed to index due to:\n 500 Server Error'
+
+
+def test_upload_executor():
+    # The thread pool is shared between calls
+    assert util.upload_executor() is util.upload_executor()
+
+
+def test_solr_session():
+    # The session is shared between calls
+    assert util.solr_session() is util.solr_session()
+
+
 # Test datadump_success function
 def test_datadump_success(mocker):
     # Mock urllib.request.urlopen to return data with "passing" (success)